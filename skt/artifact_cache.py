@@ -0,0 +1,188 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General
+# Public License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Class for caching kernel build artifacts."""
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from skt.misc import join_with_slash
+
+# Suffix of the cache entry metadata files
+METADATA_SUFFIX = '.json'
+
+
+def get_build_key(*inputs):
+    """
+    Compute a cache key from the inputs of a build.
+
+    Args:
+        *inputs:    Strings identifying the build inputs, e.g. the tree hash,
+                    config hash, architecture, toolchain and make options.
+
+    Returns:
+        The key, a hex string.
+    """
+    sha = hashlib.sha256()
+    for build_input in inputs:
+        sha.update(str(build_input))
+        sha.update('\0')
+    return sha.hexdigest()
+
+
+class ArtifactCache(object):
+    """
+    A local directory of kernel tarballs keyed by the hash of their build
+    inputs. Each entry consists of the tarball and a JSON metadata file, which
+    also records the URL the tarball was published at, if any. The
+    least-recently used entries are evicted when the total size of the
+    tarballs exceeds the size limit.
+    """
+
+    def __init__(self, path, max_size=None):
+        """
+        Initialize an artifact cache.
+
+        Args:
+            path:       Path to the cache directory, created if missing.
+            max_size:   Maximum total size of the cached tarballs in bytes,
+                        or None for no limit.
+        """
+        self.path = path
+        self.max_size = max_size
+
+        try:
+            os.makedirs(self.path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    def __metadata_path(self, key):
+        """Get the path to the metadata file of an entry."""
+        return join_with_slash(self.path, key + METADATA_SUFFIX)
+
+    def __read_metadata(self, key):
+        """Read metadata of an entry, return None if it's missing."""
+        try:
+            with open(self.__metadata_path(key), 'r') as fileh:
+                return json.load(fileh)
+        except (IOError, ValueError):
+            return None
+
+    def __write_metadata(self, key, metadata):
+        """Atomically write metadata of an entry."""
+        (fdesc, tmppath) = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fdesc, 'w') as fileh:
+            json.dump(metadata, fileh, sort_keys=True)
+        os.rename(tmppath, self.__metadata_path(key))
+
+    def lookup(self, key):
+        """
+        Look up a cached build and mark it as recently used.
+
+        Args:
+            key:    The build key, see get_build_key().
+
+        Returns:
+            The metadata dictionary of the entry, with the path to the cached
+            tarball under 'path', or None if the build is not cached.
+        """
+        metadata = self.__read_metadata(key)
+        if not metadata or not os.path.isfile(metadata.get('path', '')):
+            return None
+
+        # The modification time of the metadata marks the last use.
+        os.utime(self.__metadata_path(key), None)
+        logging.info("artifact cache hit: %s", metadata['path'])
+        return metadata
+
+    def store(self, key, tarball, **metadata):
+        """
+        Add a built tarball to the cache, and evict old entries if the cache
+        grows over its size limit.
+
+        Args:
+            key:        The build key, see get_build_key().
+            tarball:    Path to the tarball to cache. It's hard-linked into
+                        the cache if possible, copied otherwise.
+            **metadata: Extra metadata to store with the entry.
+
+        Returns:
+            The path to the cached tarball.
+        """
+        name = os.path.basename(tarball)
+        extension = name[name.rindex('.tar'):] if '.tar' in name else ''
+        cached = join_with_slash(self.path, key + extension)
+
+        tmppath = '{}.{}.tmp'.format(cached, os.getpid())
+        try:
+            os.link(tarball, tmppath)
+        except OSError:
+            shutil.copyfile(tarball, tmppath)
+        os.rename(tmppath, cached)
+
+        metadata['path'] = cached
+        metadata['size'] = os.path.getsize(cached)
+        self.__write_metadata(key, metadata)
+        logging.info("stored %s in artifact cache as %s", tarball, cached)
+
+        self.evict()
+        return cached
+
+    def update(self, key, **metadata):
+        """
+        Update metadata of a cached entry, e.g. with its published URL.
+
+        Args:
+            key:        The build key, see get_build_key().
+            **metadata: Metadata to add or replace.
+        """
+        current = self.__read_metadata(key)
+        if current is None:
+            return
+
+        current.update(metadata)
+        self.__write_metadata(key, current)
+
+    def evict(self):
+        """Remove least-recently used entries over the size limit."""
+        if self.max_size is None:
+            return
+
+        entries = []
+        for filename in os.listdir(self.path):
+            if not filename.endswith(METADATA_SUFFIX):
+                continue
+            key = filename[:-len(METADATA_SUFFIX)]
+            metadata = self.__read_metadata(key)
+            if metadata is None:
+                continue
+            mtime = os.path.getmtime(self.__metadata_path(key))
+            entries.append((mtime, key, metadata))
+
+        total = sum(metadata.get('size', 0) for (_, _, metadata) in entries)
+        for (_, key, metadata) in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            logging.info("evicting %s from artifact cache", metadata['path'])
+            for path in [self.__metadata_path(key), metadata['path']]:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            total -= metadata.get('size', 0)
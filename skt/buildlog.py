@@ -0,0 +1,477 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General
+# Public License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Classes for streaming, scanning and indexing kernel build logs."""
+import contextlib
+import fcntl
+import gzip
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+# Regular expressions for the interesting lines of a kernel build log.
+TARBALL_REGEX = r'^Tarball successfully created in (?P<path>.*)$'
+COMPILER_ERROR_REGEX = (
+    r'^(?P<file>[^:\s]+):(?P<line>\d+):(?:\d+:)? (?:fatal )?error: '
+)
+COMPILER_WARNING_REGEX = (
+    r'^(?P<file>[^:\s]+):(?P<line>\d+):(?:\d+:)? warning: '
+)
+# E.g. "make[2]: *** [scripts/Makefile.build:304: fs/foo.o] Error 1", the
+# makefile location is only printed by make 4.2 and newer.
+MAKE_ERROR_REGEX = (
+    r'^make(?:\[\d+\])?: \*\*\* \[(?:(?P<makefile>[^\]]+?:\d+): )?'
+    r'(?P<target>[^\]]+)\] Error (?P<code>\d+)'
+)
+# Kbuild short output of a processed file, e.g. "  CC [M]  fs/foo.o"
+KBUILD_STEP_REGEX = r'^  (?P<tool>[A-Z0-9_]+)(?: \[M\])?\s+(?P<path>\S+)$'
+
+# Version of the build log index format
+INDEX_VERSION = 1
+# Maximum length of a log line stored in the index
+INDEX_MAX_LINE = 512
+# Amount of log data compressed into each gzip member of a compressed log
+GZIP_MEMBER_SIZE = 1024 * 1024
+# Compression level of the compressed logs, a trade-off for speed
+GZIP_LEVEL = 6
+
+
+class LogMatcher(object):
+    """Collect the lines of a log matching a regular expression."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, regex, first_only=False):
+        """
+        Initialize a log matcher.
+
+        Args:
+            regex:      Regular expression to search each line for.
+            first_only: True if only the first match should be kept.
+        """
+        self.regex = re.compile(regex)
+        self.first_only = first_only
+        # List of (offset, match) tuples, where offset is the position of the
+        # matching line in the log.
+        self.matches = []
+
+    def feed(self, line, offset):
+        """
+        Check a single log line.
+
+        Args:
+            line:   The log line, without the trailing newline.
+            offset: Offset of the line from the start of the log, in bytes.
+        """
+        if self.first_only and self.matches:
+            return
+
+        match = self.regex.search(line)
+        if match:
+            self.matches.append((offset, match))
+
+    def first(self):
+        """
+        Get the first match.
+
+        Returns:
+            The first match object, or None if nothing matched.
+        """
+        return self.matches[0][1] if self.matches else None
+
+
+class GzipLogWriter(object):
+    """
+    Write a log compressed as a series of gzip members, each holding about
+    GZIP_MEMBER_SIZE bytes of whole lines. Any gzip reader decompresses the
+    members as a single stream, and with the recorded member offsets, a
+    reader can start decompressing right before any part of the log.
+    """
+
+    def __init__(self, path, member_size=None):
+        """
+        Initialize a compressed log writer and create the log file.
+
+        Args:
+            path:           Path of the compressed log file to write.
+            member_size:    Amount of uncompressed data to put into a member,
+                            GZIP_MEMBER_SIZE by default.
+        """
+        self.member_size = member_size or GZIP_MEMBER_SIZE
+        # List of (offset, compressed offset) tuples, where offset is the
+        # position of the start of a member in the uncompressed log, and
+        # compressed offset its position in the log file.
+        self.members = []
+        self.offset = 0
+        self.__fileh = io.open(path, 'wb')
+        self.__member = None
+
+    def write(self, data):
+        """
+        Write data to the log, finishing the current member if it's full.
+
+        Args:
+            data:   The data, which should end with a whole line.
+        """
+        if self.__member is None:
+            self.members.append((self.offset, self.__fileh.tell()))
+            self.__member = gzip.GzipFile(fileobj=self.__fileh, mode='wb',
+                                          compresslevel=GZIP_LEVEL)
+
+        self.__member.write(data)
+        self.offset += len(data)
+
+        if self.offset - self.members[-1][0] >= self.member_size:
+            self.__member.close()
+            self.__member = None
+
+    def close(self):
+        """Finish the last member and close the log file."""
+        if self.__member is not None:
+            self.__member.close()
+            self.__member = None
+        self.__fileh.close()
+
+
+class BuildLogTee(object):
+    """
+    Stream output of processes into a log file and to stdout, while running
+    line matchers on it. Pass the file descriptor returned by fileno() as
+    stdout of the processes. Matches are complete once the tee is closed.
+    """
+
+    def __init__(self, path, matchers=None, echo=None, compress=False):
+        """
+        Initialize a build log tee.
+
+        Args:
+            path:       Path of the log file to write.
+            matchers:   A list of LogMatcher objects to feed the lines to.
+            echo:       File object to echo the lines to, sys.stdout by
+                        default.
+            compress:   True if the log should be written compressed, see
+                        GzipLogWriter.
+        """
+        self.path = path
+        self.matchers = matchers or []
+        self.echo = echo
+        self.compress = compress
+        self.offset = 0
+        # The gzip members of a compressed log, see GzipLogWriter.members,
+        # or None if the log is not compressed.
+        self.members = None
+        self.__logfile = None
+        self.__write_fd = None
+        self.__thread = None
+        # The exception raised while streaming, re-raised by close()
+        self.__error = None
+
+    def open(self):
+        """Open the log file and start streaming."""
+        if self.compress:
+            self.__logfile = GzipLogWriter(self.path)
+            self.members = self.__logfile.members
+        else:
+            self.__logfile = io.open(self.path, 'wb')
+        read_fd, self.__write_fd = os.pipe()
+        # Only the stdout of the processes should refer to the pipe, or any
+        # process outliving them would keep it open and close() would never
+        # see EOF.
+        for pipe_fd in (read_fd, self.__write_fd):
+            flags = fcntl.fcntl(pipe_fd, fcntl.F_GETFD)
+            fcntl.fcntl(pipe_fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self.__thread = threading.Thread(target=self.__pump, args=(read_fd,))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def fileno(self):
+        """
+        Get the file descriptor to pass as stdout of the logged processes.
+
+        Returns:
+            The write end of the pipe the tee reads from.
+        """
+        return self.__write_fd
+
+    def close(self):
+        """
+        Wait until all output was processed and close the log file.
+
+        Raises:
+            The exception raised while writing the output, if any, e.g. an
+            IOError if the disk with the log is full.
+        """
+        if self.__write_fd is None:
+            return
+
+        os.close(self.__write_fd)
+        self.__write_fd = None
+        self.__thread.join()
+        self.__logfile.close()
+
+        if self.__error is not None:
+            error = self.__error
+            self.__error = None
+            raise error
+
+    def __pump(self, read_fd):
+        """
+        Copy lines from the pipe to the sinks until EOF. If that fails, keep
+        draining the pipe, so the processes don't block on a full pipe, and
+        save the exception for close().
+        """
+        echo = self.echo or sys.stdout
+        with io.open(read_fd, 'rb') as reader:
+            try:
+                for line in iter(reader.readline, b''):
+                    self.__logfile.write(line)
+                    echo.write(line)
+                    echo.flush()
+
+                    stripped = line.rstrip(b'\r\n')
+                    for matcher in self.matchers:
+                        matcher.feed(stripped, self.offset)
+                    self.offset += len(line)
+            except Exception as exc:  # pylint: disable=broad-except
+                self.__error = exc
+                for _ in iter(lambda: reader.read(io.DEFAULT_BUFFER_SIZE),
+                              b''):
+                    pass
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, trace):
+        self.close()
+
+
+class BuildLogIndex(object):
+    """
+    Index of the interesting parts of a build log, built while the log is
+    streamed. It contains the offsets of the tarball line, compiler errors and
+    warnings, the failing make target, and the time spent in each directory.
+    The index is written as a small JSON file next to the log, so reports and
+    other tools can seek straight to the errors instead of scanning the log.
+    """
+
+    def __init__(self):
+        """Initialize an empty build log index."""
+        self.matchers = {
+            'tarball': LogMatcher(TARBALL_REGEX, first_only=True),
+            'error': LogMatcher(COMPILER_ERROR_REGEX),
+            'warning': LogMatcher(COMPILER_WARNING_REGEX),
+            'make_error': LogMatcher(MAKE_ERROR_REGEX, first_only=True),
+        }
+        self.__step_regex = re.compile(KBUILD_STEP_REGEX)
+        self.__tstart = time.time()
+        # Directory -> [first seen, last seen, number of build steps]
+        self.directories = {}
+        self.size = 0
+        # The gzip members of a compressed log, see GzipLogWriter.members,
+        # or None if the log is not compressed.
+        self.members = None
+
+    def feed(self, line, offset):
+        """
+        Index a single log line.
+
+        Args:
+            line:   The log line, without the trailing newline.
+            offset: Offset of the line from the start of the log, in bytes.
+        """
+        for matcher in self.matchers.values():
+            matcher.feed(line, offset)
+
+        match = self.__step_regex.match(line)
+        if match:
+            now = time.time() - self.__tstart
+            directory = os.path.dirname(match.group('path')) or '.'
+            timing = self.directories.setdefault(directory, [now, now, 0])
+            timing[1] = now
+            timing[2] += 1
+
+        self.size = offset + len(line) + 1
+
+    def to_dict(self):
+        """
+        Get the index as a dictionary.
+
+        Returns:
+            A dictionary, as written into the index file.
+        """
+        def located(matcher):
+            """Convert compiler messages into dictionaries."""
+            return [{'offset': offset,
+                     'file': match.group('file'),
+                     'line': int(match.group('line')),
+                     'message': match.string[:INDEX_MAX_LINE]}
+                    for (offset, match) in matcher.matches]
+
+        failed_target = None
+        make_error = self.matchers['make_error']
+        if make_error.matches:
+            offset, match = make_error.matches[0]
+            failed_target = {'offset': offset,
+                             'target': match.group('target'),
+                             'makefile': match.group('makefile'),
+                             'code': int(match.group('code'))}
+
+        tarball = self.matchers['tarball']
+        return {
+            'version': INDEX_VERSION,
+            'size': self.size,
+            'tarball': tarball.matches[0][0] if tarball.matches else None,
+            'errors': located(self.matchers['error']),
+            'warnings': located(self.matchers['warning']),
+            'failed_target': failed_target,
+            'members': ([list(member) for member in self.members]
+                        if self.members is not None else None),
+            'directories': {
+                directory: {'start': round(first, 3),
+                            'elapsed': round(last - first, 3),
+                            'steps': steps}
+                for (directory, (first, last, steps))
+                in self.directories.items()
+            },
+        }
+
+    def write(self, path):
+        """
+        Write the index into a file.
+
+        Args:
+            path:   Path of the index file.
+        """
+        with open(path, 'w') as fileh:
+            json.dump(self.to_dict(), fileh, sort_keys=True)
+
+
+def get_index_path(logpath):
+    """
+    Get the path of the index file belonging to a build log.
+
+    Args:
+        logpath:    Path to the build log.
+
+    Returns:
+        Path to the index file.
+    """
+    return logpath + '.index'
+
+
+def load_index(path):
+    """
+    Load a build log index file.
+
+    Args:
+        path:   Path to the index file.
+
+    Returns:
+        The index dictionary, or None if the index doesn't exist or is not
+        readable.
+    """
+    try:
+        with open(path, 'r') as fileh:
+            index = json.load(fileh)
+    except (IOError, ValueError):
+        return None
+
+    if index.get('version') != INDEX_VERSION:
+        return None
+
+    return index
+
+
+@contextlib.contextmanager
+def open_log(logpath, offset=0, index=None):
+    """
+    Open a build log for reading from an offset. A compressed log (ending
+    with .gz) is decompressed from the last gzip member starting before the
+    offset, if the index lists the members, or from its start otherwise.
+
+    Args:
+        logpath:    Path to the build log.
+        offset:     Offset in the uncompressed log to start reading at.
+        index:      The index dictionary of the build log, or None.
+
+    Returns:
+        A context manager for a binary file object, positioned at the
+        offset.
+    """
+    with io.open(logpath, 'rb') as fileh:
+        if not logpath.endswith('.gz'):
+            fileh.seek(offset)
+            yield fileh
+            return
+
+        (start, compressed_start) = (0, 0)
+        for (member_start, member_compressed) in \
+                (index or {}).get('members') or []:
+            if member_start > offset:
+                break
+            (start, compressed_start) = (member_start, member_compressed)
+
+        fileh.seek(compressed_start)
+        reader = gzip.GzipFile(fileobj=fileh, mode='rb')
+        try:
+            reader.seek(offset - start)
+            yield reader
+        finally:
+            reader.close()
+
+
+def get_error_excerpt(logpath, index, before=5, after=20):
+    """
+    Get the part of a build log around the first error, using its index.
+
+    Args:
+        logpath:    Path to the build log, possibly compressed, see
+                    open_log().
+        index:      The index dictionary of the build log.
+        before:     Number of lines to include before the error.
+        after:      Number of lines to include after the error.
+
+    Returns:
+        The excerpt as a string, or None if the index doesn't point to any
+        error.
+    """
+    if index['errors']:
+        offset = index['errors'][0]['offset']
+    elif index['failed_target']:
+        offset = index['failed_target']['offset']
+    else:
+        return None
+
+    # Read a window around the error only, assuming sane line lengths.
+    window = (before + 1) * INDEX_MAX_LINE
+    start = max(0, offset - window)
+    with open_log(logpath, start, index) as fileh:
+        head = fileh.read(offset - start).split(b'\n')
+        tail = []
+        for line in fileh:
+            tail.append(line.rstrip(b'\n'))
+            if len(tail) > after:
+                break
+
+    # The first line of the window is probably incomplete.
+    if start > 0:
+        head = head[1:]
+    # The last element is an empty string as the offset points to a line
+    # start.
+    head = head[:-1][-before:] if before else []
+
+    return b'\n'.join(head + tail) + b'\n'
@@ -14,10 +14,17 @@
 """Class for managing ConsoleLog."""
 import gzip
 import re
+import shutil
 import StringIO
+import tempfile
 
 import requests
 
+# Size of the chunks to compress files in
+GZIP_CHUNK_SIZE = 1024 * 1024
+# Maximum size of compressed data kept in memory before it's spooled to disk
+GZIP_SPOOL_SIZE = 1024 * 1024
+
 
 def gzipdata(data):
     """
@@ -35,6 +42,26 @@ def gzipdata(data):
     return tstr.getvalue()
 
 
+def gzipfile(path):
+    """
+    Compress a file with gzip, reading it in chunks, so neither the file nor
+    the compressed data have to fit in memory.
+
+    Args:
+        path:   Path to the file to compress.
+
+    Returns:
+        A spooled temporary file containing the gzip-compressed data,
+        positioned at its start.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=GZIP_SPOOL_SIZE)
+    with open(path, 'rb') as source, \
+            gzip.GzipFile(fileobj=spool, mode='wb') as fileh:
+        shutil.copyfileobj(source, fileh, GZIP_CHUNK_SIZE)
+    spool.seek(0)
+    return spool
+
+
 class ConsoleLog(object):
     """Console log parser"""
 
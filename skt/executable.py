@@ -13,7 +13,6 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
 from __future__ import print_function
-import ConfigParser
 import argparse
 import ast
 import atexit
@@ -24,25 +23,34 @@ import logging
 import os
 import shutil
 import signal
+import stat
 import subprocess
 import sys
 import tempfile
 import time
 import traceback
 
-import junit_xml
-
-import skt
-import skt.console
-import skt.publisher
-import skt.reporter
-import skt.runner
-from skt.kernelbuilder import KernelBuilder, CommandTimeoutError, ParsingError
+# The modules needed only by some of the commands, along with their heavier
+# dependencies (junit_xml, jinja2, requests, defusedxml), are imported by
+# those commands, so the others start faster.
+from skt.artifact_cache import ArtifactCache
+from skt.kernelbuilder import KernelBuilder, CommandTimeoutError, \
+    ParsingError, PACKAGE_FORMATS
 from skt.kerneltree import KernelTree, PatchApplicationError
-from skt.misc import join_with_slash, SKT_SUCCESS, SKT_FAIL, SKT_ERROR
-from skt.state_file import get_state, update_state
+from skt.misc import join_with_slash, measure, SKT_SUCCESS, SKT_FAIL, \
+    SKT_ERROR
+from skt.state_file import get_state, read_state_file, state_transaction, \
+    update_state
 
 DEFAULTRC = "~/.sktrc"
+# Configuration and state keys put into the stdout of the JUnit test cases by
+# default, see --junit-key
+JUNIT_KEYS = ['baserepo', 'basehead', 'buildhead', 'krelease', 'kernel_arch',
+              'mergelog', 'buildlog', 'cfgurl', 'buildurl', 'jobs',
+              'recipe_sets', 'retcode']
+# Default maximum number of artifact uploads running at the same time, a few
+# to overlap the connection setups without overloading the destination
+PUBLISH_JOBS = 4
 LOGGER = logging.getLogger()
 retcode = SKT_SUCCESS
 
@@ -113,17 +121,91 @@ def save_state(cfg, state):
     if not cfg.get('state'):
         return
 
-    config = cfg.get('_parser')
-    if not config.has_section("state"):
-        config.add_section("state")
-
+    updates = {}
     for (key, val) in state.iteritems():
         if val is not None:
             logging.debug("state: %s -> %s", key, val)
-            config.set('state', key, val)
+            updates[key] = val
+
+    # Merge the updates into the current state file, it could have been
+    # updated since the configuration was loaded.
+    update_state(cfg.get('rc'), updates)
+
+
+def get_metrics_properties(metrics):
+    """
+    Flatten build phase metrics into JUnit properties.
+
+    Args:
+        metrics:    A dictionary of build phase metrics, see misc.measure().
+
+    Returns:
+        A dictionary of properties like {'build.make.wall': '123.4', ...}.
+    """
+    properties = {}
+    for (phase, measurements) in (metrics or {}).items():
+        for (key, value) in measurements.items():
+            properties['build.{}.{}'.format(phase, key)] = str(value)
+
+    return properties
+
+
+def get_junit_stdout(cfg, metrics):
+    """
+    Get the stdout of a JUnit test case: a JSON object with the selected
+    configuration and state keys, and the metrics of the step.
 
-    with open(cfg.get('rc'), 'w') as fileh:
-        config.write(fileh)
+    Args:
+        cfg:        A dictionary of skt configuration.
+        metrics:    A dictionary of the step metrics, see misc.measure().
+
+    Returns:
+        The JSON string.
+    """
+    keys = cfg.get('junit_key') or JUNIT_KEYS
+    payload = {
+        'state': {key: cfg[key] for key in keys if cfg.get(key) is not None},
+        'metrics': metrics,
+    }
+    return json.dumps(payload, default=str, sort_keys=True)
+
+
+def write_junit(cfg):
+    """
+    Write the JUnit test cases created so far into "<command name>.xml" in
+    the JUnit result directory. The file is replaced atomically, so it always
+    contains valid results, even if skt is interrupted.
+
+    Args:
+        cfg:    A dictionary of skt configuration.
+    """
+    import junit_xml
+
+    testsuite = junit_xml.TestSuite(
+        "skt",
+        cfg.get('_testcases'),
+        properties=get_metrics_properties(cfg.get('build_metrics'))
+    )
+    path = join_with_slash(cfg.get('junit'), '{}.xml'.format(cfg['_name']))
+    (fdesc, tmppath) = tempfile.mkstemp(dir=cfg.get('junit'))
+    try:
+        with os.fdopen(fdesc, 'w') as fileh:
+            junit_xml.TestSuite.to_file(fileh, [testsuite])
+
+        # Keep the mode of the original file, or use the default one, the
+        # temporary file is only readable by us.
+        if os.path.isfile(path):
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(tmppath, mode)
+
+        os.rename(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
 
 
 def junit(func):
@@ -134,9 +216,11 @@ def junit(func):
     function otherwise.
 
     The generated test case is named "skt.<function-name>". The case stdout is
-    set to JSON representation of the configuration object after the function
-    call has completed. The created test case is appended to the "_testcases"
-    list in the configuration object after that. Sets the global "retcode" to
+    set to JSON representation of the selected configuration keys after the
+    function call has completed, along with the time and resources spent in
+    it, see get_junit_stdout(). The created test case is appended to the
+    "_testcases" list in the configuration object after that, and the JUnit
+    results written so far are updated with it. Sets the global "retcode" to
     SKT_SUCCESS in case of test success, SKT_FAIL in case of test failure, and
     SKT_ERROR and above in case of infrastructure failure or skt problem (eg.
     Beaker server is unreachable).
@@ -161,11 +245,15 @@ def junit(func):
         # pylint: disable=broad-except
         global retcode
         if cfg.get('junit'):
+            import junit_xml
+
             tstart = time.time()
             testcase = junit_xml.TestCase(func.__name__, classname="skt")
+            metrics = {}
 
             try:
-                func(cfg)
+                with measure(metrics, 'step'):
+                    func(cfg)
             except Exception:
                 logging.error("Unexpected exception caught, probably an "
                               "infrastructure failure or skt bug: %s",
@@ -183,9 +271,10 @@ def junit(func):
                     retcode
                 )
 
-            testcase.stdout = json.dumps(cfg, default=str)
+            testcase.stdout = get_junit_stdout(cfg, metrics['step'])
             testcase.elapsed_sec = time.time() - tstart
             cfg['_testcases'].append(testcase)
+            write_junit(cfg)
         else:
             func(cfg)
     return wrapper
@@ -201,11 +290,13 @@ def cmd_merge(args):
         args:    Command line arguments
     """
     global retcode
-    # Counter merge patch following:
-    # idx[0]: counter of merge-ref option.
-    # idx[1]: counter of patch option.
-    # idx[2]: counter of pw option.
-    idx = [0, 0, 0]
+    # What was merged so far, saved to the state as lists.
+    merged = {
+        'mergerepos': [],
+        'mergeheads': [],
+        'localpatches': [],
+        'patchworks': [],
+    }
 
     # Clone the kernel tree and check out the proper ref.
     ktree = KernelTree(
@@ -220,95 +311,87 @@ def cmd_merge(args):
     bsubject = ktree.get_commit_subject(bhead)
     commitdate = ktree.get_commit_date(bhead)
 
-    # Update the state file with what we know so far.
-    state = {
-        'baserepo': args.get('baserepo'),
-        'basehead': bhead,
-        'basesubject': bsubject,
-        'commitdate': commitdate,
-        'workdir': full_path(args.get('workdir')),
-    }
-    update_state(args['rc'], state)
-
-    # Loop over what we have been asked to merge (if applicable).
-    for thing_to_merge in args.get('merge_queue', []):
-        try:
-            if thing_to_merge[0] == 'merge_ref':
-                mbranch_ref = thing_to_merge[1].split()
-
-                # Update the state file with our merge_ref data.
-                state = {
-                    'mergerepo_%02d' % idx[0]: mbranch_ref[0],
-                    'mergehead_%02d' % idx[0]: bhead
-                }
-                update_state(args['rc'], state)
-
-                # Merge the git ref.
-                (retcode, bhead) = ktree.merge_git_ref(*mbranch_ref)
+    # Write the state once the merge is done, instead of after each merged
+    # item.
+    with state_transaction(args['rc']):
+        # Update the state file with what we know so far.
+        state = {
+            'baserepo': args.get('baserepo'),
+            'basehead': bhead,
+            'basesubject': bsubject,
+            'commitdate': commitdate,
+            'workdir': full_path(args.get('workdir')),
+        }
+        update_state(args['rc'], state)
 
-                if retcode:
-                    return
+        # Loop over what we have been asked to merge (if applicable).
+        for thing_to_merge in args.get('merge_queue', []):
+            try:
+                if thing_to_merge[0] == 'merge_ref':
+                    mbranch_ref = thing_to_merge[1].split()
 
-                # Increment the counter.
-                idx[0] += 1
+                    # Update the state file with our merge_ref data.
+                    merged['mergerepos'].append(mbranch_ref[0])
+                    merged['mergeheads'].append(bhead)
+                    update_state(args['rc'], merged)
 
-            else:
-                # Attempt to merge a local patch.
-                if thing_to_merge[0] == 'patch':
-                    # Get the full path to the patch to merge.
-                    patch = os.path.abspath(thing_to_merge[1])
+                    # Merge the git ref.
+                    (retcode, bhead) = ktree.merge_git_ref(*mbranch_ref)
 
-                    # Update the state file with our local patch data.
-                    state = {'localpatch_%02d' % idx[1]: patch}
-                    update_state(args['rc'], state)
+                    if retcode:
+                        return
 
-                    # Merge the patch.
-                    ktree.merge_patch_file(patch)
+                else:
+                    # Attempt to merge a local patch.
+                    if thing_to_merge[0] == 'patch':
+                        # Get the full path to the patch to merge.
+                        patch = os.path.abspath(thing_to_merge[1])
 
-                    # Increment the counter.
-                    idx[1] += 1
+                        # Update the state file with our local patch data.
+                        merged['localpatches'].append(patch)
+                        update_state(args['rc'], merged)
 
-                # Attempt to merge a patch from patchwork.
-                elif thing_to_merge[0] == 'pw':
-                    patch = thing_to_merge[1]
+                        # Merge the patch.
+                        ktree.merge_patch_file(patch)
 
-                    # Update the state file with our patchwork patch data.
-                    state = {'patchwork_%02d' % idx[2]: patch}
-                    update_state(args['rc'], state)
+                    # Attempt to merge a patch from patchwork.
+                    elif thing_to_merge[0] == 'pw':
+                        patch = thing_to_merge[1]
 
-                    # Merge the patch.
-                    ktree.merge_patchwork_patch(patch)
+                        # Update the state file with our patchwork patch data.
+                        merged['patchworks'].append(patch)
+                        update_state(args['rc'], merged)
 
-                    # Increment the counter.
-                    idx[2] += 1
+                        # Merge the patch.
+                        ktree.merge_patchwork_patch(patch)
 
-        # If the patch application failed, we should set the return code,
-        # log an error, and update our state file.
-        except PatchApplicationError as patch_exc:
-            retcode = SKT_FAIL
-            logging.error(patch_exc)
+            # If the patch application failed, we should set the return code,
+            # log an error, and update our state file.
+            except PatchApplicationError as patch_exc:
+                retcode = SKT_FAIL
+                logging.error(patch_exc)
 
-            # Update the state.
-            state = {'mergelog': ktree.mergelog}
-            update_state(args['rc'], state)
+                # Update the state.
+                state = {'mergelog': ktree.mergelog}
+                update_state(args['rc'], state)
 
-            return
+                return
 
-        # If something else unexpected happened, re-raise the exception.
-        except Exception:
-            (exc, exc_type, trace) = sys.exc_info()
-            raise exc, exc_type, trace
+            # If something else unexpected happened, re-raise the exception.
+            except Exception:
+                (exc, exc_type, trace) = sys.exc_info()
+                raise exc, exc_type, trace
 
-    # Get the SHA and subject of the repo after applying patches.
-    buildhead = ktree.get_commit_hash()
-    buildsubject = ktree.get_commit_subject()
+        # Get the SHA and subject of the repo after applying patches.
+        buildhead = ktree.get_commit_hash()
+        buildsubject = ktree.get_commit_subject()
 
-    # Update the state file with the data about the current repo commit.
-    state = {
-        'buildhead': buildhead,
-        'buildsubject': buildsubject
-    }
-    update_state(args['rc'], state)
+        # Update the state file with the data about the current repo commit.
+        state = {
+            'buildhead': buildhead,
+            'buildsubject': buildsubject
+        }
+        update_state(args['rc'], state)
 
 
 @junit
@@ -331,7 +414,12 @@ def cmd_build(args):
         extra_make_args=args.get('makeopts'),
         enable_debuginfo=args.get('enable_debuginfo'),
         rh_configs_glob=args.get('rh_configs_glob'),
-        localversion=args.get('localversion')
+        localversion=args.get('localversion'),
+        make_jobs=args.get('make_jobs'),
+        jobserver=args.get('jobserver'),
+        package_format=args.get('package_format'),
+        compress_level=args.get('compress_level'),
+        compress_log=args.get('compress_log')
     )
 
     # Clean the kernel source with 'make mrproper' if requested.
@@ -346,21 +434,57 @@ def cmd_build(args):
     state = {
         'kernel_arch': kernel_arch,
         'cross_compiler_prefix': cross_compiler_prefix,
-        'make_opts': make_opts
+        'make_opts': make_opts,
+        'make_jobs': builder.make_jobs,
+        'jobserver': builder.jobserver
     }
     update_state(args['rc'], state)
 
+    # Look up a tarball built from the same inputs before, if requested.
+    cache = None
+    build_key = None
+    cached = None
+    if args.get('artifact_cache'):
+        cache_size = args.get('artifact_cache_size')
+        cache = ArtifactCache(args.get('artifact_cache'),
+                              cache_size * 1024 * 1024 if cache_size else None)
+        try:
+            builder.prepare_config()
+            build_key = builder.get_build_key()
+        except (subprocess.CalledProcessError, IOError) as exc:
+            # Let the build itself fail and report it properly.
+            logging.warning("can't compute the build key: %s", exc)
+
+        if build_key:
+            cached = cache.lookup(build_key)
+            update_state(args['rc'], {'artifact_cache': cache.path})
+
+    # Record the cache entry used, if any. The state can be kept across runs,
+    # so the entry of an earlier build has to be cleared.
+    state = {'artifact_key': build_key or '',
+             'cached_tarpkg': (cached or {}).get('path', ''),
+             'cached_buildurl': (cached or {}).get('buildurl', '')}
+    update_state(args['rc'], state)
+
     # Attempt to compile the kernel.
     try:
-        tgz = builder.mktgz()
+        if cached:
+            logging.info("skipping the build, using cached tarball")
+        else:
+            tgz = builder.mktgz()
     # Handle a failure if the build times out, fails, or if the build
     # artifacts can't be found.
     except (CommandTimeoutError, subprocess.CalledProcessError, ParsingError,
             IOError) as exc:
         logging.error(exc)
 
-        # Update the state file with the path to the build log.
-        state = {'buildlog': builder.buildlog}
+        # Update the state file with the path to the build log and its
+        # index, and the metrics of the failed build, in case anything after
+        # this fails too.
+        args['build_metrics'] = builder.metrics
+        state = {'buildlog': builder.buildlog,
+                 'buildlogindex': builder.buildlogindex,
+                 'build_metrics': builder.metrics}
         update_state(args['rc'], state)
 
         # Set the return code.
@@ -376,17 +500,27 @@ def cmd_build(args):
     if tgz:
         if buildhead:
             # Replace the filename with the SHA of the last commit in the repo.
-            ttgz = "{}.tar.gz".format(buildhead)
+            ttgz = "{}{}".format(buildhead, builder.package_extension)
         else:
             # Add a timestamp to the path if we have no commit to reference.
             ttgz = addtstamp(tgz, tstamp)
 
         # Rename the kernel tarball.
-        shutil.move(tgz, ttgz)
+        with measure(builder.metrics, 'files'):
+            shutil.move(tgz, ttgz)
         logging.info("tarball path: %s", ttgz)
 
-        # Save our tarball path to the state file.
-        state = {'tarpkg': ttgz}
+        # Save our tarball path and format to the state file.
+        state = {'tarpkg': ttgz, 'tarpkg_format': builder.package_format}
+        update_state(args['rc'], state)
+
+        if build_key:
+            with measure(builder.metrics, 'files'):
+                cache.store(build_key, ttgz, krelease=builder.getrelease())
+    elif cached:
+        # Point at the cached tarball, it's kept in place for future builds.
+        state = {'tarpkg': cached['path'],
+                 'tarpkg_format': builder.package_format}
         update_state(args['rc'], state)
 
     # Set a filename for the kernel config file based on the SHA of the last
@@ -395,12 +529,19 @@ def cmd_build(args):
 
     try:
         # Rename the config file and save its location to our state file.
-        shutil.copyfile(builder.get_cfgpath(), tconfig)
+        # Replace it by renaming, it can be published as a hard link.
+        with measure(builder.metrics, 'files'):
+            tmppath = '{}.{}.tmp'.format(tconfig, os.getpid())
+            shutil.copyfile(builder.get_cfgpath(), tmppath)
+            os.rename(tmppath, tconfig)
         state = {'buildconf': tconfig}
         update_state(args['rc'], state)
 
         # Get the kernel version string.
-        krelease = builder.getrelease()
+        if cached and cached.get('krelease'):
+            krelease = cached['krelease']
+        else:
+            krelease = builder.getrelease()
         state = {'krelease': krelease}
         update_state(args['rc'], state)
 
@@ -408,30 +549,81 @@ def cmd_build(args):
         tconfig = ''
         logging.error('No config file to copy found!')
 
+    # Save the time and resources spent in each of the build phases, for the
+    # state file and the JUnit test case.
+    args['build_metrics'] = builder.metrics
+    state = {'build_metrics': builder.metrics}
+    update_state(args['rc'], state)
+
 
 @junit
 def cmd_publish(cfg):
     """
     Publish (copy) the kernel tarball and configuration to the specified
     location, generating their resulting URLs, using the specified "publisher".
-    Only "cp", "scp" and "sftp" publishers are supported at the moment.
+    The "cp", "scp", "sftp" and "http" publishers are supported at the moment.
 
     Args:
         cfg:    A dictionary of skt configuration.
     """
-    publisher = skt.publisher.getpublisher(*cfg.get('publisher'))
+    import skt.publisher
+
+    # Options only some of the publishers support
+    options = {}
+    if cfg.get('multipart_upload'):
+        options['multipart'] = True
+    if cfg.get('no_verify_upload'):
+        options['verify'] = False
+
+    publisher = skt.publisher.getpublisher(
+        *cfg.get('publisher'),
+        content_addressed=cfg.get('content_addressed'),
+        **options
+    )
 
+    # Artifacts to publish, as (state key of the path, state key of the URL)
+    artifacts = []
+    state = {}
     if cfg.get('buildconf'):
-        cfgurl = publisher.publish(cfg.get('buildconf'))
-        save_state(cfg, {'cfgurl': cfgurl})
-
-    if cfg.get('tarpkg'):
-        url = publisher.publish(cfg.get('tarpkg'))
-        logging.info("published tarpkg url: %s", url)
-        save_state(cfg, {'buildurl': url})
+        artifacts.append(('buildconf', 'cfgurl'))
+        # The config is only replaced by renaming, by cmd_build.
+        publisher.immutable.add(cfg.get('buildconf'))
+
+    cached_url = cfg.get('cached_buildurl')
+    baseurl = publisher.baseurl.rstrip('/') + '/'
+    if cached_url and cached_url.startswith(baseurl) \
+            and cfg.get('tarpkg') == cfg.get('cached_tarpkg'):
+        # The cached tarball was published to the same place before.
+        logging.info("tarpkg already published: %s", cached_url)
+        state['buildurl'] = cached_url
+    elif cfg.get('tarpkg'):
+        artifacts.append(('tarpkg', 'buildurl'))
+        # The tarball is never modified after it's moved into place.
+        publisher.immutable.add(cfg.get('tarpkg'))
     else:
         logging.debug('No kernel tarball to publish found!')
 
+    # Publish all artifacts in parallel batches, each e.g. over a single
+    # connection, and save their URLs and checksums at once.
+    sources = [cfg.get(name) for (name, _) in artifacts]
+    urls = []
+    if sources:
+        urls = publisher.publish_many(sources,
+                                      cfg.get('publish_jobs') or PUBLISH_JOBS)
+    for (name, url_key), source, url in zip(artifacts, sources, urls):
+        logging.info("published %s url: %s", name, url)
+        state[url_key] = url
+        if source in publisher.checksums:
+            state['{}_sha256'.format(name)] = publisher.checksums[source]
+    if state:
+        save_state(cfg, state)
+
+    # Remember the URL so later builds with the same inputs can reuse it.
+    if ('tarpkg', 'buildurl') in artifacts and cfg.get('artifact_cache') \
+            and cfg.get('artifact_key'):
+        cache = ArtifactCache(cfg.get('artifact_cache'))
+        cache.update(cfg.get('artifact_key'), buildurl=state['buildurl'])
+
 
 @junit
 def cmd_run(cfg):
@@ -443,6 +635,7 @@ def cmd_run(cfg):
         cfg:    A dictionary of skt configuration.
     """
     global retcode
+    import skt.runner
 
     runner = skt.runner.getrunner(*cfg.get('runner'))
 
@@ -453,47 +646,58 @@ def cmd_run(cfg):
                          cfg.get('max_aborted_count'),
                          cfg.get('krelease'),
                          cfg.get('wait'),
-                         arch=cfg.get("kernel_arch"))
-
-    recipe_set_index = 0
-    for index, job in enumerate(runner.job_to_recipe_set_map.keys()):
-        save_state(cfg, {'jobid_%s' % (index): job})
-        for recipe_set in runner.job_to_recipe_set_map[job]:
-            save_state(cfg,
-                       {'recipesetid_%s' % (recipe_set_index): recipe_set})
-            recipe_set_index += 1
+                         arch=cfg.get("kernel_arch"),
+                         kpkg_format=cfg.get('tarpkg_format') or 'targz')
 
-    cfg['jobs'] = runner.job_to_recipe_set_map.keys()
+    # Save all the jobs and recipe sets at once.
+    recipe_sets = []
+    for job in runner.job_to_recipe_set_map.keys():
+        recipe_sets.extend(runner.job_to_recipe_set_map[job])
 
-    save_state(cfg, {'retcode': retcode})
+    save_state(cfg, {'retcode': retcode,
+                     'jobs': runner.job_to_recipe_set_map.keys(),
+                     'recipe_sets': recipe_sets})
 
 
 def cmd_report(cfg):
     """
     Report build and/or test results using the specified "reporter". Currently
-    results can be reported by e-mail or printed to stdout.
+    results can be reported by e-mail or printed to stdout, or exported in a
+    machine-readable format.
 
     Args:
         cfg:    A dictionary of skt configuration.
     """
-    if not cfg.get("reporter"):
+    report_format = cfg.get('format') or 'text'
+    if report_format == 'text' and not cfg.get("reporter"):
         return
 
-    # Attempt to import the reporter provided by the user
+    # Attempt to import the reporter provided by the user, or the one
+    # exporting the requested format
     try:
         module = importlib.import_module('skt.reporter')
-        class_name = "{}Reporter".format(cfg['reporter']['type'].title())
+        if report_format == 'text':
+            class_name = "{}Reporter".format(
+                cfg['reporter']['type'].title()
+            )
+        else:
+            class_name = "{}Reporter".format(report_format.title())
         reporter_class = getattr(module, class_name)
     except AttributeError:
         sys.exit(
             "Unable to find specified reporter type: {}".format(class_name)
         )
 
+    # Send a separate report for each state file if requested.
+    cfgs = [cfg]
+    if cfg.get('split_results') and cfg.get('result'):
+        cfgs = [dict(cfg, result=[statefile])
+                for statefile in cfg.get('result')]
+
     # FIXME We are passing the entire cfg object to the reporter class but
     # we should be passing the specific options that are needed.
-    # Create a report
-    reporter = reporter_class(cfg)
-    reporter.report()
+    # Create the reports
+    reporter_class.report_many(cfgs)
 
 
 def cmd_console_check(cfg):
@@ -503,6 +707,8 @@ def cmd_console_check(cfg):
     Args:
         cfg: A dictionary of skt configuration.
     """
+    import skt.console
+
     remove_oldresult(cfg.get('output_dir'), 'console_check.')
     console_result_path = join_with_slash(cfg.get('output_dir'),
                                           'console_check.result')
@@ -612,6 +818,17 @@ def setup_parser():
         "--junit",
         help="Directory for storing junit XML results"
     )
+    parser.add_argument(
+        "--junit-key",
+        action="append",
+        type=str,
+        help=(
+            "Configuration or state key to include in the stdout of the "
+            "junit test cases, can be repeated. Defaults to: {}".format(
+                ', '.join(JUNIT_KEYS)
+            )
+        )
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -728,6 +945,59 @@ def setup_parser():
         default="skt",
         help=("String to append to kernel version number (LOCALVERSION)")
     )
+    parser_build.add_argument(
+        "--make-jobs",
+        type=int,
+        help=(
+            "Number of parallel make jobs (default: number of CPUs available "
+            "to the cgroup, reduced by the current load average)"
+        )
+    )
+    parser_build.add_argument(
+        "--jobserver",
+        type=str,
+        help=(
+            "Path to a GNU make jobserver fifo shared by concurrent builds on "
+            "this host, created if it doesn't exist (requires make >= 4.4)"
+        )
+    )
+    parser_build.add_argument(
+        "--package-format",
+        type=str,
+        choices=sorted(PACKAGE_FORMATS),
+        help=(
+            "Format of the kernel tarball (default: targz). Parallel "
+            "compressors (pigz, pbzip2, xz -T0, zstd -T0) are used if "
+            "available."
+        )
+    )
+    parser_build.add_argument(
+        "--compress-level",
+        type=int,
+        help="Compression level of the kernel tarball"
+    )
+    parser_build.add_argument(
+        "--compress-log",
+        action="store_true",
+        default=False,
+        help=(
+            "Write the build log gzip-compressed as it's built, into "
+            "build.log.gz"
+        )
+    )
+    parser_build.add_argument(
+        "--artifact-cache",
+        type=str,
+        help=(
+            "Directory caching kernel tarballs by the hash of their build "
+            "inputs, builds with cached inputs are skipped"
+        )
+    )
+    parser_build.add_argument(
+        "--artifact-cache-size",
+        type=int,
+        help="Maximum size of the artifact cache in MiB (default: unlimited)"
+    )
 
     # These arguments apply to the 'publish' skt command
     parser_publish = subparsers.add_parser("publish", add_help=False)
@@ -743,6 +1013,42 @@ def setup_parser():
         type=str,
         help="Path to tar pkg to publish"
     )
+    parser_publish.add_argument(
+        "--content-addressed",
+        action="store_true",
+        default=False,
+        help=(
+            "Publish artifacts as <sha256>/<basename> and skip uploading "
+            "the ones already present"
+        )
+    )
+    parser_publish.add_argument(
+        "--multipart-upload",
+        action="store_true",
+        default=False,
+        help=(
+            "Upload large artifacts in parts with ranged PUT requests, if "
+            "the store supports them (\"http\" publisher only)"
+        )
+    )
+    parser_publish.add_argument(
+        "--no-verify-upload",
+        action="store_true",
+        default=False,
+        help=(
+            "Don't check the uploaded artifacts on the remote host, saving "
+            "a connection (\"scp\" and \"sftp\" publishers only)"
+        )
+    )
+    parser_publish.add_argument(
+        "--publish-jobs",
+        type=int,
+        default=PUBLISH_JOBS,
+        help=(
+            "Maximum number of artifact uploads running at the same time "
+            "(default: {})".format(PUBLISH_JOBS)
+        )
+    )
 
     # These arguments apply to the 'run' skt command
     parser_run = subparsers.add_parser("run", add_help=False)
@@ -834,11 +1140,28 @@ def setup_parser():
         type=str,
         help='Path to a state file to include in the report'
     )
+    parser_report.add_argument(
+        "--split-results",
+        action="store_true",
+        default=False,
+        help=(
+            "Send a separate report for each --result state file, the mail "
+            "reporter sends them over a single SMTP connection"
+        )
+    )
     parser_report.add_argument(
         "--smtp-url",
         type=str,
         help='Use smtp url instead of localhost to send mail',
     )
+    parser_report.add_argument(
+        "--mail-attach-max",
+        type=int,
+        help=(
+            "Maximum size of a report email attachment in KiB, larger ones "
+            "are published with the configured publisher and linked instead"
+        )
+    )
     parser_report.add_argument(
         "--template",
         dest="template",
@@ -847,6 +1170,25 @@ def setup_parser():
         choices=('full', 'limited'),
         help="Template to use for reports"
     )
+    parser_report.add_argument(
+        "--format",
+        type=str,
+        default='text',
+        choices=('text', 'jsonl', 'sqlite'),
+        help=(
+            "Report format: the text report of the selected reporter, or a "
+            "record per test task as JSON Lines or in an SQLite database"
+        )
+    )
+    parser_report.add_argument(
+        "--output",
+        dest="report_output",
+        type=str,
+        help=(
+            "File to append the jsonl or sqlite records to, jsonl records "
+            "are printed to stdout by default"
+        )
+    )
     parser_report.set_defaults(func=cmd_report)
     parser_report.set_defaults(_name="report")
 
@@ -943,30 +1285,16 @@ def load_config(args):
     """
     # NOTE(mhayden): The shell should do any tilde expansions on the path
     # before the rc path is provided to Python.
-    config_parser = ConfigParser.ConfigParser()
-    config_parser.read(os.path.abspath(args.rc))
+    (config_parser, state) = read_state_file(os.path.abspath(args.rc))
 
     cfg = vars(args)
-    cfg['_parser'] = config_parser
     cfg['_testcases'] = []
 
     # Read 'state' section first so that it is not overwritten by 'config'
     # section values.
-    if cfg.get('state') and config_parser.has_section('state'):
-        for (name, value) in config_parser.items('state'):
+    if cfg.get('state'):
+        for (name, value) in state.items():
             if not cfg.get(name):
-                if name.startswith("jobid_"):
-                    cfg.setdefault("jobs", set()).add(value)
-                if name.startswith('recipesetid_'):
-                    cfg.setdefault("recipe_sets", set()).add(value)
-                elif name.startswith("mergerepo_"):
-                    cfg.setdefault("mergerepos", list()).append(value)
-                elif name.startswith("mergehead_"):
-                    cfg.setdefault("mergeheads", list()).append(value)
-                elif name.startswith("localpatch_"):
-                    cfg.setdefault("localpatches", list()).append(value)
-                elif name.startswith("patchwork_"):
-                    cfg.setdefault("patchworks", list()).append(value)
                 cfg[name] = value
 
     if config_parser.has_section('config'):
@@ -1027,6 +1355,13 @@ def load_config(args):
     if cfg.get('tarpkg'):
         cfg['tarpkg'] = full_path(cfg.get('tarpkg'))
 
+    # Get absolute paths for the artifact cache and the tarball taken from it,
+    # so they match the tarpkg and don't depend on the current directory
+    if cfg.get('artifact_cache'):
+        cfg['artifact_cache'] = full_path(cfg.get('artifact_cache'))
+    if cfg.get('cached_tarpkg'):
+        cfg['cached_tarpkg'] = full_path(cfg.get('cached_tarpkg'))
+
     # Get absolute paths to state files for multireport
     # Handle "result" being None if none are specified
     for idx, statefile_path in enumerate(cfg.get('result') or []):
@@ -1081,6 +1416,10 @@ def check_args(parser, args):
     # Check required arguments for 'report'
     if args._name == 'report':
 
+        # The SQLite database has to be stored somewhere
+        if args.format == 'sqlite' and not args.report_output:
+            parser.error("--format sqlite requires --output to be set")
+
         # MailReporter requires recipient and sender email addresses
         if (args.type == 'mail' and (not args.mail_to or not args.mail_from)):
             parser.error(
@@ -1117,11 +1456,10 @@ def main():
             cfg = load_config(args)
             args.func(cfg)
 
-        if cfg.get('junit'):
-            testsuite = junit_xml.TestSuite("skt", cfg.get('_testcases'))
-            with open("%s/%s.xml" % (cfg.get('junit'), args._name),
-                      'w') as fileh:
-                junit_xml.TestSuite.to_file(fileh, [testsuite])
+        # The JUnit steps write their results themselves, only commands
+        # without any need an (empty) result file here.
+        if cfg.get('junit') and not cfg.get('_testcases'):
+            write_junit(cfg)
 
         sys.exit(retcode)
     except KeyboardInterrupt:
@@ -12,9 +12,13 @@
 # along with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """Class for building kernels"""
+from distutils.spawn import find_executable
+import errno
+import fcntl
 import glob
-import io
+import hashlib
 import logging
+import math
 import multiprocessing
 import os
 import platform
@@ -23,9 +27,84 @@ import shlex
 import shutil
 import subprocess
 import sys
-import time
 
-from skt.misc import join_with_slash
+from skt.artifact_cache import get_build_key
+from skt.buildlog import BuildLogIndex, BuildLogTee, get_index_path
+from skt.misc import join_with_slash, measure
+
+# cgroup files describing the CPU bandwidth limit of the current container,
+# for cgroup v2 and v1 respectively.
+CGROUP2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CGROUP1_CPU_DIRS = ['/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct']
+
+# Kernel tarball package formats: the make target, the tarball extension, the
+# make variable the kernel's buildtar script takes the compressor from, and
+# the compressor commands to use, the preferred (parallel) one first.
+PACKAGE_FORMATS = {
+    'targz': ('targz-pkg', '.tar.gz', 'KGZIP', ['pigz', 'gzip']),
+    'tarbz2': ('tarbz2-pkg', '.tar.bz2', 'KBZIP2', ['pbzip2', 'bzip2']),
+    'tarxz': ('tarxz-pkg', '.tar.xz', 'XZ', ['xz -T0']),
+    'tarzst': ('tarzst-pkg', '.tar.zst', 'ZSTD', ['zstd -T0']),
+}
+
+
+def get_cgroup_cpu_limit():
+    """
+    Get the number of CPUs the current cgroup is allowed to use.
+
+    Returns:
+        The CPU quota rounded up to a whole number of CPUs, or None if no
+        quota is set or the cgroup files can't be read.
+    """
+    try:
+        with open(CGROUP2_CPU_MAX, 'r') as fileh:
+            quota, period = fileh.read().split()[:2]
+        if quota != 'max':
+            return max(1, int(math.ceil(float(quota) / float(period))))
+        return None
+    except (IOError, OSError, ValueError):
+        pass
+
+    for cgroup_dir in CGROUP1_CPU_DIRS:
+        try:
+            with open(join_with_slash(cgroup_dir,
+                                      'cpu.cfs_quota_us')) as fileh:
+                quota = int(fileh.read())
+            with open(join_with_slash(cgroup_dir,
+                                      'cpu.cfs_period_us')) as fileh:
+                period = int(fileh.read())
+        except (IOError, OSError, ValueError):
+            continue
+
+        if quota > 0 and period > 0:
+            return max(1, int(math.ceil(float(quota) / period)))
+
+    return None
+
+
+def get_make_jobs():
+    """
+    Determine how many parallel make jobs the build host can take right now.
+
+    Start with the number of CPUs, limit it by the cgroup CPU quota (as
+    cpu_count() reports host CPUs inside containers), and subtract the load
+    other processes (e.g. concurrent builds) are already putting on the host.
+
+    Returns:
+        Number of make jobs to use, at least 1.
+    """
+    jobs = multiprocessing.cpu_count()
+
+    cgroup_limit = get_cgroup_cpu_limit()
+    if cgroup_limit is not None:
+        jobs = min(jobs, cgroup_limit)
+
+    try:
+        load = os.getloadavg()[0]
+    except OSError:
+        load = 0
+
+    return max(1, jobs - int(load))
 
 
 class KernelBuilder(object):
@@ -36,12 +115,19 @@ class KernelBuilder(object):
     # pylint: disable=too-many-instance-attributes,too-many-arguments
     def __init__(self, source_dir, basecfg, cfgtype=None,
                  extra_make_args=None, enable_debuginfo=False,
-                 rh_configs_glob=None, localversion=None):
+                 rh_configs_glob=None, localversion=None, make_jobs=None,
+                 jobserver=None, package_format=None, compress_level=None,
+                 compress_log=False):
         self.source_dir = source_dir
         self.basecfg = basecfg
         self.cfgtype = cfgtype if cfgtype is not None else "olddefconfig"
         self._ready = 0
-        self.buildlog = join_with_slash(self.source_dir, "build.log")
+        # Write the build log compressed as it's built, see GzipLogWriter.
+        self.compress_log = compress_log
+        self.buildlog = join_with_slash(
+            self.source_dir, "build.log.gz" if compress_log else "build.log"
+        )
+        self.buildlogindex = get_index_path(self.buildlog)
         self.make_argv_base = [
             "make", "-C", self.source_dir
         ]
@@ -50,12 +136,35 @@ class KernelBuilder(object):
         self.cross_compiler_prefix = self.__get_cross_compiler_prefix()
         self.rh_configs_glob = rh_configs_glob
         self.localversion = localversion
-
-        self.targz_pkg_argv = [
+        self.make_jobs = make_jobs if make_jobs else get_make_jobs()
+        self.jobserver = jobserver
+        # File descriptor keeping the jobserver fifo (and its tokens) alive
+        # while we are building.
+        self._jobserver_fd = None
+        # Index of the build log of the last build by mktgz(), and its line
+        # matchers keyed by name: 'tarball', 'error', 'warning' and
+        # 'make_error'.
+        self.log_index = None
+        self.log_matchers = {}
+        # Time and resources used by the build phases, see misc.measure()
+        self.metrics = {}
+        # Kernel release of the tree, cached by getrelease() and mktgz()
+        self._krelease = None
+
+        self.package_format = package_format or 'targz'
+        (package_target, self.package_extension, compressor_var,
+         compressors) = PACKAGE_FORMATS[self.package_format]
+        self.compressor = self.__get_compressor(compressors, compress_level)
+
+        self.package_argv = [
             "INSTALL_MOD_STRIP=1",
-            "-j%d" % multiprocessing.cpu_count(),
-            "targz-pkg"
+            "{}={}".format(compressor_var, self.compressor)
         ]
+        if not self.jobserver:
+            # With a jobserver, the parallelism comes from the shared fifo
+            # passed via MAKEFLAGS instead.
+            self.package_argv.append("-j%d" % self.make_jobs)
+        self.package_argv.append(package_target)
 
         # Split the extra make arguments provided by the user
         if extra_make_args:
@@ -65,6 +174,34 @@ class KernelBuilder(object):
 
         logging.info("basecfg: %s", self.basecfg)
         logging.info("cfgtype: %s", self.cfgtype)
+        logging.info("make jobs: %d", self.make_jobs)
+        logging.info("package format: %s (compressor: %s)",
+                     self.package_format, self.compressor)
+
+    @classmethod
+    def __get_compressor(cls, compressors, compress_level=None):
+        """
+        Choose the first available compressor command.
+
+        Args:
+            compressors:    A list of compressor commands, in order of
+                            preference.
+            compress_level: Compression level to pass to the compressor, or
+                            None to use the compressor's default.
+
+        Returns:
+            The compressor command line, as a string.
+        """
+        compressor = compressors[-1]
+        for command in compressors:
+            if find_executable(command.split()[0]):
+                compressor = command
+                break
+
+        if compress_level is not None:
+            compressor += " -{}".format(compress_level)
+
+        return compressor
 
     def __adjust_config_option(self, action, *options):
         """Adjust a kernel config option using kernel scripts."""
@@ -81,7 +218,8 @@ class KernelBuilder(object):
         # pylint: disable=no-self-use
         args = self.make_argv_base + ["mrproper"]
         logging.info("cleaning up tree: %s", args)
-        subprocess.check_call(args)
+        with measure(self.metrics, 'clean'):
+            subprocess.check_call(args)
 
     @classmethod
     def __glob_escape(cls, pathname):
@@ -184,6 +322,73 @@ class KernelBuilder(object):
 
         return None
 
+    def prepare_config(self, stdout=None, stderr=None):
+        """
+        Prepare the kernel config for the build. mktgz() does this itself if
+        it wasn't done before.
+
+        Args:
+            stdout: Where to redirect the output of the config commands.
+            stderr: Where to redirect the error output of the config commands.
+        """
+        with measure(self.metrics, 'config'):
+            self.__prepare_kernel_config(stdout=stdout, stderr=stderr)
+
+    def __get_toolchain_version(self):
+        """
+        Get the version of the compiler used for the build.
+
+        Returns:
+            The first line of 'gcc --version' output, or None if the compiler
+            can't be run.
+        """
+        compiler = '{}gcc'.format(self.cross_compiler_prefix or '')
+        try:
+            output = subprocess.check_output([compiler, '--version'])
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+        return output.split('\n')[0]
+
+    def get_build_key(self):
+        """
+        Get the key identifying the build inputs, for caching build artifacts.
+        The key covers the source tree content, the kernel config, the
+        architecture, the compiler version, and the make options except the
+        number of jobs. The config has to be prepared already.
+
+        Returns:
+            The build key, or None if it can't be determined, e.g. because the
+            source is not a clean git tree.
+        """
+        git_args = ['git', '-C', self.source_dir]
+        try:
+            tree = subprocess.check_output(
+                git_args + ['rev-parse', 'HEAD^{tree}']
+            ).strip()
+            changes = subprocess.check_output(
+                git_args + ['status', '--porcelain', '--untracked-files=no']
+            ).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+        if changes:
+            logging.info("source tree has uncommitted changes, not caching")
+            return None
+
+        toolchain = self.__get_toolchain_version()
+        if toolchain is None:
+            return None
+
+        with open(self.get_cfgpath(), 'rb') as fileh:
+            config_hash = hashlib.sha256(fileh.read()).hexdigest()
+
+        make_opts = [opt for opt in self.package_argv + self.extra_make_args
+                     if not opt.startswith('-j')]
+
+        return get_build_key(tree, config_hash, self.build_arch, toolchain,
+                             ' '.join(make_opts))
+
     def get_cfgpath(self):
         """
         Get path to kernel .config file.
@@ -193,20 +398,141 @@ class KernelBuilder(object):
         """
         return join_with_slash(self.source_dir, ".config")
 
+    def __lock_jobserver(self):
+        """
+        Open and exclusively lock the file listing the PIDs of the builds
+        using the jobserver, "<fifo>.members". Closing the returned file
+        descriptor releases the lock.
+
+        Returns:
+            A tuple of the file descriptor and a list of the PIDs of the
+            builds using the jobserver which are still running.
+        """
+        lock_fd = os.open(self.jobserver + '.members',
+                          os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+
+        members = []
+        for pid in os.read(lock_fd, 1024 * 1024).split():
+            try:
+                os.kill(int(pid), 0)
+            except OSError as exc:
+                # Skip the builds which died without leaving.
+                if exc.errno == errno.ESRCH:
+                    continue
+            members.append(int(pid))
+
+        return (lock_fd, members)
+
+    @staticmethod
+    def __write_jobserver_members(lock_fd, members):
+        """
+        Replace the PIDs in a locked jobserver member file.
+
+        Args:
+            lock_fd:    The file descriptor, see __lock_jobserver().
+            members:    A list of the PIDs of the builds using the jobserver.
+        """
+        os.lseek(lock_fd, 0, os.SEEK_SET)
+        os.ftruncate(lock_fd, 0)
+        os.write(lock_fd, ''.join('{}\n'.format(pid) for pid in members))
+
+    def __join_jobserver(self):
+        """
+        Join the GNU make jobserver shared by the builds on this host. Create
+        the fifo if it doesn't exist yet. If no other build is using it, fill
+        it with make_jobs - 1 tokens (every make holds one implicit token).
+
+        Returns:
+            Environment for the make process, with MAKEFLAGS pointing make to
+            the jobserver fifo.
+        """
+        try:
+            os.mkfifo(self.jobserver, 0o600)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+        (lock_fd, members) = self.__lock_jobserver()
+        try:
+            # Opening the fifo read-write doesn't block and keeps the tokens
+            # in the pipe around even if no make is currently attached. Once
+            # the last build closes it, the tokens are gone, so the first
+            # build to join again has to put them back.
+            self._jobserver_fd = os.open(self.jobserver,
+                                         os.O_RDWR | os.O_NONBLOCK)
+            if not members:
+                logging.info("filling jobserver %s with %d jobs",
+                             self.jobserver, self.make_jobs)
+                os.write(self._jobserver_fd, b'+' * (self.make_jobs - 1))
+            else:
+                logging.info("joining jobserver %s", self.jobserver)
+
+            self.__write_jobserver_members(lock_fd,
+                                           members + [os.getpid()])
+        finally:
+            os.close(lock_fd)
+
+        environ = os.environ.copy()
+        environ['MAKEFLAGS'] = '{} -j{} --jobserver-auth=fifo:{}'.format(
+            environ.get('MAKEFLAGS', ''), self.make_jobs, self.jobserver
+        ).strip()
+        return environ
+
+    def __leave_jobserver(self):
+        """
+        Close our file descriptor of the jobserver fifo and remove this build
+        from its members.
+        """
+        if self._jobserver_fd is None:
+            return
+
+        # Close the fifo under the lock, so a build joining at the same time
+        # doesn't fill it while our tokens are still in the pipe.
+        (lock_fd, members) = self.__lock_jobserver()
+        try:
+            os.close(self._jobserver_fd)
+            self._jobserver_fd = None
+            if os.getpid() in members:
+                members.remove(os.getpid())
+            self.__write_jobserver_members(lock_fd, members)
+        finally:
+            os.close(lock_fd)
+
+    def __read_release_file(self):
+        """
+        Read the kernel release generated by the build.
+
+        Returns:
+            The kernel release, or None if the file doesn't exist.
+        """
+        try:
+            with open(join_with_slash(self.source_dir, 'include', 'config',
+                                      'kernel.release'), 'r') as fileh:
+                return fileh.read().strip() or None
+        except IOError:
+            return None
+
     def getrelease(self):
         """
-        Get kernel release.
+        Get kernel release. The release is cached, so only the first call
+        runs 'make kernelrelease', unless mktgz() already got the release
+        from the built tree.
 
         Returns:
              kernel release like '4.17.0-rc6+'.
         """
+        if self._krelease:
+            return self._krelease
+
         krelease = None
-        if not self._ready:
-            self.__prepare_kernel_config()
+        with measure(self.metrics, 'release'):
+            if not self._ready:
+                self.__prepare_kernel_config()
 
-        args = self.make_argv_base + ["kernelrelease"]
-        make = subprocess.Popen(args, stdout=subprocess.PIPE)
-        (stdout, _) = make.communicate()
+            args = self.make_argv_base + ["kernelrelease"]
+            make = subprocess.Popen(args, stdout=subprocess.PIPE)
+            (stdout, _) = make.communicate()
         for line in stdout.split("\n"):
             match = re.match(r'^\d+\.\d+\.\d+.*$', line)
             if match:
@@ -216,51 +542,45 @@ class KernelBuilder(object):
         if krelease is None:
             raise Exception("Failed to find kernel release in stdout")
 
+        self._krelease = krelease
         return krelease
 
     def assemble_make_options(self):
         """Assemble all of the make options into a list."""
         kernel_build_argv = (
             self.make_argv_base
-            + self.targz_pkg_argv
+            + self.package_argv
             + self.extra_make_args
         )
         return kernel_build_argv
 
     def find_tarball(self):
         """
-        Find a tarball in the buildlog.
+        Get the tarball reported in the buildlog by the last build.
 
         Returns:
             The full path to the tarball (as a string), or None if the tarball
             line was not found in the log.
         """
-        # Compile a regex to look for the tarball filename.
-        tgz_regex = re.compile("^Tarball successfully created in (.*)$")
+        matcher = self.log_matchers.get('tarball')
+        match = matcher.first() if matcher else None
+        if not match:
+            return None
 
-        # Read the buildlog line by line looking for the tarball.
-        fpath = None
-        with open(self.buildlog, 'r') as fileh:
-            for log_line in fileh:
-                match = tgz_regex.search(log_line)
-
-                # If we find a match, store the path to the tarball and stop
-                # reading the buildlog.
-                if match:
-                    fpath = os.path.realpath(
-                        join_with_slash(
-                            self.source_dir,
-                            match.group(1)
-                        )
-                    )
-                    break
-
-        return fpath
+        return os.path.realpath(
+            join_with_slash(self.source_dir, match.group('path'))
+        )
 
     def mktgz(self, timeout=60 * 60 * 12):
         """
         Build kernel and modules, after that, pack everything into a tarball.
 
+        The build output is streamed into the buildlog and to stdout, and
+        indexed on the way, see log_index. The index is written next to the
+        buildlog, into buildlogindex, even if the build fails. With
+        compress_log, the buildlog is written compressed, and the index
+        includes the offsets of its gzip members.
+
         Args:
             timeout:    Max time in seconds will wait for build.
         Returns:
@@ -274,48 +594,65 @@ class KernelBuilder(object):
             IOError:             When tarball file doesn't exist.
         """
         fpath = None
-
-        with io.open(self.buildlog, 'wb') as writer, \
-                io.open(self.buildlog, 'rb') as reader:
-            self.__prepare_kernel_config(stdout=writer,
-                                         stderr=subprocess.STDOUT)
-            # Get the kernel build options.
-            kernel_build_argv = self.assemble_make_options()
-            logging.info("building kernel: %s", kernel_build_argv)
-
-            # Prepend a timeout to the make options.
-            kernel_build_argv = (
-                ['timeout', str(timeout)]
-                + kernel_build_argv
-            )
-
-            # Compile the kernel.
-            make = subprocess.Popen(kernel_build_argv,
-                                    stdout=writer,
-                                    stderr=subprocess.STDOUT)
-
-            # Watch for output and append it to the log and to stdout.
-            while make.poll() is None:
-                self.log2stdout(reader.readlines())
-                time.sleep(1)
-            self.log2stdout(reader.readlines())
-
-            # The timeout command exits with 124 if a timeout occurred.
-            if make.returncode == 124:
-                raise CommandTimeoutError(
-                    "'{}' was taking too long".format(
-                        ' '.join(kernel_build_argv)
-                    )
+        self.log_index = BuildLogIndex()
+        self.log_matchers = self.log_index.matchers
+
+        tee = BuildLogTee(self.buildlog, [self.log_index],
+                          compress=self.compress_log)
+        try:
+            with tee:
+                if not self._ready:
+                    self.prepare_config(stdout=tee.fileno(),
+                                        stderr=subprocess.STDOUT)
+                # Get the kernel build options.
+                kernel_build_argv = self.assemble_make_options()
+                logging.info("building kernel: %s", kernel_build_argv)
+
+                # Prepend a timeout to the make options.
+                kernel_build_argv = (
+                    ['timeout', str(timeout)]
+                    + kernel_build_argv
                 )
 
-            # The build failed for a reason other than a timeout.
-            if make.returncode != 0:
-                raise subprocess.CalledProcessError(
-                    make.returncode,
+                environ = None
+                if self.jobserver:
+                    environ = self.__join_jobserver()
+
+                # Compile the kernel, the tee appends the output to the log
+                # and to stdout as it comes.
+                try:
+                    with measure(self.metrics, 'build'):
+                        make = subprocess.Popen(kernel_build_argv,
+                                                stdout=tee.fileno(),
+                                                stderr=subprocess.STDOUT,
+                                                env=environ)
+                        make.wait()
+                finally:
+                    self.__leave_jobserver()
+        finally:
+            self.log_index.members = tee.members
+            self.log_index.write(self.buildlogindex)
+
+        # make generates the kernel release file early in the build, cache the
+        # release so we don't need to run make again to get it.
+        self._krelease = self.__read_release_file()
+
+        # The timeout command exits with 124 if a timeout occurred.
+        if make.returncode == 124:
+            raise CommandTimeoutError(
+                "'{}' was taking too long".format(
                     ' '.join(kernel_build_argv)
                 )
+            )
 
-        # Search the build log for a tarball file.
+        # The build failed for a reason other than a timeout.
+        if make.returncode != 0:
+            raise subprocess.CalledProcessError(
+                make.returncode,
+                ' '.join(kernel_build_argv)
+            )
+
+        # Get the tarball file found in the build log.
         fpath = self.find_tarball()
 
         # Raise an exception if we did not find a tarball.
@@ -329,17 +666,6 @@ class KernelBuilder(object):
 
         return fpath
 
-    @staticmethod
-    def log2stdout(lines):
-        """
-        Show `lines` on stdout.
-
-        Args:
-            lines:      list of strings.
-        """
-        sys.stdout.write(''.join(lines))
-        sys.stdout.flush()
-
 
 class CommandTimeoutError(Exception):
     """
@@ -12,12 +12,10 @@
 # along with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """Functions and constants used by multiple parts of skt."""
-from email.errors import HeaderParseError
-import email.header
-import email.parser
+import contextlib
 import re
-
-import requests
+import resource
+import time
 
 
 # SKT Result
@@ -46,6 +44,48 @@ def join_with_slash(base, *suffix_tuple):
     return '/'.join(parts) + ending
 
 
+@contextlib.contextmanager
+def measure(metrics, phase):
+    """
+    Measure the wall clock time of a phase, and the resources used by the
+    child processes which finished during it. Add the measurements to
+    metrics[phase], a dictionary with the following keys:
+
+    'wall'      - wall clock time, seconds
+    'cpu_user'  - user CPU time of the children, seconds
+    'cpu_sys'   - system CPU time of the children, seconds
+    'maxrss'    - peak resident set size of the largest child process of skt
+                  so far, KiB. This is a high-water mark for the whole skt
+                  process, not specific to the phase: a phase reports the
+                  peak of an earlier phase unless its own children grew
+                  larger.
+    'inblock'   - number of blocks read by the children from the filesystem
+    'oublock'   - number of blocks written by the children to the filesystem
+
+    Args:
+        metrics:    A dictionary to store the measurements of each phase in.
+        phase:      Name of the phase.
+    """
+    tstart = time.time()
+    ustart = resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+        yield
+    finally:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        result = metrics.setdefault(phase, {'wall': 0.0,
+                                            'cpu_user': 0.0,
+                                            'cpu_sys': 0.0,
+                                            'maxrss': 0,
+                                            'inblock': 0,
+                                            'oublock': 0})
+        result['wall'] += time.time() - tstart
+        result['cpu_user'] += usage.ru_utime - ustart.ru_utime
+        result['cpu_sys'] += usage.ru_stime - ustart.ru_stime
+        result['maxrss'] = max(result['maxrss'], usage.ru_maxrss)
+        result['inblock'] += usage.ru_inblock - ustart.ru_inblock
+        result['oublock'] += usage.ru_oublock - ustart.ru_oublock
+
+
 def get_patch_name(content):
     """
     Retrieve patch name from 'Subject' header from the mbox string
@@ -58,6 +98,11 @@ def get_patch_name(content):
         Name of the patch. <SUBJECT MISSING> is returned if no subject is
         found, and <SUBJECT ENCODING INVALID> if header decoding fails.
     """
+    # The email package takes a while to import, and only reports need it.
+    from email.errors import HeaderParseError
+    import email.header
+    import email.parser
+
     headers = email.parser.Parser().parsestr(content, True)
     subject = headers['Subject']
     if not subject:
@@ -92,6 +137,9 @@ def get_patch_mbox(url):
         Exception in case the URL is currently unavailable or invalid
     """
     # pylint: disable=no-member
+    # requests takes a while to import, and only a few commands need it.
+    import requests
+
     mbox_url = join_with_slash(url, 'mbox')
 
     try:
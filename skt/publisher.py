@@ -12,15 +12,184 @@
 # along with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """Class for managing Publisher."""
+import errno
+import fcntl
+import hashlib
+import inspect
+import io
+import json
 import logging
 import os
-import shutil
+import pipes
 import subprocess
+import threading
 
 from abc import ABCMeta, abstractmethod
+from multiprocessing.pool import ThreadPool
+
+import requests
 
 from skt.misc import join_with_slash
 
+# Size of the chunks files are streamed and hashed in
+CHUNK_SIZE = 1024 * 1024
+# The FICLONE ioctl request, cloning a file's data on copy-on-write
+# filesystems (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+
+def hash_file(path):
+    """
+    Compute the SHA-256 checksum of a file, reading it in chunks.
+
+    Args:
+        path:   Path to the file.
+
+    Returns:
+        The checksum as a hex string.
+    """
+    sha = hashlib.sha256()
+    with io.open(path, 'rb') as fileh:
+        for chunk in iter(lambda: fileh.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def makedirs(path):
+    """
+    Create a directory with its parents, if it doesn't exist.
+
+    Args:
+        path:   Path to the directory.
+    """
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def get_remote_path(basedir, path):
+    """
+    Get the path of a file on a remote host.
+
+    Args:
+        basedir:    The base directory on the host, empty for the home
+                    directory.
+        path:       The path relative to the base directory.
+
+    Returns:
+        The remote path.
+    """
+    return join_with_slash(basedir, path) if basedir else path
+
+
+def get_temp_path(destination):
+    """
+    Get a temporary path to write a file at before renaming it to its
+    destination, so the destination is never left incomplete or missing.
+
+    Args:
+        destination:    Path to the file.
+
+    Returns:
+        The temporary path, next to the destination.
+    """
+    return '{}.{}.tmp'.format(destination, os.getpid())
+
+
+def remove_file(path):
+    """
+    Remove a file if it exists.
+
+    Args:
+        path:   Path to the file.
+    """
+    try:
+        os.unlink(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def clone_file(source, destination, hardlink=False):
+    """
+    Make the destination share the data of the source file, without copying
+    it. A hard link is tried first if allowed, then a reflink (FICLONE),
+    which needs both files on the same filesystem supporting it, e.g. XFS or
+    Btrfs. An existing destination file is replaced atomically, and left
+    alone if it already is the source file.
+
+    Args:
+        source:         Path to the file to clone.
+        destination:    Path to the clone.
+        hardlink:       True if the destination can be a hard link to the
+                        source. Only use it for files which are never
+                        modified in place, as the destination would change
+                        with them.
+
+    Returns:
+        The method used: "link" or "reflink", or "copy" if the file has to
+        be copied instead, see copy_file().
+    """
+    if os.path.exists(destination) and \
+            os.path.samefile(source, destination):
+        return 'link'
+
+    tmppath = get_temp_path(destination)
+    try:
+        if hardlink:
+            try:
+                os.link(source, tmppath)
+                os.rename(tmppath, destination)
+                return 'link'
+            except OSError:
+                remove_file(tmppath)
+
+        with io.open(source, 'rb') as src, io.open(tmppath, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except IOError:
+                return 'copy'
+        os.rename(tmppath, destination)
+        return 'reflink'
+    finally:
+        remove_file(tmppath)
+
+
+def copy_file(source, destination):
+    """
+    Copy a file in chunks, computing its SHA-256 checksum on the way, and
+    verify the copy is complete. The copy is written next to the destination
+    and renamed over it when complete.
+
+    Args:
+        source:         Path to the file to copy.
+        destination:    Path to the copy.
+
+    Returns:
+        The checksum of the copied data as a hex string.
+
+    Raises:
+        IOError if the copy doesn't have the size of the source.
+    """
+    sha = hashlib.sha256()
+    tmppath = get_temp_path(destination)
+    try:
+        with io.open(source, 'rb') as src, io.open(tmppath, 'wb') as dst:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                sha.update(chunk)
+                dst.write(chunk)
+
+        if os.path.getsize(tmppath) != os.path.getsize(source):
+            raise IOError(
+                "incomplete copy of {} to {}".format(source, destination)
+            )
+        os.rename(tmppath, destination)
+    finally:
+        remove_file(tmppath)
+    return sha.hexdigest()
+
 
 class Publisher(object):
     """An abstract result publisher."""
@@ -28,17 +197,26 @@ class Publisher(object):
 
     TYPE = 'default'
 
-    def __init__(self, dest, url):
+    def __init__(self, dest, url, content_addressed=False):
         """
         Initialize an abstract result publisher.
 
         Args:
-            dest:   Type-specific destination string.
-            url:    Base URL prefix of the published result,
-                    without '/' on the end.
+            dest:               Type-specific destination string.
+            url:                Base URL prefix of the published result,
+                                without '/' on the end.
+            content_addressed:  True if files should be published under their
+                                checksum, as "<sha256>/<basename>", and not
+                                uploaded again if already present.
         """
         self.destination = dest
         self.baseurl = url
+        self.content_addressed = content_addressed
+        # Source file path -> SHA-256 checksum of the published data
+        self.checksums = {}
+        # Paths of the source files which are never modified in place, e.g.
+        # only replaced by renaming, so they can be published as hard links
+        self.immutable = set()
 
         logging.info("publisher type: %s", self.TYPE)
         logging.info("publisher destination: %s", self.destination)
@@ -53,7 +231,24 @@ class Publisher(object):
         Returns:
             Published URL corresponding to the specified source.
         """
-        return join_with_slash(self.baseurl, os.path.basename(source))
+        return join_with_slash(self.baseurl, self.getpath(source))
+
+    def getpath(self, source):
+        """
+        Get the path of a published file, relative to the destination. In
+        the content-addressed mode, the checksum of the file has to be
+        computed already.
+
+        Args:
+            source: Source file path.
+
+        Returns:
+            The relative path of the published file.
+        """
+        if self.content_addressed:
+            return join_with_slash(self.checksums[source],
+                                   os.path.basename(source))
+        return os.path.basename(source)
 
     @abstractmethod
     def publish(self, source):
@@ -69,11 +264,75 @@ class Publisher(object):
         """
         pass
 
+    def publish_batch(self, sources):
+        """
+        Publish several files one after another. Override this method if the
+        files can be published more efficiently together, e.g. over a single
+        connection.
+
+        Args:
+            sources:    A list of source file paths.
+
+        Returns:
+            A list of published URLs corresponding to the sources.
+        """
+        return [self.publish(source) for source in sources]
+
+    def publish_many(self, sources, jobs=1):
+        """
+        Publish several files, split into batches published in parallel. The
+        checksums of the published files are stored in the "checksums"
+        member.
+
+        Args:
+            sources:    A list of source file paths.
+            jobs:       Maximum number of batches published at the same time.
+
+        Returns:
+            A list of published URLs corresponding to the sources.
+        """
+        jobs = max(1, min(jobs, len(sources)))
+        if jobs == 1:
+            return self.publish_batch(sources)
+
+        # Distribute the files round-robin, so large and small ones mix.
+        batches = [sources[index::jobs] for index in range(jobs)]
+        pool = ThreadPool(jobs)
+        try:
+            results = pool.map(self.publish_batch, batches)
+        finally:
+            pool.close()
+            pool.join()
+
+        urls = [None] * len(sources)
+        for index, batch_urls in enumerate(results):
+            urls[index::jobs] = batch_urls
+        return urls
+
 
 class CpPublisher(Publisher):
-    """A copy publisher that copies source to destination."""
+    """
+    A copy publisher that copies source to destination. Immutable files are
+    hard-linked, and the others reflinked, instead of copied if the
+    destination filesystem allows it.
+    """
     TYPE = 'cp'
 
+    def __init__(self, dest, url, content_addressed=False):
+        """
+        Initialize a copy publisher.
+
+        Args:
+            dest:               Destination directory.
+            url:                Base URL prefix of the published result,
+                                without '/' on the end.
+            content_addressed:  True if files should be published under their
+                                checksum, see Publisher.
+        """
+        super(CpPublisher, self).__init__(dest, url, content_addressed)
+        # Source file path -> method used to publish it, see clone_file()
+        self.methods = {}
+
     def publish(self, source):
         """
         Copy the source file to public destination.
@@ -84,8 +343,28 @@ class CpPublisher(Publisher):
         Returns:
             Published URL corresponding to the specified source.
         """
-        destination = join_with_slash(self.destination, "")
-        shutil.copy(source, destination)
+        if self.content_addressed:
+            self.checksums[source] = hash_file(source)
+            destination = join_with_slash(self.destination,
+                                          self.getpath(source))
+            if os.path.exists(destination):
+                self.methods[source] = 'present'
+                logging.info("%s is already published", source)
+                return self.geturl(source)
+            makedirs(os.path.dirname(destination))
+        else:
+            destination = join_with_slash(self.destination,
+                                          os.path.basename(source))
+
+        method = clone_file(source, destination,
+                            hardlink=source in self.immutable)
+        if method == 'copy':
+            self.checksums[source] = copy_file(source, destination)
+        elif source not in self.checksums:
+            # A link or a clone has the content of the source.
+            self.checksums[source] = hash_file(source)
+        self.methods[source] = method
+        logging.info("published %s using %s", source, method)
         return self.geturl(source)
 
 
@@ -93,6 +372,23 @@ class ScpPublisher(Publisher):
     """A SCP publisher that copies source to (remote) destination."""
     TYPE = 'scp'
 
+    def __init__(self, dest, url, content_addressed=False, verify=True):
+        """
+        Initialize a SCP publisher.
+
+        Args:
+            dest:               Destination, as "host:directory".
+            url:                Base URL prefix of the published result,
+                                without '/' on the end.
+            content_addressed:  True if files should be published under their
+                                checksum, see Publisher.
+            verify:             True if the checksums of the uploaded files
+                                should be checked on the remote host. It
+                                takes an extra ssh connection per batch.
+        """
+        super(ScpPublisher, self).__init__(dest, url, content_addressed)
+        self.verify = verify
+
     def publish(self, source):
         """
         Copy the source file to public destination.
@@ -103,15 +399,111 @@ class ScpPublisher(Publisher):
         Returns:
             Published URL corresponding to the specified source.
         """
-        destination = join_with_slash(self.destination, "")
-        subprocess.check_call(["scp", source, destination])
-        return self.geturl(source)
+        return self.publish_batch([source])[0]
+
+    def publish_batch(self, sources):
+        """
+        Copy the source files to public destination with a single scp
+        connection.
+
+        Args:
+            sources:    A list of source file paths.
+
+        Returns:
+            A list of published URLs corresponding to the sources.
+
+        Raises:
+            IOError if the checksum of an uploaded file doesn't match.
+        """
+        for source in sources:
+            self.checksums[source] = hash_file(source)
+
+        (host, _, basedir) = self.destination.partition(':')
+        if not self.content_addressed:
+            destination = join_with_slash(self.destination, "")
+            subprocess.check_call(["scp"] + list(sources) + [destination])
+            self.__verify(host, {
+                source: get_remote_path(basedir, os.path.basename(source))
+                for source in sources
+            })
+            return [self.geturl(source) for source in sources]
+
+        # Check which files are present and create the directories of the
+        # missing ones, with a single ssh connection.
+        paths = {source: get_remote_path(basedir, self.getpath(source))
+                 for source in sources}
+        script = 'for path in {}; do test -e "$path" && echo "$path"; ' \
+            'mkdir -p "$(dirname "$path")"; done'.format(
+                ' '.join(pipes.quote(path) for path in paths.values())
+            )
+        present = subprocess.check_output(['ssh', host, script]).splitlines()
+
+        uploaded = {}
+        for source in sources:
+            if paths[source] in present:
+                logging.info("%s is already published", source)
+                continue
+            subprocess.check_call(
+                ["scp", source, '{}:{}'.format(host, paths[source])]
+            )
+            uploaded[source] = paths[source]
+        self.__verify(host, uploaded)
+        return [self.geturl(source) for source in sources]
+
+    def __verify(self, host, paths):
+        """
+        Check the checksums of the uploaded files on the remote host, with a
+        single ssh connection, if verification is enabled.
+
+        Args:
+            host:   The remote host.
+            paths:  A dictionary of the source file paths and the remote
+                    paths they were uploaded to.
+
+        Raises:
+            IOError if the checksum of an uploaded file doesn't match.
+        """
+        if not paths or not self.verify:
+            return
+
+        output = subprocess.check_output(
+            ['ssh', host, 'sha256sum -- {}'.format(
+                ' '.join(pipes.quote(path)
+                         for path in sorted(paths.values()))
+            )]
+        )
+        remote = {}
+        for line in output.splitlines():
+            (checksum, _, path) = line.partition('  ')
+            remote[path] = checksum
+
+        for (source, path) in paths.items():
+            if remote.get(path) != self.checksums[source]:
+                raise IOError("checksum mismatch of {} uploaded to {}:{}"
+                              .format(source, host, path))
 
 
 class SftpPublisher(Publisher):
     """A sftp publisher that copies source to (remote) destination."""
     TYPE = 'sftp'
 
+    def __init__(self, dest, url, content_addressed=False, verify=True):
+        """
+        Initialize a sftp publisher.
+
+        Args:
+            dest:               Destination, as "host:directory".
+            url:                Base URL prefix of the published result,
+                                without '/' on the end.
+            content_addressed:  True if files should be published under their
+                                checksum, see Publisher.
+            verify:             True if the sizes of the uploaded files
+                                should be checked on the remote host. It
+                                takes an extra sftp session per batch.
+        """
+        super(SftpPublisher, self).__init__(dest, url, content_addressed)
+        self.verify = verify
+
     def publish(self, source):
         """
         Copy the source file to public destination.
@@ -122,29 +514,332 @@ class SftpPublisher(Publisher):
         Returns:
             Published URL corresponding to the specified source.
         """
-        proc = subprocess.Popen(['sftp', self.destination],
-                                stdin=subprocess.PIPE)
-        proc.stdin.write("put -r %s\n" % source)
-        proc.stdin.close()
-        proc.wait()
+        return self.publish_batch([source])[0]
+
+    def publish_batch(self, sources):
+        """
+        Copy the source files to public destination with a single sftp
+        session. The session aborts on the first failed transfer.
+
+        Args:
+            sources:    A list of source file paths.
+
+        Returns:
+            A list of published URLs corresponding to the sources.
+
+        Raises:
+            subprocess.CalledProcessError if any of the transfers failed.
+            IOError if the size of an uploaded file doesn't match.
+        """
+        for source in sources:
+            self.checksums[source] = hash_file(source)
+
+        if not self.content_addressed:
+            batch = ''.join('put -r "%s"\n' % source for source in sources)
+            self.__run_batch(batch)
+            self.__verify({source: os.path.basename(source)
+                           for source in sources})
+            return [self.geturl(source) for source in sources]
+
+        # List the published files first, failing listings are ignored.
+        listing = self.__run_batch(''.join(
+            '-ls "%s"\n' % self.getpath(source) for source in sources
+        ))
+        present = set(line.strip() for line in listing.splitlines())
+
+        batch = ''
+        uploaded = {}
+        for source in sources:
+            path = self.getpath(source)
+            if path in present:
+                logging.info("%s is already published", source)
+                continue
+            batch += '-mkdir "%s"\nput "%s" "%s"\n' % (
+                os.path.dirname(path), source, path
+            )
+            uploaded[source] = path
+        if batch:
+            self.__run_batch(batch)
+            self.__verify(uploaded)
+
+        return [self.geturl(source) for source in sources]
+
+    def __verify(self, paths):
+        """
+        Check the sizes of the uploaded files on the remote host, in a single
+        sftp session, if verification is enabled. sftp can't compute
+        checksums remotely.
+
+        Args:
+            paths:  A dictionary of the source file paths and the remote
+                    paths they were uploaded to.
+
+        Raises:
+            IOError if the size of an uploaded file doesn't match.
+        """
+        if not paths or not self.verify:
+            return
+
+        listing = self.__run_batch(''.join(
+            '-ls -l "%s"\n' % path for path in sorted(paths.values())
+        ))
+        sizes = {}
+        for line in listing.splitlines():
+            # E.g. "-rw-r--r--  1 user group  1234 Jan  1 00:00 path"
+            fields = line.split(None, 8)
+            if len(fields) == 9 and fields[4].isdigit():
+                sizes[fields[8]] = int(fields[4])
+
+        for (source, path) in paths.items():
+            if sizes.get(path) != os.path.getsize(source):
+                raise IOError("size mismatch of {} uploaded to {}:{}"
+                              .format(source, self.destination, path))
+
+    def __run_batch(self, batch):
+        """
+        Run sftp commands in a single session. The session aborts on the
+        first failed command, unless it's prefixed with "-".
+
+        Args:
+            batch:  The commands, one per line.
+
+        Returns:
+            The output of the commands.
+
+        Raises:
+            subprocess.CalledProcessError if the session failed.
+        """
+        proc = subprocess.Popen(['sftp', '-b', '-', self.destination],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        (output, _) = proc.communicate(batch)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, 'sftp')
+
+        return output
+
+
+class HttpPublisher(Publisher):
+    """
+    A HTTP publisher that uploads source to an object store with PUT
+    requests. In the multipart mode, which the store has to support, large
+    files are uploaded in parts, in parallel, each part being a PUT request
+    with a Content-Range header. Completed parts are recorded in a journal
+    next to the source file, so an interrupted upload can be resumed.
+    """
+    TYPE = 'http'
+
+    # Files larger than this are uploaded in parts of this size
+    PART_SIZE = 16 * 1024 * 1024
+    # Maximum number of parts uploaded at the same time
+    PART_JOBS = 4
+    # Connect and read timeouts of the requests, in seconds
+    TIMEOUT = (30, 300)
+
+    def __init__(self, dest, url, content_addressed=False, multipart=False):
+        """
+        Initialize a HTTP publisher.
+
+        Args:
+            dest:               Base URL to upload to.
+            url:                Base URL prefix of the published result,
+                                without '/' on the end.
+            content_addressed:  True if files should be published under their
+                                checksum, see Publisher.
+            multipart:          True if large files should be uploaded in
+                                parts, with ranged PUT requests. Many object
+                                stores don't support them.
+        """
+        super(HttpPublisher, self).__init__(dest, url, content_addressed)
+        self.multipart = multipart
+        # Reuse connections between the requests.
+        self.session = requests.Session()
+        self.__mount_pool(1)
+        self.__journal_lock = threading.Lock()
+
+    def __mount_pool(self, uploads):
+        """
+        Keep enough connections open for a number of files uploaded at the
+        same time, and all their parts in the multipart mode.
+
+        Args:
+            uploads:    Maximum number of files uploaded at the same time.
+        """
+        if self.multipart:
+            uploads *= self.PART_JOBS
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=uploads)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def publish_many(self, sources, jobs=1):
+        """
+        Publish several files, in parallel, see Publisher.publish_many().
+
+        Args:
+            sources:    A list of source file paths.
+            jobs:       Maximum number of files published at the same time.
+
+        Returns:
+            A list of published URLs corresponding to the sources.
+        """
+        self.__mount_pool(max(1, min(jobs, len(sources))))
+        return super(HttpPublisher, self).publish_many(sources, jobs)
+
+    def publish(self, source):
+        """
+        Upload the source file to public destination.
+
+        Args:
+            source: Source file path.
+
+        Returns:
+            Published URL corresponding to the specified source.
+
+        Raises:
+            requests.RequestException if the upload failed.
+        """
+        self.checksums[source] = hash_file(source)
+        target = join_with_slash(self.destination, self.getpath(source))
+
+        if self.content_addressed:
+            response = self.session.head(target, timeout=self.TIMEOUT)
+            if response.status_code == requests.codes.ok:
+                logging.info("%s is already published", source)
+                return self.geturl(source)
+
+        size = os.path.getsize(source)
+        if self.multipart and size > self.PART_SIZE:
+            self.__put_parts(source, target, size)
+        else:
+            with io.open(source, 'rb') as fileh:
+                response = self.session.put(target, data=fileh,
+                                            timeout=self.TIMEOUT)
+            response.raise_for_status()
+
         return self.geturl(source)
 
+    @staticmethod
+    def get_journal_path(source):
+        """
+        Get the path of the upload journal of a source file.
+
+        Args:
+            source: Source file path.
+
+        Returns:
+            The path of the journal.
+        """
+        return source + '.upload'
+
+    def __load_journal(self, source, target, size):
+        """
+        Load the upload journal of a file, or start a new one if the journal
+        doesn't exist or belongs to a different upload.
 
-def getpublisher(ptype, parg, pburl):
+        Returns:
+            The journal dictionary.
+        """
+        journal = {'target': target,
+                   'size': size,
+                   'mtime': os.path.getmtime(source),
+                   'part_size': self.PART_SIZE,
+                   'parts': []}
+        try:
+            with open(self.get_journal_path(source), 'r') as fileh:
+                previous = json.load(fileh)
+        except (IOError, ValueError):
+            return journal
+
+        if all(previous.get(key) == value for (key, value) in journal.items()
+               if key != 'parts'):
+            logging.info("resuming upload of %s, %d parts done", source,
+                         len(previous['parts']))
+            return previous
+
+        return journal
+
+    def __put_parts(self, source, target, size):
+        """
+        Upload a file in parts, in parallel, skipping the parts already
+        uploaded according to the journal.
+
+        Args:
+            source: Source file path.
+            target: URL to upload to.
+            size:   Size of the source file.
+
+        Raises:
+            requests.RequestException if the upload failed.
+            IOError if the uploaded object doesn't have the size of the
+            source.
+        """
+        journal = self.__load_journal(source, target, size)
+        journal_path = self.get_journal_path(source)
+        done = set(journal['parts'])
+        parts = [index for index in range((size - 1) // self.PART_SIZE + 1)
+                 if index not in done]
+
+        def put_part(index):
+            """Upload a single part and record it in the journal."""
+            start = index * self.PART_SIZE
+            with io.open(source, 'rb') as fileh:
+                fileh.seek(start)
+                data = fileh.read(self.PART_SIZE)
+            end = start + len(data) - 1
+            response = self.session.put(
+                target, data=data, timeout=self.TIMEOUT,
+                headers={'Content-Range': 'bytes {}-{}/{}'.format(start, end,
+                                                                  size)}
+            )
+            response.raise_for_status()
+
+            with self.__journal_lock:
+                journal['parts'].append(index)
+                with open(journal_path, 'w') as fileh:
+                    json.dump(journal, fileh)
+
+        pool = ThreadPool(min(self.PART_JOBS, len(parts)) or 1)
+        try:
+            pool.map(put_part, parts)
+        finally:
+            pool.close()
+            pool.join()
+
+        response = self.session.head(target, timeout=self.TIMEOUT)
+        response.raise_for_status()
+        if int(response.headers.get('Content-Length', size)) != size:
+            # Start from scratch next time.
+            os.unlink(journal_path)
+            raise IOError("incomplete upload of {} to {}".format(source,
+                                                                 target))
+        os.unlink(journal_path)
+
+
+def getpublisher(ptype, parg, pburl, content_addressed=False, **options):
     """
     Create an instance of a "publisher" subclass with specified arguments.
 
     Args:
-        rtype:  The value of the class "TYPE" member to match.
-        rarg:   A dictionary with the instance creation arguments.
+        rtype:              The value of the class "TYPE" member to match.
+        rarg:               A dictionary with the instance creation arguments.
+        content_addressed:  True if files should be published under their
+                            checksum, see Publisher.
+        options:            Options specific to the publisher type, passed
+                            to its constructor, e.g. "multipart" for "http".
 
     Returns:
         The created class instance.
 
     Raises:
-        ValueError if the rtype match wasn't found.
+        ValueError if the rtype match wasn't found, or the publisher doesn't
+        support one of the options.
     """
     for cls in Publisher.__subclasses__():
         if cls.TYPE == ptype:
-            return cls(parg, pburl)
+            supported = inspect.getargspec(cls.__init__).args
+            for option in options:
+                if option not in supported:
+                    raise ValueError("%s publisher doesn't support %s" %
+                                     (ptype, option))
+            return cls(parg, pburl, content_addressed, **options)
     raise ValueError("Unknown publisher type: %s" % ptype)
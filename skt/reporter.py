@@ -12,35 +12,373 @@
 # along with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """Class for managing Reporter."""
-import ConfigParser
-from email.mime.application import MIMEApplication
+import base64
+import errno
+from email.generator import Generator
+from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import enum
+import io
+import json
 import logging
 import os
 import re
+import shutil
 import smtplib
+import StringIO
 import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
 
-from jinja2 import Environment, FileSystemLoader
-
-from skt.console import gzipdata
+from skt.buildlog import get_error_excerpt, get_index_path, load_index
+from skt.console import gzipfile
 from skt.misc import get_patch_name, get_patch_mbox
 import skt.runner
+from skt.state_file import read_state_file
 
 # Determine the absolute path to this script and the directory which holds
 # the jinja2 templates.
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 TEMPLATE_DIR = "{}/templates".format(SCRIPT_DIR)
 
-# Set up the jinja2 environment which can be reused throughout this script.
-JINJA_ENV = Environment(
-    loader=FileSystemLoader(TEMPLATE_DIR),
-    trim_blocks=True,  # Remove first newline after a jinja2 block
-    keep_trailing_newline=True,  # Preserve trailing newlines
-    lstrip_blocks=True,  # Strip whitespace from the left side of tags
-)
+# Maximum number of state files to gather in parallel for a multireport
+MULTIREPORT_JOBS = 8
+
+# Size of the attachment chunks encoded at once, a multiple of the 57 bytes
+# base64 encodes per line
+ATTACHMENT_CHUNK_SIZE = 57 * 1024
+
+# Maximum size of a mail message kept in memory before it's spooled to disk
+MAIL_SPOOL_SIZE = 1024 * 1024
+
+# Number of times to retry sending a message after a temporary failure, and
+# the delay in seconds before the first retry, doubled with each retry
+SMTP_RETRIES = 3
+SMTP_RETRY_DELAY = 10
+
+# The jinja2 environment, created by get_jinja_env() on the first report
+_JINJA_ENV = None
+
+# Fields of the exported test result records, with their SQLite column types
+EXPORT_FIELDS = [
+    ('krelease', 'TEXT'),
+    ('recipe_set', 'TEXT'),
+    ('recipe', 'TEXT'),
+    ('arch', 'TEXT'),
+    ('task', 'TEXT'),
+    ('result', 'TEXT'),
+    ('status', 'TEXT'),
+    ('duration', 'INTEGER'),
+    ('url', 'TEXT'),
+    ('logs', 'TEXT'),
+]
+
+
+def get_template_cache_dir():
+    """
+    Get the directory to cache the compiled report templates in.
+
+    Returns:
+        The path to the directory, following the XDG base directory spec.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'skt', 'templates')
+
+
+def get_jinja_env():
+    """
+    Get the jinja2 environment which is reused for all reports. It's only
+    created, and jinja2 imported, when the first report is rendered. The
+    compiled templates are cached on disk, so only the first run after a
+    template changes has to compile it.
+
+    Returns:
+        The jinja2 environment.
+    """
+    # pylint: disable=global-statement
+    global _JINJA_ENV
+    if _JINJA_ENV is not None:
+        return _JINJA_ENV
+
+    from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+    cache_dir = get_template_cache_dir()
+    try:
+        os.makedirs(cache_dir)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            logging.warning("can't cache report templates in %s: %s",
+                            cache_dir, exc)
+            cache_dir = None
+
+    _JINJA_ENV = Environment(
+        loader=FileSystemLoader(TEMPLATE_DIR),
+        bytecode_cache=(FileSystemBytecodeCache(cache_dir)
+                        if cache_dir else None),
+        trim_blocks=True,  # Remove first newline after a jinja2 block
+        keep_trailing_newline=True,  # Preserve trailing newlines
+        lstrip_blocks=True,  # Strip whitespace from the left side of tags
+    )
+    return _JINJA_ENV
+
+
+def open_attachment(att):
+    """
+    Get a file object to read attachment contents from.
+
+    Args:
+        att:    The attachment contents, either a string or a file object.
+
+    Returns:
+        A file object positioned at the start of the contents.
+    """
+    if not hasattr(att, 'read'):
+        return io.BytesIO(att)
+
+    att.seek(0)
+    return att
+
+
+def get_attachment_size(att):
+    """
+    Get the size of attachment contents without reading them.
+
+    Args:
+        att:    The attachment contents, either a string or a file object.
+
+    Returns:
+        The size in bytes.
+    """
+    if not hasattr(att, 'read'):
+        return len(att)
+
+    att.seek(0, os.SEEK_END)
+    return att.tell()
+
+
+def write_message(fileh, msg, attachments):
+    """
+    Write an email message with attachments, encoding the attachments one
+    chunk at a time, so they are never held in memory in full.
+
+    Args:
+        fileh:          The file to write the message to.
+        msg:            The MIMEMultipart message with the headers and the
+                        inline parts, such as the report text.
+        attachments:    A list of (file name, contents) attachment tuples,
+                        with the contents either a string or a file object.
+    """
+    # Write the message without the attachments, but leave out the closing
+    # boundary, since the attachments come before it.
+    text = StringIO.StringIO()
+    Generator(text, mangle_from_=False).flatten(msg)
+    boundary = msg.get_boundary()
+    text = text.getvalue()
+    fileh.write(text[:text.rindex('--{}--'.format(boundary))])
+
+    for (name, att) in attachments:
+        # TODO Store content type and charset when adding attachments
+        if name.endswith(('.log', '.txt')):
+            part = MIMEBase('text', 'plain', charset='utf-8')
+        else:
+            part = MIMEBase('application', 'octet-stream')
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header("content-disposition", "attachment", filename=name)
+
+        fileh.write('--{}\n'.format(boundary))
+        Generator(fileh, mangle_from_=False).flatten(part)
+        source = open_attachment(att)
+        for chunk in iter(lambda: source.read(ATTACHMENT_CHUNK_SIZE), b''):
+            fileh.write(base64.encodestring(chunk))
+        fileh.write('\n')
+
+    fileh.write('--{}--\n'.format(boundary))
+
+
+def send_message(mailserver, mailfrom, recipients, fileh):
+    """
+    Send an email message from a file over an SMTP connection, a line at a
+    time instead of reading it into memory as smtplib.SMTP.sendmail() does.
+
+    Args:
+        mailserver: The connected smtplib.SMTP object.
+        mailfrom:   The envelope sender address.
+        recipients: A list of envelope recipient addresses.
+        fileh:      The file containing the message.
+
+    Returns:
+        A dictionary of the refused recipients, as returned by
+        smtplib.SMTP.sendmail().
+
+    Raises:
+        The smtplib exceptions smtplib.SMTP.sendmail() raises.
+    """
+    mailserver.ehlo_or_helo_if_needed()
+
+    (code, resp) = mailserver.mail(mailfrom)
+    if code != 250:
+        mailserver.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, mailfrom)
+
+    refused = {}
+    for recipient in recipients:
+        (code, resp) = mailserver.rcpt(recipient)
+        if code not in (250, 251):
+            refused[recipient] = (code, resp)
+    if len(refused) == len(recipients):
+        mailserver.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    mailserver.putcmd("data")
+    (code, resp) = mailserver.getreply()
+    if code != 354:
+        mailserver.rset()
+        raise smtplib.SMTPDataError(code, resp)
+
+    # Send the lines with CRLF line endings and leading dots doubled, as
+    # smtplib.quotedata() does, in buffers of about the spool size.
+    fileh.seek(0)
+    lines = []
+    size = 0
+    for line in fileh:
+        line = line.rstrip('\r\n')
+        if line.startswith('.'):
+            line = '.' + line
+        lines.append(line + '\r\n')
+        size += len(line) + 2
+        if size >= MAIL_SPOOL_SIZE:
+            mailserver.send(''.join(lines))
+            lines = []
+            size = 0
+    lines.append('.\r\n')
+    mailserver.send(''.join(lines))
+
+    (code, resp) = mailserver.getreply()
+    if code != 250:
+        mailserver.rset()
+        raise smtplib.SMTPDataError(code, resp)
+
+    return refused
+
+
+def get_duration_seconds(duration):
+    """
+    Convert a Beaker task duration to seconds.
+
+    Args:
+        duration:   The duration as formatted by Beaker, e.g. "1:02:03" or
+                    "2 days, 1:02:03", or None.
+
+    Returns:
+        The duration in seconds, or None if it's missing or malformed.
+    """
+    match = re.match(r'^(?:(\d+) days?, )?(\d+):(\d+):(\d+)$',
+                     duration or '')
+    if not match:
+        return None
+
+    (days, hours, minutes, seconds) = [int(value or 0)
+                                       for value in match.groups()]
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+class MailSession(object):
+    """
+    An SMTP connection reused to send several messages. Sending is retried
+    on temporary (4xx) failures and after losing the connection.
+    """
+
+    def __init__(self, smtp_url, debug=False, retries=SMTP_RETRIES,
+                 retry_delay=SMTP_RETRY_DELAY):
+        """
+        Initialize an SMTP session, connecting on the first message.
+
+        Args:
+            smtp_url:       The SMTP server in "host[:port]" format.
+            debug:          True to enable debugging of the connection.
+            retries:        Number of retries after a temporary failure.
+            retry_delay:    Delay in seconds before the first retry, doubled
+                            with each retry.
+        """
+        self.smtp_url = smtp_url
+        self.debug = debug
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.mailserver = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __connect(self):
+        """Connect to the SMTP server unless connected already."""
+        if self.mailserver is None:
+            self.mailserver = smtplib.SMTP(self.smtp_url)
+            # Enable SMTP debugging if skt is running in verbose mode.
+            self.mailserver.set_debuglevel(self.debug)
+
+    @staticmethod
+    def __is_temporary(exc):
+        """Check if an SMTP failure is temporary and worth retrying."""
+        if isinstance(exc, (smtplib.SMTPServerDisconnected, IOError)):
+            return True
+        if isinstance(exc, smtplib.SMTPRecipientsRefused):
+            return all(400 <= code < 500
+                       for (code, _) in exc.recipients.values())
+        if isinstance(exc, smtplib.SMTPResponseException):
+            return 400 <= exc.smtp_code < 500
+        return False
+
+    def send(self, mailfrom, recipients, fileh):
+        """
+        Send an email message from a file, see send_message().
+
+        Args:
+            mailfrom:   The envelope sender address.
+            recipients: A list of envelope recipient addresses.
+            fileh:      The file containing the message.
+
+        Returns:
+            A dictionary of the refused recipients.
+        """
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                self.__connect()
+                refused = send_message(self.mailserver, mailfrom,
+                                       recipients, fileh)
+                break
+            except (smtplib.SMTPException, IOError) as exc:
+                if isinstance(exc, (smtplib.SMTPServerDisconnected,
+                                    IOError)) and self.mailserver:
+                    # The connection is lost, reconnect on the next attempt.
+                    self.mailserver.close()
+                    self.mailserver = None
+                if attempt == self.retries or not self.__is_temporary(exc):
+                    raise
+                logging.warning("sending mail failed temporarily, retrying "
+                                "in %d seconds: %s", delay, exc)
+                time.sleep(delay)
+                delay *= 2
+
+        for (recipient, (code, resp)) in refused.items():
+            logging.warning("mail to %s refused: %d %s", recipient, code,
+                            resp)
+        return refused
+
+    def close(self):
+        """Close the connection to the SMTP server, if any."""
+        if self.mailserver is not None:
+            try:
+                self.mailserver.quit()
+            except smtplib.SMTPServerDisconnected:
+                pass
+            self.mailserver = None
 
 
 class MultiReportFailure(enum.IntEnum):
@@ -64,28 +402,13 @@ def load_state_cfg(statefile):
     Returns: A cfg dictionary.
 
     """
-    cfg = {}
-    state_to_report = ConfigParser.ConfigParser()
-    with open(statefile, 'r') as fileh:
-        state_to_report.readfp(fileh)
-
-    # FIXME This can be simplified or removed after configuration and
-    # state split
-    for (name, value) in state_to_report.items('state'):
-        if not cfg.get(name):
-            if name.startswith('jobid_'):
-                cfg.setdefault("jobs", set()).add(value)
-            if name.startswith('recipesetid_'):
-                cfg.setdefault("recipe_sets", set()).add(value)
-            elif name.startswith('mergerepo_'):
-                cfg.setdefault("mergerepos", list()).append(value)
-            elif name.startswith('mergehead_'):
-                cfg.setdefault("mergeheads", list()).append(value)
-            elif name.startswith('localpatch_'):
-                cfg.setdefault("localpatches", list()).append(value)
-            elif name.startswith('patchwork_'):
-                cfg.setdefault("patchworks", list()).append(value)
-            cfg[name] = value
+    if not os.path.isfile(statefile):
+        raise IOError(errno.ENOENT, "No such state file", statefile)
+
+    # The parsed state file is cached, so each state file is parsed once
+    # per process.
+    (state_to_report, state) = read_state_file(statefile)
+    cfg = dict(state.items())
 
     # Get runner info
     if state_to_report.has_section('runner'):
@@ -120,8 +443,14 @@ class Reporter(object):
         # FIXME Switch to using an explicitly-defined type
         self.cfg = cfg
         # List of attachment tuples, each containing attachment file name and
-        # contents.
+        # contents, either as a string or a file object.
         self.attach = list()
+        # Maximum size of an attachment in bytes, larger ones are published
+        # and linked from the report instead, None for no limit.
+        self.attach_max = None
+        # Publisher config for the large attachments, see
+        # skt.publisher.getpublisher().
+        self.publisher = cfg.get('publisher')
         # mergedata: a dict containing following keys:
         # 'baserepo'     - repo URL
         # 'basehead'     - base commit SHA
@@ -142,33 +471,54 @@ class Reporter(object):
         # multireporting
         self.multi_job_ids = []
 
-    def __stateconfigdata(self, mergedata):
+    @classmethod
+    def report_many(cls, cfgs):
+        """
+        Generate a report for each of several configurations.
+
+        Args:
+            cfgs:   A list of skt configurations and states to report.
+        """
+        for cfg in cfgs:
+            cls(cfg).report()
+
+    @classmethod
+    def __stateconfigdata(cls, cfg, mergedata):
         # Store the repo URL, base commit SHA, and subject for that commit.
-        mergedata['baserepo'] = self.cfg.get("baserepo")
-        mergedata['basehead'] = self.cfg.get("basehead")
-        mergedata['basesubject'] = self.cfg.get('basesubject')
+        mergedata['baserepo'] = cfg.get("baserepo")
+        mergedata['basehead'] = cfg.get("basehead")
+        mergedata['basesubject'] = cfg.get('basesubject')
 
-        if self.cfg.get("mergerepos"):
-            mrl = self.cfg.get("mergerepos")
-            mhl = self.cfg.get("mergeheads")
+        if cfg.get("mergerepos"):
+            mrl = cfg.get("mergerepos")
+            mhl = cfg.get("mergeheads")
             for idx, mrl_item in enumerate(mrl):
                 mergedata['merge_git'].append((mrl_item, mhl[idx]))
 
-        if self.cfg.get("localpatches"):
+        if cfg.get("localpatches"):
             mergedata['localpatch'] = [
                 os.path.basename(patch_path) for patch_path
-                in self.cfg.get("localpatches")
+                in cfg.get("localpatches")
             ]
 
-        if self.cfg.get("patchworks"):
-            for purl in self.cfg.get("patchworks"):
+        if cfg.get("patchworks"):
+            for purl in cfg.get("patchworks"):
                 patch_mbox = get_patch_mbox(purl)
                 patchname = get_patch_name(patch_mbox)
                 mergedata['patchwork'].append((purl, patchname))
 
         return mergedata
 
-    def _update_mergedata(self):
+    @classmethod
+    def _get_mergedata(cls, cfg):
+        """
+        Get the data about the merged patches of a state.
+
+        Args:
+            cfg:    The skt configuration and state.
+
+        Returns: A mergedata dictionary, see Reporter.__init__().
+        """
         mergedata = {
             'base': None,
             'merge_git': [],
@@ -176,21 +526,26 @@ class Reporter(object):
             'patchwork': [],
         }
 
-        mergedata = self.__stateconfigdata(mergedata)
-        self.mergedata = mergedata
+        return cls.__stateconfigdata(cfg, mergedata)
 
-    def __getmergelog(self):
+    def _update_mergedata(self):
+        self.mergedata = self._get_mergedata(self.cfg)
+
+    @classmethod
+    def __getmergelog(cls, cfg):
         """
         Read the merge log and remove unneeded lines.
+        Args:
+            cfg:    The skt configuration and state.
         Returns: A string containing a filtered merge log if the merge log
                  exists. Otherwise None is returned.
         """
         # Did the merge fail?
-        if not self.cfg.get('mergelog'):
+        if not cfg.get('mergelog'):
             return None
 
         result = ""
-        with open(self.cfg.get("mergelog"), 'r') as fileh:
+        with open(cfg.get("mergelog"), 'r') as fileh:
             for line in fileh:
                 # Skip the useless part of the 'git am' output
                 if ("The copy of the patch" in line) \
@@ -200,18 +555,22 @@ class Reporter(object):
 
         return result
 
-    def __getbuildlog(self, suffix=None):
+    @classmethod
+    def __getbuildlog(cls, cfg, suffix=None):
         """
-        Read a build log from the disk and add it to the list of attachments.
+        Prepare a build log on the disk as a compressed attachment. A log
+        compressed already, or with an up-to-date compressed copy next to
+        it, is attached as it is, others are compressed a chunk at a time.
         Args:
+            cfg:    The skt configuration and state.
             suffix: The extra text to add to the build log file name. This is
                     helpful for distinguishing between different architectures
                     that were built. Examples: 'aarch64', 'x86_64'.
-        Returns: The name of the attachment that was added if the build log
+        Returns: An (attachment name, file object) tuple if the build log
                  exists from a failed build. Otherwise None is returned.
         """
         # Did the build fail?
-        if not self.cfg.get('buildlog'):
+        if not cfg.get('buildlog'):
             return None
 
         if suffix:
@@ -219,129 +578,209 @@ class Reporter(object):
         else:
             attachment_name = "build.log.gz"
 
-        with open(self.cfg.get("buildlog"), 'r') as fileh:
-            self.attach.append((attachment_name, gzipdata(fileh.read())))
+        buildlog = cfg.get("buildlog")
+        if buildlog.endswith('.gz'):
+            return (attachment_name, open(buildlog, 'rb'))
+
+        compressed = buildlog + '.gz'
+        if os.path.isfile(compressed) and \
+                os.path.getmtime(compressed) >= os.path.getmtime(buildlog):
+            return (attachment_name, open(compressed, 'rb'))
 
-        return attachment_name
+        return (attachment_name, gzipfile(buildlog))
 
     @classmethod
-    def __get_failed_task_log(cls, task_node):
+    def __getbuildexcerpt(cls, cfg):
         """
-        Get logs from a failed task and its subtasks.
-
-        Returns: A list of log file URLs.
+        Get the part of the build log around the first build error, located
+        with the index written next to the build log by the builder.
+        Args:
+            cfg:    The skt configuration and state.
+        Returns: The excerpt as a unicode string, or None if the build log
+                 has no usable index or the index doesn't point to any error.
         """
-        useless_logs = ['harness.log', 'setup.log']
-
-        # Get the logs from the main task.
-        task_logs = [
-            log.attrib.get('href') for log in task_node.findall('logs/log')
-            if log.attrib.get('name') not in useless_logs
-        ]
-
-        # If this task has subtasks, get those as well.
-        subtask_logs = [subtask.findall('logs/log') for subtask in
-                        task_node.findall('results/result')
-                        if subtask.attrib.get('result') != 'Pass']
-
-        for subtask_log in subtask_logs:
-            log_urls = [log.attrib.get('href') for log in subtask_log]
-            task_logs += log_urls
+        buildlog = cfg.get('buildlog')
+        index = load_index(cfg.get('buildlogindex')
+                           or get_index_path(buildlog))
+        if not index:
+            return None
 
-        return task_logs
+        excerpt = get_error_excerpt(buildlog, index)
+        if excerpt is None:
+            return None
 
-    @classmethod
-    def __get_task(cls, recipe, task_name):
-        """
-        Get the task XML node for a task.
-        Returns: An XML element for a particular task.
-        """
-        xml_task_element = "task[@name='{}']".format(task_name)
-        task_node = recipe.find(xml_task_element)
-        return task_node
+        # Compilers quote identifiers with UTF-8 quotes in their messages.
+        return excerpt.decode('utf-8', 'replace')
 
-    def __getjobresults(self):
+    def __getjobresults(self, cfg):
         """
         Retrieve job results which should be appended to the report.
         Every test run has a list of receipe sets that were run. Each set
         can contain one or more recipes. Each recipe has one or more tasks
         that run individual tests.
 
+        Args:
+            cfg:    The skt configuration and state.
+
         Returns:
             A list of lines representing results of test runs.
         """
         result = []
 
-        runner = skt.runner.getrunner(*self.cfg.get("runner"))
+        for (_, summary) in self._iter_recipe_summaries(cfg):
+            # Aborted tasks are left out of the report
+            result.append({
+                'id': summary['id'],
+                'arch': summary['arch'],
+                'result': summary['result'],
+                'passed_tasks': summary['passed_tasks'],
+                'failed_tasks': summary['failed_tasks'],
+            })
+
+        return result
+
+    @classmethod
+    def _iter_recipe_summaries(cls, cfg):
+        """
+        Iterate over the summaries of the recipes that were run, see
+        skt.runner.BeakerRunner.summarize_recipe(). Every test run has a list
+        of recipe sets that were run, each containing one or more recipes.
+
+        Args:
+            cfg:    The skt configuration and state.
 
-        # Get the list of recipes sets that were run.
-        recipe_set_list = self.cfg.get('recipe_sets', [])
+        Yields:
+            Tuples of the recipe set ID and the summary of a recipe in it.
+        """
+        if not cfg.get('runner'):
+            return
 
-        # Get the XML result tree for each recipe set.
-        recipe_set_results = [runner.getresultstree(recipe_set_id)
-                              for recipe_set_id in recipe_set_list]
+        runner = skt.runner.getrunner(*cfg.get("runner"))
 
-        # Loop through each recipe set to examine each recipe (and its tasks).
-        for recipe_set_result in recipe_set_results:
+        # Get the XML result tree for each recipe set that was run.
+        for recipe_set_id in cfg.get('recipe_sets', []):
+            recipe_set_result = runner.getresultstree(recipe_set_id)
             for recipe in recipe_set_result.findall('recipe'):
+                yield (recipe_set_id, runner.summarize_recipe(recipe))
 
-                passed_tasks = []
-                failed_tasks = []
-
-                # Get basic information about this recipe.
-                recipe_result = recipe.attrib.get('result')
-                recipe_data = {
-                    'id': recipe.attrib.get('id'),
-                    'arch': recipe.find(
-                        'hostRequires/and/arch').attrib.get('value'),
-                    'result': recipe_result,
-                }
-
-                # Get a list of the tests that were run for this recipe.
-                tests_run = runner.get_recipe_test_list(recipe)
-                for test_name in tests_run:
-
-                    # Get the XML node of the task and basic data
-                    task_node = self.__get_task(recipe, test_name)
-                    task_name = task_node.attrib.get('name')
-                    task_result = task_node.attrib['result']
-                    task_status = task_node.attrib['status']
-                    task_url = ''
-
-                    # Find git source, if any
-                    fetch = task_node.find('fetch')
-                    if fetch is not None:
-                        task_url = fetch.attrib.get('url')
-
-                    if task_result == 'Pass':
-                        passed_tasks.append({'name': task_name,
-                                             'url': task_url})
-                    elif (task_result == 'Warn' and task_status == 'Aborted'):
-                        # Don't add tasks that aborted to the lists
-                        continue
-                    else:
-                        # Retrieve all needed data about the failed task
-                        logs = self.__get_failed_task_log(task_node)
-                        # If the task caused a kernel panic, add a link to the
-                        # console log since that's the one containing the
-                        # actual trace.
-                        if task_result == 'Panic':
-                            console = recipe.find(
-                                "logs/log[@name='console.log']")
-                            if console is not None:
-                                logs.append(console.attrib.get('href'))
-
-                        failed_tasks.append({'name': task_name,
-                                             'logs': logs,
-                                             'url': task_url})
-
-                recipe_data['passed_tasks'] = passed_tasks
-                recipe_data['failed_tasks'] = failed_tasks
-
-                # Add all the details about this recipe to the main result.
-                result.append(recipe_data)
+    def _gather_statefile(self, statefile):
+        """
+        Gather the data to report from a single state file. This doesn't
+        modify the reporter, so state files can be processed in parallel.
 
-        return result
+        Args:
+            statefile:  Path to the state file, or None to use the state
+                        already loaded into self.cfg.
+
+        Returns: A dictionary with the loaded configuration and state
+                 ('cfg'), the merge data ('mergedata'), the job IDs
+                 ('jobs'), the filtered merge log of a failed merge
+                 ('mergelog'), the data about the job for the report
+                 ('job_data', None if there's nothing to report), the
+                 attachments ('attachments') and the failure found
+                 ('failed', None if none).
+        """
+        # If the statefile is none, this is a single run report and the
+        # state information has already been loaded into self.cfg.
+        cfg = load_state_cfg(statefile) if statefile else self.cfg
+
+        data = {
+            'cfg': cfg,
+            # Update the data about the patches merged.
+            'mergedata': self._get_mergedata(cfg),
+            # The list of jobs found in this statefile.
+            'jobs': sorted(cfg.get('jobs') or []),
+            'mergelog': None,
+            'job_data': None,
+            'attachments': [],
+            'failed': None,
+        }
+
+        # Did the merge fail? Nothing was built or tested after that.
+        if cfg.get('mergelog'):
+            data['failed'] = MultiReportFailure.MERGE
+            data['mergelog'] = self.__getmergelog(cfg)
+            return data
+
+        # Store the data about this job for the report.
+        job_data = cfg
+
+        # If our make options contain '-C <path>', we should remove that.
+        if 'make_opts' in job_data:
+            make_opts = job_data['make_opts']
+            if isinstance(make_opts, list):
+                make_opts = ' '.join(make_opts)
+            pattern = r' -C [\w\-/\d]+'
+            job_data['make_opts'] = re.sub(pattern, '', make_opts)
+
+        # Did the compile fail for this job?
+        # If yes, store the build log and skip the test results since we
+        # didn't test anything in this job.
+        if cfg.get('buildlog'):
+            data['failed'] = MultiReportFailure.BUILD
+            kernel_arch = cfg.get('kernel_arch')
+            job_data['buildlog_excerpt'] = self.__getbuildexcerpt(cfg)
+            attachment = self.__getbuildlog(cfg, kernel_arch)
+            data['attachments'].append(attachment)
+            job_data['buildlog'] = attachment[0]
+            data['job_data'] = job_data
+            return data
+
+        # Did the tests run for this job?
+        if cfg.get('runner'):
+            # If the tests failed, mark the result as a test failure.
+            if cfg.get('retcode') != 0:
+                data['failed'] = MultiReportFailure.TEST
+
+            # Collect the tests results and append them to our list.
+            job_data['test_results'] = self.__getjobresults(cfg)
+            data['job_data'] = job_data
+
+        return data
+
+    def _publish_attachments(self, report_jobs):
+        """
+        Publish the attachments larger than self.attach_max and link the
+        build logs among them from the report instead of attaching them.
+
+        Args:
+            report_jobs:    The data about the jobs in the report, updated
+                            with the URLs of their build logs.
+        """
+        large = [(name, att) for (name, att) in self.attach
+                 if self.attach_max is not None
+                 and get_attachment_size(att) > self.attach_max]
+        if not large:
+            return
+
+        if not self.publisher:
+            logging.warning("no publisher configured for the attachments "
+                            "over the size limit, attaching them anyway")
+            return
+
+        import skt.publisher
+
+        # Publish by checksum, so the logs of different runs don't clash.
+        publisher = skt.publisher.getpublisher(*self.publisher,
+                                               content_addressed=True)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for (name, att) in large:
+                path = os.path.join(tmpdir, name)
+                with open(path, 'wb') as fileh:
+                    shutil.copyfileobj(open_attachment(att), fileh)
+                paths.append(path)
+            urls = publisher.publish_many(paths)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        urls = dict(zip([name for (name, _) in large], urls))
+        self.attach = [(name, att) for (name, att) in self.attach
+                       if name not in urls]
+        for job_data in report_jobs:
+            if job_data.get('buildlog') in urls:
+                job_data['buildlog_url'] = urls[job_data['buildlog']]
 
     def _get_multireport(self):
         """
@@ -358,72 +797,55 @@ class Reporter(object):
 
         # Set the template filename and load the template.
         template_file = "report_{}.j2".format(template_name)
-        template = JINJA_ENV.get_template(template_file)
+        template = get_jinja_env().get_template(template_file)
 
         # If we don't have any state files, this is likely a run with a single
         # test. Make a single entry in self.statefiles so we can re-use the
         # loop below.
         self.statefiles = self.statefiles or [None]
 
+        # Gather the data of all state files at once, as that's mostly
+        # waiting for downloads and Beaker.
+        jobs = min(MULTIREPORT_JOBS, len(self.statefiles))
+        if jobs > 1:
+            pool = ThreadPool(jobs)
+            try:
+                gathered = pool.map(self._gather_statefile, self.statefiles)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            gathered = [self._gather_statefile(statefile)
+                        for statefile in self.statefiles]
+
         # Set up a list to hold our data for each job.
         report_jobs = []
 
-        # Loop through each of the statefiles provided.
-        for statefile in self.statefiles:
-            # If the statefile is none, this is a single run report and the
-            # state information has already been loaded into self.cfg.
-            if statefile:
-                self.cfg = load_state_cfg(statefile)
-
-            # Update the data about the patches merged.
-            self._update_mergedata()
-
-            # Add the list of jobs foud in this statefile to the list.
-            if self.cfg.get("jobs"):
-                jobs = [x for x in sorted(self.cfg.get('jobs'))]
-                self.multi_job_ids += jobs
+        # Put the data together in the order of the state files.
+        for data in gathered:
+            self.cfg = data['cfg']
+            self.mergedata = data['mergedata']
+            self.multi_job_ids += data['jobs']
+            self.attach += data['attachments']
+            if data['failed'] is not None:
+                self.multireport_failed = data['failed']
 
             # Did the merge fail? If so, stop right here and send the report.
             # We didn't build any kernels or test anything after that failure.
-            if self.cfg.get('mergelog'):
-                self.multireport_failed = MultiReportFailure.MERGE
+            if data['failed'] == MultiReportFailure.MERGE:
                 result = template.render(
                     mergedata=self.mergedata,
                     cfg=self.cfg,
-                    mergelog=self.__getmergelog(),
+                    mergelog=data['mergelog'],
                     multireport_failed=self.multireport_failed,
                 )
                 return result
 
-            # Store the data about this job for the report.
-            job_data = self.cfg
-
-            # If our make options contain '-C <path>', we should remove that.
-            if 'make_opts' in job_data:
-                pattern = r' -C [\w\-/\d]+'
-                job_data['make_opts'] = re.sub(
-                    pattern, '', job_data['make_opts']
-                )
+            if data['job_data'] is not None:
+                report_jobs.append(data['job_data'])
 
-            # Did the compile fail for this job?
-            # If yes, store the build log and skip to the next job since we
-            # didn't test anything in this job.
-            if self.cfg.get('buildlog'):
-                self.multireport_failed = MultiReportFailure.BUILD
-                kernel_arch = self.cfg.get('kernel_arch')
-                job_data['buildlog'] = self.__getbuildlog(kernel_arch)
-                report_jobs.append(job_data)
-                continue
-
-            # Did the tests run for this job?
-            if self.cfg.get('runner'):
-                # If the tests failed, mark the result as a test failure.
-                if self.cfg.get('retcode') != '0':
-                    self.multireport_failed = MultiReportFailure.TEST
-
-                # Collect the tests results and append them to our list.
-                job_data['test_results'] = self.__getjobresults()
-                report_jobs.append(job_data)
+        # Link the attachments too large to send instead.
+        self._publish_attachments(report_jobs)
 
         # Render the report.
         result = template.render(
@@ -493,12 +915,12 @@ class StdioReporter(Reporter):
         # data to build subject from
         report = self._get_multireport()
         printer.write("Subject: {}\n".format(self._get_multisubject()))
-        printer.write(report)
+        printer.write(report.encode('utf-8'))
 
         for (name, att) in self.attach:
             if name.endswith(('.log', '.txt')):
                 printer.write("\n---------------\n{}\n".format(name))
-                printer.write(att)
+                shutil.copyfileobj(open_attachment(att), printer)
 
 
 class MailReporter(Reporter):
@@ -528,8 +950,36 @@ class MailReporter(Reporter):
 
         super(MailReporter, self).__init__(cfg)
 
-    def report(self):
-        """Generate and send the email report."""
+        # The attachment size limit is given in KiB.
+        if cfg.get('mail_attach_max') is not None:
+            self.attach_max = int(cfg.get('mail_attach_max')) * 1024
+
+    @classmethod
+    def report_many(cls, cfgs):
+        """
+        Send a report email for each of several configurations, all over a
+        single SMTP session.
+
+        Args:
+            cfgs:   A list of skt configurations and states to report.
+        """
+        reporters = [cls(cfg) for cfg in cfgs]
+        if not reporters:
+            return
+
+        with MailSession(reporters[0].smtp_url,
+                         reporters[0].debug) as session:
+            for reporter in reporters:
+                reporter.report(session)
+
+    def report(self, session=None):
+        """
+        Generate and send the email report.
+
+        Args:
+            session:    The MailSession to send the email over, or None to
+                        use a new one.
+        """
         msg = MIMEMultipart()
 
         # Add the most basic parts of the email message
@@ -544,7 +994,12 @@ class MailReporter(Reporter):
 
         # We need to run the reporting function first to get aggregates to
         # build subject from
-        msg.attach(MIMEText(self._get_multireport()))
+        report = self._get_multireport()
+        try:
+            msg.attach(MIMEText(report.encode('ascii')))
+        except UnicodeError:
+            # The build log excerpt can contain non-ASCII characters.
+            msg.attach(MIMEText(report.encode('utf-8'), 'plain', 'utf-8'))
 
         # Assign subject
         if self.subject:
@@ -558,25 +1013,148 @@ class MailReporter(Reporter):
         # Add the SKT job IDs so we can correlate emails to jobs
         msg['X-SKT-JIDS'] = ' '.join(self.multi_job_ids)
 
-        for (name, att) in self.attach:
-            # TODO Store content type and charset when adding attachments
-            if name.endswith(('.log', '.txt')):
-                tmp = MIMEText(att, _charset='utf-8')
-                tmp.add_header("content-disposition", "attachment",
-                               filename=name)
-            else:
-                tmp = MIMEApplication(att)
-                tmp.add_header("content-disposition", "attachment",
-                               filename=name)
+        # Assemble the message on disk if it grows large, encoding the
+        # attachments as they are written, and send it from there.
+        spool = tempfile.SpooledTemporaryFile(max_size=MAIL_SPOOL_SIZE)
+        try:
+            write_message(spool, msg, self.attach)
+
+            own_session = session is None
+            if own_session:
+                session = MailSession(self.smtp_url, self.debug)
+            try:
+                session.send(self.mailfrom,
+                             self.mailto + self.mailcc + self.mailbcc,
+                             spool)
+            finally:
+                if own_session:
+                    session.close()
+        finally:
+            spool.close()
+
+
+class ExportReporter(Reporter):
+    """
+    Abstract reporter exporting a machine-readable record for each test task
+    which ran, see EXPORT_FIELDS. The records are written as soon as the
+    results of each state file are retrieved.
+    """
+    # pylint: disable=too-few-public-methods,abstract-method
+
+    def __init__(self, cfg):
+        """Initialize an exporting reporter."""
+        super(ExportReporter, self).__init__(cfg)
+        # Path to the file to append the records to, None for stdout
+        self.output = cfg.get('report_output')
+
+    def _get_records(self, statefile):
+        """
+        Get the records of the test tasks run by a single state file.
+
+        Args:
+            statefile:  Path to the state file, or None to use the state
+                        already loaded into self.cfg.
+
+        Returns:
+            A list of dictionaries with the EXPORT_FIELDS as keys.
+        """
+        cfg = load_state_cfg(statefile) if statefile else self.cfg
+
+        records = []
+        for (recipe_set_id, summary) in self._iter_recipe_summaries(cfg):
+            for task in summary['tasks']:
+                records.append({
+                    'krelease': cfg.get('krelease'),
+                    'recipe_set': recipe_set_id,
+                    'recipe': summary['id'],
+                    'arch': summary['arch'],
+                    'task': task['name'],
+                    'result': task['result'],
+                    'status': task['status'],
+                    'duration': get_duration_seconds(task['duration']),
+                    'url': task['url'],
+                    'logs': task.get('logs', []),
+                })
+
+        return records
+
+    def _iter_records(self):
+        """
+        Iterate over the records of the state files, in their order.
+        Retrieving the results is mostly waiting for Beaker, so several state
+        files are processed at once.
+
+        Yields:
+            Lists of records of a single state file, see _get_records().
+        """
+        statefiles = self.statefiles or [None]
+        pool = ThreadPool(min(MULTIREPORT_JOBS, len(statefiles)))
+        try:
+            for records in pool.imap(self._get_records, statefiles):
+                yield records
+        finally:
+            pool.close()
+            pool.join()
+
+
+class JsonlReporter(ExportReporter):
+    """Export the test results as JSON Lines, one record per line."""
+    # pylint: disable=too-few-public-methods
+    TYPE = 'jsonl'
+
+    def report(self, printer=sys.stdout):
+        """
+        Write the records to the output file, or a configurable output if
+        there's none.
 
-            msg.attach(tmp)
+        Args:
+            printer: What should be used to print the records if no output
+                     file is set (default: stdout)
+        """
+        fileh = open(self.output, 'a') if self.output else printer
+        try:
+            for records in self._iter_records():
+                for record in records:
+                    fileh.write(json.dumps(record, sort_keys=True) + '\n')
+                fileh.flush()
+        finally:
+            if self.output:
+                fileh.close()
+
+
+class SqliteReporter(ExportReporter):
+    """
+    Export the test results into the "results" table of an SQLite database,
+    one row per record, with the logs as a JSON list.
+    """
+    # pylint: disable=too-few-public-methods
+    TYPE = 'sqlite'
 
-        mailserver = smtplib.SMTP(self.smtp_url)
+    def report(self):
+        """Insert the records into the database at the output path."""
+        import sqlite3
 
-        # Enable SMTP debugging if skt is running in verbose mode.
-        mailserver.set_debuglevel(self.debug)
+        names = [name for (name, _) in EXPORT_FIELDS]
+        insert = 'INSERT INTO results ({}) VALUES ({})'.format(
+            ', '.join(names), ', '.join('?' * len(names))
+        )
 
-        mailserver.sendmail(self.mailfrom,
-                            self.mailto + self.mailcc + self.mailbcc,
-                            msg.as_string())
-        mailserver.quit()
+        connection = sqlite3.connect(self.output)
+        try:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS results ({})'.format(
+                    ', '.join('{} {}'.format(name, column_type)
+                              for (name, column_type) in EXPORT_FIELDS)
+                )
+            )
+            # Commit after each state file, so the rows show up as the
+            # results come in.
+            for records in self._iter_records():
+                connection.executemany(insert, [
+                    [json.dumps(record[name]) if name == 'logs'
+                     else record[name] for name in names]
+                    for record in records
+                ])
+                connection.commit()
+        finally:
+            connection.close()
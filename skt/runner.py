@@ -36,7 +36,7 @@ class Runner(object):
 
     @abstractmethod
     def run(self, url, max_aborted, release, wait=False,
-            arch=platform.machine()):
+            arch=platform.machine(), kpkg_format='targz'):
         """
         Abstract method, override this to run tests in <implement. specific>
 
@@ -51,6 +51,8 @@ class Runner(object):
                          in a format accepted by Beaker. Defaults to
                          architecture of the current machine skt is running on
                          if not specified.
+            kpkg_format: Format of the kernel tarball, e.g. "tarxz", see
+                         skt.kernelbuilder.PACKAGE_FORMATS.
 
         Returns:
             ret where ret can be
@@ -374,23 +376,10 @@ class BeakerRunner(Runner):
                             self.__add_to_watchlist(newjobid)
                         continue
 
-                    # Something in the recipe set really reported failure
-                    test_failure = False
-
-                    if self.get_kpkginstall_task(recipe) is None:
-                        # Assume the kernel was installed by default and
-                        # everything is a test
-                        test_failure = True
-                    else:
-                        test_list = self.get_recipe_test_list(recipe)
-
-                        for task in recipe.findall('task'):
-                            if task.attrib.get('result') != 'Pass':
-                                if task.attrib.get('name') in test_list:
-                                    test_failure = True
-                                break
-
-                    if not test_failure:
+                    # Something in the recipe set really reported failure,
+                    # was it a test or something before the kernel was
+                    # installed?
+                    if not self.summarize_recipe(recipe)['test_failure']:
                         # Recipe failed before the tested kernel was installed
                         self.__forget_taskspec(recipe_set_id)
                         self.aborted_count += 1
@@ -430,11 +419,8 @@ class BeakerRunner(Runner):
 
     def get_recipe_test_list(self, recipe_node):
         """
-        Retrieve the list of tests which ran for a particular recipe. All tasks
-        after kpkginstall (including the kpkginstall task itself), which were
-        not skipped, are interpreted as ran tests. If the kpkginstall task
-        doesn't exist, assume every task is a test and the kernel was installed
-        by default.
+        Retrieve the list of tests which ran for a particular recipe, see
+        summarize_recipe().
 
         Args:
             recipe_node: ElementTree node representing the recipe, extracted
@@ -443,20 +429,138 @@ class BeakerRunner(Runner):
         Returns:
             List of test names that ran.
         """
-        test_list = []
-        after_kpkg = True if self.get_kpkginstall_task(recipe_node) is None \
-            else False
+        return self.summarize_recipe(recipe_node)['tests']
 
-        for test_task in recipe_node.findall('task'):
-            fetch = test_task.find('fetch')
-            if fetch is not None and \
-                    'kpkginstall' in fetch.attrib.get('url', ''):
-                after_kpkg = True
+    @classmethod
+    def summarize_recipe(cls, recipe_node):
+        """
+        Summarize the results of a recipe, looking at each of its tasks only
+        once. All tasks after kpkginstall (including the kpkginstall task
+        itself), which were not skipped, are interpreted as ran tests. If the
+        kpkginstall task doesn't exist, assume every task is a test and the
+        kernel was installed by default.
+
+        Args:
+            recipe_node: ElementTree node representing the recipe, extracted
+                         from Beaker XML or result XML.
+
+        Returns:
+            A dictionary with the recipe 'id', 'arch', 'result' and 'status',
+            the 'kpkginstall' task node (None if there is no such task), the
+            names of the 'tests' which ran, the 'tasks' which ran and the
+            'passed_tasks', the 'failed_tasks' and the 'aborted_tasks' among
+            them, and 'test_failure', True if the first task which didn't
+            pass is a test. Each task is a dictionary with its 'name',
+            'result', 'status', 'duration' and the 'url' of its git source,
+            and the failed ones with the URLs of their 'logs', including the
+            console log for a kernel panic.
+        """
+        arch_node = recipe_node.find('hostRequires/and/arch')
+        summary = {
+            'id': recipe_node.attrib.get('id'),
+            'arch': (arch_node.attrib.get('value')
+                     if arch_node is not None else None),
+            'result': recipe_node.attrib.get('result'),
+            'status': recipe_node.attrib.get('status'),
+            'kpkginstall': None,
+            'tests': [],
+            'tasks': [],
+            'passed_tasks': [],
+            'failed_tasks': [],
+            'aborted_tasks': [],
+            'test_failure': False,
+        }
+
+        # The tasks which ran before and after kpkginstall, with their git
+        # sources
+        before_kpkg = []
+        after_kpkg = []
+        first_failure_is_test = False
+        failure_found = False
+        for task in recipe_node.findall('task'):
+            fetch = task.find('fetch')
+            url = fetch.attrib.get('url') if fetch is not None else ''
+            if summary['kpkginstall'] is None and \
+                    'kpkginstall' in (url or ''):
+                summary['kpkginstall'] = task
+
+            ran = task.attrib.get('result') != 'Skip'
+            if not failure_found and task.attrib.get('result') != 'Pass':
+                failure_found = True
+                first_failure_is_test = \
+                    ran and summary['kpkginstall'] is not None
+
+            if ran:
+                if summary['kpkginstall'] is None:
+                    before_kpkg.append((task, url))
+                else:
+                    after_kpkg.append((task, url))
+
+        if summary['kpkginstall'] is None:
+            # Assume the kernel was installed by default and everything is a
+            # test.
+            tests = before_kpkg
+            summary['test_failure'] = True
+        else:
+            tests = after_kpkg
+            summary['test_failure'] = first_failure_is_test
+
+        for (task, url) in tests:
+            result = task.attrib.get('result')
+            task_data = {
+                'name': task.attrib.get('name'),
+                'url': url,
+                'result': result,
+                'status': task.attrib.get('status'),
+                'duration': task.attrib.get('duration'),
+            }
+            summary['tests'].append(task_data['name'])
+            summary['tasks'].append(task_data)
+
+            if result == 'Pass':
+                summary['passed_tasks'].append(task_data)
+            elif result == 'Warn' and task_data['status'] == 'Aborted':
+                summary['aborted_tasks'].append(task_data)
+            else:
+                logs = cls.__get_failed_task_logs(task)
+                # If the task caused a kernel panic, add a link to the console
+                # log since that's the one containing the actual trace.
+                if result == 'Panic':
+                    console = recipe_node.find(
+                        "logs/log[@name='console.log']")
+                    if console is not None:
+                        logs.append(console.attrib.get('href'))
+                task_data['logs'] = logs
+                summary['failed_tasks'].append(task_data)
+
+        return summary
+
+    @classmethod
+    def __get_failed_task_logs(cls, task_node):
+        """
+        Get logs from a failed task and its subtasks which didn't pass.
+
+        Args:
+            task_node:  ElementTree node representing the task.
+
+        Returns:
+            A list of log file URLs.
+        """
+        useless_logs = ['harness.log', 'setup.log']
+
+        # Get the logs from the main task.
+        task_logs = [
+            log.attrib.get('href') for log in task_node.findall('logs/log')
+            if log.attrib.get('name') not in useless_logs
+        ]
 
-            if after_kpkg and test_task.attrib.get('result') != 'Skip':
-                test_list.append(test_task.attrib.get('name'))
+        # If this task has subtasks, get those as well.
+        for subtask in task_node.findall('results/result'):
+            if subtask.attrib.get('result') != 'Pass':
+                task_logs += [log.attrib.get('href')
+                              for log in subtask.findall('logs/log')]
 
-        return test_list
+        return task_logs
 
     @classmethod
     def get_kpkginstall_task(cls, recipe_node):
@@ -504,7 +608,7 @@ class BeakerRunner(Runner):
         return jobid
 
     def run(self, url, max_aborted, release, wait=False,
-            arch=platform.machine()):
+            arch=platform.machine(), kpkg_format='targz'):
         """
         Run tests in Beaker.
 
@@ -519,6 +623,8 @@ class BeakerRunner(Runner):
                          in a format accepted by Beaker. Defaults to
                          architecture of the current machine skt is running on
                          if not specified.
+            kpkg_format: Format of the kernel tarball, e.g. "tarxz", see
+                         skt.kernelbuilder.PACKAGE_FORMATS.
 
         Returns:
             ret where ret can be
@@ -540,6 +646,7 @@ class BeakerRunner(Runner):
             job_xml_tree = fromstring(self.__getxml(
                 {'KVER': release,
                  'KPKG_URL': url,
+                 'KPKG_FORMAT': kpkg_format,
                  'ARCH': arch}
             ))
             for recipe in job_xml_tree.findall('recipeSet/recipe'):
@@ -13,64 +13,408 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """Functions that manage the skt state file."""
 import ConfigParser
+import contextlib
+import fcntl
+import json
 import os
+import stat
+import tempfile
 
+# Version of the state format, stored in the state section
+STATE_VERSION = 2
+STATE_VERSION_KEY = 'state_version'
+# Prefixes of the numbered keys old state files flattened lists into, and
+# the names of the lists
+LEGACY_LIST_PREFIXES = [
+    ('jobid_', 'jobs'),
+    ('recipesetid_', 'recipe_sets'),
+    ('mergerepo_', 'mergerepos'),
+    ('mergehead_', 'mergeheads'),
+    ('localpatch_', 'localpatches'),
+    ('patchwork_', 'patchworks'),
+]
+# Lists old state files were read into sets
+LEGACY_SET_NAMES = ['jobs', 'recipe_sets']
 
-def get_state(state_file, state_key):
+# Pending updates of state files with an open transaction, by path
+_TRANSACTIONS = {}
+# Parsed state files, by path: (signature, ConfigParser, StateValues)
+_CACHE = {}
+
+
+def get_lock_path(state_file):
     """
-    Read and return a value from the state file for a specified key.
+    Get the path of the lock file protecting a state file.
 
     Args:
         state_file: Path to a state file.
-        state_key:  The key for a desired value in the state file.
 
     Returns:
-        Value from the state file for the corresponding key. The value type
-        will be the same as what was set when the value was stored.
+        Path to the lock file.
+    """
+    return state_file + '.lock'
 
+
+@contextlib.contextmanager
+def lock_state(state_file):
     """
-    config = ConfigParser.RawConfigParser()
+    Lock a state file against concurrent updates, e.g. from other skt
+    processes, for the duration of the context.
 
-    # Does this state file exist?
-    if not os.path.isfile(state_file):
-        return None
+    Args:
+        state_file: Path to a state file.
+    """
+    with open(get_lock_path(state_file), 'a') as lockfile:
+        fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
 
-    # Read the state file
-    config.read(state_file)
 
-    # Check if the state file has a 'state' section.
-    if not config.has_section("state"):
-        return None
+def write_state_file(state_file, config):
+    """
+    Atomically replace a state file: write a temporary file next to it, sync
+    it to the disk and rename it over the original. A crash can't leave a
+    truncated state file behind.
 
-    # Get the value from the state file.
+    Args:
+        state_file: Path to a state file.
+        config:     The ConfigParser object to write.
+    """
+    directory = os.path.dirname(os.path.abspath(state_file))
+    (fdesc, tmppath) = tempfile.mkstemp(
+        dir=directory, prefix='.{}.'.format(os.path.basename(state_file))
+    )
     try:
-        return config.get('state', state_key)
-    except ConfigParser.NoOptionError:
-        return None
+        with os.fdopen(fdesc, 'w') as fileh:
+            config.write(fileh)
+            fileh.flush()
+            os.fsync(fileh.fileno())
+
+        # Keep the mode of the original file, or use the default one.
+        if os.path.isfile(state_file):
+            mode = stat.S_IMODE(os.stat(state_file).st_mode)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(tmppath, mode)
+
+        os.rename(tmppath, state_file)
+    except Exception:
+        os.unlink(tmppath)
+        raise
+
+    # Make the rename itself durable.
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+@contextlib.contextmanager
+def state_transaction(state_file):
+    """
+    Batch updates of a state file. Updates made with update_state() inside
+    the context are kept in memory, and written to the state file at once
+    when the context is left, even if it's left with an exception.
+    Transactions can be nested, the outermost one writes the updates.
+
+    Args:
+        state_file: Path to a state file.
+    """
+    if state_file in _TRANSACTIONS:
+        yield
+        return
+
+    _TRANSACTIONS[state_file] = {}
+    try:
+        yield
+    finally:
+        pending = _TRANSACTIONS.pop(state_file)
+        if pending:
+            update_state(state_file, pending)
+
+
+def to_native(value):
+    """
+    Convert unicode strings in a decoded JSON value to native strings, as
+    the rest of skt expects.
+
+    Args:
+        value:  The decoded value.
+
+    Returns:
+        The value with all unicode strings encoded as UTF-8.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [to_native(item) for item in value]
+    if isinstance(value, dict):
+        return {to_native(key): to_native(item)
+                for (key, item) in value.items()}
+    return value
+
+
+def decode_value(value):
+    """
+    Decode a raw value of a current state file. A value which isn't valid
+    JSON, e.g. edited by hand, is taken as a plain string.
+
+    Args:
+        value:  The raw value.
+
+    Returns:
+        The decoded value.
+    """
+    try:
+        return to_native(json.loads(value))
+    except ValueError:
+        return value
+
+
+def get_state_items(config):
+    """
+    Get the raw items of the state section of a parsed state file.
+
+    Args:
+        config: A RawConfigParser or ConfigParser object with the state file
+                read.
+
+    Returns:
+        A list of (name, raw value) tuples, empty if there's no state.
+    """
+    if not config.has_section('state'):
+        return []
+    # Get the values without interpolation, which ConfigParser would do.
+    if isinstance(config, ConfigParser.ConfigParser):
+        return config.items('state', raw=True)
+    return config.items('state')
+
+
+def decode_state(items):
+    """
+    Decode the state section of a parsed state file. Values are stored as
+    JSON since state version 2. Older state files, with plain string values
+    and lists flattened into numbered keys (e.g. "jobid_01"), are converted:
+    the numbered keys are replaced by lists (or sets) under the names used
+    by the current format, and "retcode" is converted to an integer.
+
+    Args:
+        items:  A list of (name, raw value) tuples of the state section.
+
+    Returns:
+        A dictionary of state values.
+    """
+    if any(name == STATE_VERSION_KEY for (name, _) in items):
+        return {name: decode_value(value) for (name, value) in items
+                if name != STATE_VERSION_KEY}
+
+    state = {}
+    lists = {}
+    for (name, value) in items:
+        for (prefix, list_name) in LEGACY_LIST_PREFIXES:
+            if name.startswith(prefix):
+                if list_name in LEGACY_SET_NAMES:
+                    lists.setdefault(list_name, set()).add(value)
+                else:
+                    lists.setdefault(list_name, list()).append(value)
+                break
+        else:
+            state[name] = value
+    # Don't let plain values override the collected lists.
+    state.update(lists)
+
+    if 'retcode' in state:
+        state['retcode'] = int(state['retcode'])
+
+    return state
+
+
+def encode_state(config, state):
+    """
+    Store state values into the state section of a state file, replacing
+    the section, in the current format.
+
+    Args:
+        config: A RawConfigParser object to store the state into.
+        state:  A dictionary of state values, JSON-serializable except sets,
+                which are stored as sorted lists.
+    """
+    def default(value):
+        """Serialize sets."""
+        if isinstance(value, (set, frozenset)):
+            return sorted(value)
+        raise TypeError("{!r} can't be stored in the state".format(value))
+
+    config.remove_section('state')
+    config.add_section('state')
+    config.set('state', STATE_VERSION_KEY, STATE_VERSION)
+    for (key, val) in sorted(state.items()):
+        config.set('state', key, json.dumps(val, default=default,
+                                            sort_keys=True))
+
+
+class StateValues(object):
+    """
+    Values of a parsed state file, each decoded on its first access, so
+    getting a few values doesn't decode all of them. Decoded values are
+    shared by all users of the same parsed state file.
+    """
+
+    def __init__(self, items):
+        """
+        Initialize state values.
+
+        Args:
+            items:  A list of (name, raw value) tuples of the state section.
+        """
+        self.__names = [name for (name, _) in items
+                        if name != STATE_VERSION_KEY]
+        if any(name == STATE_VERSION_KEY for (name, _) in items):
+            self.__raw = dict(items)
+            self.__values = {}
+        else:
+            # Old state files need all values to collect the lists.
+            self.__raw = {}
+            self.__values = decode_state(items)
+            self.__names = list(self.__values)
+
+    def __contains__(self, name):
+        return name in self.__values or name in self.__raw
+
+    def get(self, name, default=None):
+        """
+        Get a state value.
+
+        Args:
+            name:       Name of the value.
+            default:    Value to return if the state doesn't have it.
+
+        Returns:
+            The decoded value.
+        """
+        if name not in self.__values and name in self.__raw:
+            self.__values[name] = decode_value(self.__raw[name])
+        return self.__values.get(name, default)
+
+    def keys(self):
+        """
+        Get names of all state values.
+
+        Returns:
+            A list of names.
+        """
+        return list(self.__names)
+
+    def items(self):
+        """
+        Get all state values, decoding them.
+
+        Returns:
+            A list of (name, value) tuples.
+        """
+        return [(name, self.get(name)) for name in self.__names]
+
+
+def read_state_file(state_file):
+    """
+    Parse a state file, or get it from the cache of parsed state files if it
+    didn't change since it was parsed. A state file is considered changed if
+    its modification time, size or inode differ, state updates replace the
+    file with a new one.
+
+    Args:
+        state_file: Path to a state file.
+
+    Returns:
+        A tuple of the ConfigParser object with the state file read, and its
+        StateValues. Both are shared, don't modify them.
+    """
+    try:
+        stat_result = os.stat(state_file)
+        signature = (stat_result.st_mtime, stat_result.st_size,
+                     stat_result.st_ino)
+    except OSError:
+        signature = None
+
+    cached = _CACHE.get(state_file)
+    if signature and cached and cached[0] == signature:
+        return cached[1:]
+
+    config = ConfigParser.ConfigParser()
+    config.read(state_file)
+    values = StateValues(get_state_items(config))
+
+    if signature:
+        _CACHE[state_file] = (signature, config, values)
+    return (config, values)
+
+
+def load_state(state_file):
+    """
+    Load all values from the state file.
+
+    Args:
+        state_file: Path to a state file.
+
+    Returns:
+        A dictionary of state values, empty if the state file doesn't exist.
+    """
+    state = dict(read_state_file(state_file)[1].items())
+    state.update(_TRANSACTIONS.get(state_file, {}))
+    return state
+
+
+def get_state(state_file, state_key):
+    """
+    Read and return a value from the state file for a specified key.
+
+    Args:
+        state_file: Path to a state file.
+        state_key:  The key for a desired value in the state file.
+
+    Returns:
+        Value from the state file for the corresponding key, with the type
+        it was stored with, or None if it's missing.
+    """
+    # Is the value waiting to be written in a transaction?
+    if state_key in _TRANSACTIONS.get(state_file, {}):
+        return _TRANSACTIONS[state_file][state_key]
+
+    return read_state_file(state_file)[1].get(state_key)
 
 
 def update_state(state_file, state_dict):
     """
-    Write updated state information to the state file.
+    Write updated state information to the state file. Inside a
+    state_transaction() the update is only written when the transaction
+    ends.
 
     Args:
         state_file: Path to state file.
         state_dict: A dictionary of key/value pairs to update in statefile.
+                    The values keep their types, e.g. lists, dictionaries
+                    and integers.
     """
-    config = ConfigParser.RawConfigParser()
+    if state_file in _TRANSACTIONS:
+        _TRANSACTIONS[state_file].update(state_dict)
+        return
 
-    # If the state file exists, read its current values.
-    if os.path.isfile(state_file):
-        config.read(state_file)
+    with lock_state(state_file):
+        config = ConfigParser.RawConfigParser()
 
-    # Add a 'state' section if it doesn't exist already.
-    if not config.has_section("state"):
-        config.add_section("state")
+        # If the state file exists, read its current values, keeping the
+        # other sections.
+        if os.path.isfile(state_file):
+            config.read(state_file)
 
-    # Iterate over the state_dict and update key/value pairs.
-    for (key, val) in state_dict.iteritems():
-        config.set('state', key, val)
+        state = decode_state(get_state_items(config))
+        state.update(state_dict)
+        encode_state(config, state)
 
-    # Write the update state file to disk.
-    with open(state_file, 'w') as fileh:
-        config.write(fileh)
+        # Write the update state file to disk.
+        write_state_file(state_file, config)
@@ -0,0 +1,99 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General Public
+# License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Test cases for artifact_cache module."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from skt import artifact_cache
+
+
+class TestArtifactCache(unittest.TestCase):
+    """Test cases for artifact_cache.ArtifactCache class."""
+
+    def setUp(self):
+        """Test fixtures."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        """Tear down test fixtures."""
+        shutil.rmtree(self.tmpdir)
+
+    def make_tarball(self, name, size):
+        """Create a fake tarball of the given size."""
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as fileh:
+            fileh.write(b'x' * size)
+        return path
+
+    def test_get_build_key(self):
+        """Ensure the build key depends on all inputs and their order."""
+        key = artifact_cache.get_build_key('tree', 'config', 'x86_64')
+        self.assertEqual(64, len(key))
+        self.assertEqual(
+            key, artifact_cache.get_build_key('tree', 'config', 'x86_64')
+        )
+        self.assertNotEqual(
+            key, artifact_cache.get_build_key('tree', 'config', 's390x')
+        )
+        self.assertNotEqual(
+            artifact_cache.get_build_key('ab', 'c'),
+            artifact_cache.get_build_key('a', 'bc')
+        )
+
+    def test_store_lookup(self):
+        """Ensure a stored tarball is found with its metadata."""
+        cache = artifact_cache.ArtifactCache(self.cachedir)
+        tarball = self.make_tarball('abc.tar.gz', 10)
+
+        self.assertIsNone(cache.lookup('key'))
+        cached = cache.store('key', tarball, krelease='4.17.0')
+        self.assertEqual(os.path.join(self.cachedir, 'key.tar.gz'), cached)
+
+        metadata = cache.lookup('key')
+        self.assertEqual(cached, metadata['path'])
+        self.assertEqual('4.17.0', metadata['krelease'])
+        self.assertEqual(10, metadata['size'])
+
+        cache.update('key', buildurl='http://a/abc.tar.gz')
+        self.assertEqual('http://a/abc.tar.gz',
+                         cache.lookup('key')['buildurl'])
+
+    def test_lookup_missing_tarball(self):
+        """Ensure entries without their tarball are not returned."""
+        cache = artifact_cache.ArtifactCache(self.cachedir)
+        cached = cache.store('key', self.make_tarball('abc.tar.xz', 10))
+        os.unlink(cached)
+
+        self.assertIsNone(cache.lookup('key'))
+
+    def test_evict(self):
+        """Ensure least-recently used entries are evicted over the limit."""
+        cache = artifact_cache.ArtifactCache(self.cachedir, max_size=25)
+        first = cache.store('first', self.make_tarball('a.tar.gz', 10))
+        second = cache.store('second', self.make_tarball('b.tar.gz', 10))
+
+        # Make the first entry the most recently used one.
+        metadata_path = os.path.join(self.cachedir, 'second.json')
+        os.utime(metadata_path, (0, 0))
+        cache.lookup('first')
+
+        cache.store('third', self.make_tarball('c.tar.gz', 10))
+
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertIsNone(cache.lookup('second'))
+        self.assertIsNotNone(cache.lookup('third'))
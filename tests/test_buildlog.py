@@ -0,0 +1,236 @@
+# Copyright (c) 2018 Red Hat, Inc. All rights reserved. This copyrighted
+# material is made available to anyone wishing to use, modify, copy, or
+# redistribute it subject to the terms and conditions of the GNU General Public
+# License v.2 or later.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""Test cases for buildlog module."""
+import errno
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from StringIO import StringIO
+
+import mock
+
+from skt import buildlog
+
+
+class TestBuildLogTee(unittest.TestCase):
+    """Test cases for buildlog.BuildLogTee class."""
+
+    def setUp(self):
+        """Test fixtures."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.logpath = "{}/build.log".format(self.tmpdir)
+
+    def tearDown(self):
+        """Tear down test fixtures."""
+        shutil.rmtree(self.tmpdir)
+
+    def test_tee(self):
+        """Ensure process output goes to the log, echo and matchers."""
+        echo = StringIO()
+        matcher = buildlog.LogMatcher(buildlog.TARBALL_REGEX, first_only=True)
+        output = 'foo\nTarball successfully created in ./a.tar.gz\nbar\n'
+
+        with buildlog.BuildLogTee(self.logpath, [matcher], echo) as tee:
+            subprocess.check_call(['printf', output], stdout=tee.fileno())
+            subprocess.check_call(['printf', output], stdout=tee.fileno())
+
+        with open(self.logpath, 'r') as fileh:
+            self.assertEqual(output * 2, fileh.read())
+        self.assertEqual(output * 2, echo.getvalue())
+
+        # Only the first match is kept, with the offset of its line.
+        self.assertEqual(1, len(matcher.matches))
+        self.assertEqual(4, matcher.matches[0][0])
+        self.assertEqual('./a.tar.gz', matcher.first().group('path'))
+
+    def test_tee_inherited(self):
+        """Ensure other processes don't inherit the pipe of the tee."""
+        tee = buildlog.BuildLogTee(self.logpath, echo=StringIO())
+        tee.open()
+        with open(os.devnull, 'w') as devnull:
+            sleeper = subprocess.Popen(['sleep', '60'], stdout=devnull)
+        try:
+            closer = threading.Thread(target=tee.close)
+            closer.daemon = True
+            closer.start()
+            closer.join(10)
+            self.assertFalse(closer.is_alive())
+        finally:
+            sleeper.kill()
+            sleeper.wait()
+
+    def test_tee_write_error(self):
+        """Ensure the pipe is drained and the error raised on failure."""
+        echo = mock.Mock()
+        echo.write.side_effect = IOError(errno.ENOSPC, 'No space left')
+
+        tee = buildlog.BuildLogTee(self.logpath, echo=echo)
+        tee.open()
+        # More output than fits into the pipe
+        subprocess.check_call(['sh', '-c', 'yes | head -n 100000'],
+                              stdout=tee.fileno())
+        with self.assertRaises(IOError):
+            tee.close()
+        echo.write.assert_called_once()
+
+    def test_tee_compressed(self):
+        """Ensure the log can be written as a series of gzip members."""
+        echo = StringIO()
+        output = 'first line\nsecond line\n'
+
+        with buildlog.BuildLogTee(self.logpath, echo=echo,
+                                  compress=True) as tee:
+            subprocess.check_call(['printf', output], stdout=tee.fileno())
+
+        with gzip.open(self.logpath, 'rb') as fileh:
+            self.assertEqual(output, fileh.read())
+        self.assertEqual(output, echo.getvalue())
+        self.assertEqual([(0, 0)], tee.members)
+
+    def test_gzip_log_writer(self):
+        """Ensure each member can be decompressed on its own."""
+        writer = buildlog.GzipLogWriter(self.logpath, member_size=10)
+        lines = ['line {}\n'.format(idx) for idx in range(10)]
+        for line in lines:
+            writer.write(line)
+        writer.close()
+
+        # A member is finished once it holds at least 10 bytes.
+        self.assertEqual(5, len(writer.members))
+        with open(self.logpath, 'rb') as fileh:
+            for (idx, (offset, compressed)) in enumerate(writer.members):
+                fileh.seek(compressed)
+                member = gzip.GzipFile(fileobj=fileh, mode='rb')
+                self.assertEqual(''.join(lines[idx * 2:]), member.read())
+                self.assertEqual(len(''.join(lines[:idx * 2])), offset)
+
+    def test_matcher_no_match(self):
+        """Ensure LogMatcher.first() returns None without matches."""
+        matcher = buildlog.LogMatcher(buildlog.COMPILER_ERROR_REGEX)
+        matcher.feed('  CC      kernel/fork.o', 0)
+        self.assertIsNone(matcher.first())
+
+
+class TestBuildLogIndex(unittest.TestCase):
+    """Test cases for buildlog.BuildLogIndex class and index functions."""
+
+    def setUp(self):
+        """Test fixtures."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.logpath = "{}/build.log".format(self.tmpdir)
+        self.log = [
+            '  CC      fs/ext4/inode.o',
+            '  CC [M]  fs/ext4/super.o',
+            'fs/ext4/super.c:10:5: warning: unused variable \'x\'',
+            '  CC      kernel/fork.o',
+            'kernel/fork.c:42:1: error: expected \';\' before \'}\' token',
+            ' }',
+            ' ^',
+            'make[2]: *** [scripts/Makefile.build:304: kernel/fork.o] '
+            'Error 1',
+            'make[1]: *** [Makefile:1060: kernel] Error 2',
+        ]
+        with open(self.logpath, 'w') as fileh:
+            fileh.write('\n'.join(self.log) + '\n')
+
+    def tearDown(self):
+        """Tear down test fixtures."""
+        shutil.rmtree(self.tmpdir)
+
+    def make_index(self):
+        """Index self.log and return the index dictionary."""
+        index = buildlog.BuildLogIndex()
+        offset = 0
+        for line in self.log:
+            index.feed(line, offset)
+            offset += len(line) + 1
+        return index
+
+    def test_index(self):
+        """Ensure errors, the failed target and directories are indexed."""
+        index = self.make_index().to_dict()
+        error_offset = len('\n'.join(self.log[:4])) + 1
+
+        self.assertEqual(os.path.getsize(self.logpath), index['size'])
+        self.assertEqual(1, len(index['warnings']))
+        self.assertEqual([{'offset': error_offset,
+                           'file': 'kernel/fork.c',
+                           'line': 42,
+                           'message': self.log[4]}],
+                         index['errors'])
+        self.assertEqual('kernel/fork.o', index['failed_target']['target'])
+        self.assertEqual('scripts/Makefile.build:304',
+                         index['failed_target']['makefile'])
+        self.assertEqual(2, index['directories']['fs/ext4']['steps'])
+        self.assertIn('kernel', index['directories'])
+        self.assertIsNone(index['tarball'])
+
+    def test_write_load(self):
+        """Ensure an index survives writing and loading."""
+        index = self.make_index()
+        indexpath = buildlog.get_index_path(self.logpath)
+        index.write(indexpath)
+
+        self.assertEqual(index.to_dict(), buildlog.load_index(indexpath))
+        self.assertIsNone(buildlog.load_index(self.logpath))
+        self.assertIsNone(buildlog.load_index('/nonexistent'))
+
+    def test_error_excerpt(self):
+        """Ensure the excerpt is taken from around the first error."""
+        index = self.make_index().to_dict()
+        excerpt = buildlog.get_error_excerpt(self.logpath, index, before=1,
+                                             after=2)
+        self.assertEqual('\n'.join(self.log[3:7]) + '\n', excerpt)
+
+        index['errors'] = []
+        excerpt = buildlog.get_error_excerpt(self.logpath, index, before=0,
+                                             after=0)
+        self.assertEqual(self.log[7] + '\n', excerpt)
+
+        index['failed_target'] = None
+        self.assertIsNone(buildlog.get_error_excerpt(self.logpath, index))
+
+    def test_error_excerpt_compressed(self):
+        """Ensure the excerpt can be taken from a compressed log."""
+        index = self.make_index()
+        writer = buildlog.GzipLogWriter(self.logpath + '.gz', member_size=50)
+        for line in self.log:
+            writer.write(line + '\n')
+        writer.close()
+        index.members = writer.members
+        index = index.to_dict()
+
+        self.assertGreater(len(index['members']), 2)
+        excerpt = buildlog.get_error_excerpt(self.logpath + '.gz', index,
+                                             before=1, after=2)
+        self.assertEqual('\n'.join(self.log[3:7]) + '\n', excerpt)
+
+        # Reading starts at the member right before the offset.
+        content = '\n'.join(self.log) + '\n'
+        offset = index['members'][2][0] + 5
+        with buildlog.open_log(self.logpath + '.gz', offset, index) as fileh:
+            self.assertEqual(content[offset:], fileh.read())
+
+        # Without the members, the log is decompressed from its start.
+        index['members'] = None
+        with buildlog.open_log(self.logpath + '.gz', offset, index) as fileh:
+            self.assertEqual(content[offset:], fileh.read())
+        excerpt = buildlog.get_error_excerpt(self.logpath + '.gz', index,
+                                             before=1, after=2)
+        self.assertEqual('\n'.join(self.log[3:7]) + '\n', excerpt)
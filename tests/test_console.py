@@ -13,8 +13,10 @@
 # Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """Test cases for console checker module."""
 import gzip
+import os
 import re
 import StringIO
+import tempfile
 import unittest
 
 from contextlib import contextmanager
@@ -24,6 +26,25 @@ from skt import console
 from tests import misc
 
 
+class TestConsoleFunctions(unittest.TestCase):
+    """Test cases for the functions in skt.console."""
+
+    @mock.patch('skt.console.GZIP_CHUNK_SIZE', 1000)
+    @mock.patch('skt.console.GZIP_SPOOL_SIZE', 1000)
+    def test_gzipfile(self):
+        """Ensure gzipfile() compresses a file in a spooled file."""
+        data = os.urandom(5000)
+        with tempfile.NamedTemporaryFile() as source:
+            source.write(data)
+            source.flush()
+            compressed = console.gzipfile(source.name)
+
+        # The compressed data was spooled to the disk
+        self.assertTrue(compressed._rolled)
+        with gzip.GzipFile(fileobj=compressed, mode="r") as fileh:
+            self.assertEqual(data, fileh.read())
+
+
 class TestConsoleLog(unittest.TestCase):
     """Test cases for console.ConsoleLog class."""
 
@@ -13,8 +13,13 @@
 # Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """Test cases for runner module."""
 import logging
+import json
 import os
+import shutil
+import stat
+import subprocess
 import sys
+import tempfile
 import unittest
 
 from io import BytesIO
@@ -24,11 +29,21 @@ import mock
 
 from skt import executable
 
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+
 
 class TestExecutable(unittest.TestCase):
     """Test cases for executable module."""
 
     # pylint: disable=too-many-public-methods
+    def setUp(self):
+        """Set up test fixtures."""
+        self.junitdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures."""
+        shutil.rmtree(self.junitdir)
+
     def check_args_tester(self, args, expected_fail=True,
                           expected_stdout=None, expected_stderr=None):
         """Reusable method to test the check_args() method."""
@@ -69,12 +84,30 @@ class TestExecutable(unittest.TestCase):
         parser = executable.setup_parser()
         args = parser.parse_args(testing_args)
 
-        with mock_open:
+        # Don't use state files parsed by other tests.
+        with mock_open, mock.patch.dict('skt.state_file._CACHE', clear=True):
             cfg = executable.load_config(args)
 
         self.assertTrue(isinstance(cfg, dict))
         return cfg
 
+    def test_lazy_imports(self):
+        """
+        Ensure importing the executable doesn't import the dependencies
+        needed only by some of the commands, to keep startup fast.
+        """
+        lazy_modules = ['junit_xml', 'jinja2', 'requests', 'defusedxml',
+                        'smtplib', 'email', 'skt.console', 'skt.publisher',
+                        'skt.reporter', 'skt.runner']
+        # Check in a new interpreter, as the tests import everything.
+        script = ('import sys\n'
+                  'import skt.executable\n'
+                  'print(",".join(sorted(set({}) & set(sys.modules))))'
+                  .format(lazy_modules))
+        imported = subprocess.check_output([sys.executable, '-c', script],
+                                           cwd=os.path.dirname(SCRIPT_PATH))
+        self.assertEqual('', imported.strip())
+
     def test_full_path_relative(self):
         """Verify that full_path() expands a relative path."""
         filename = "somefile"
@@ -171,6 +204,19 @@ class TestExecutable(unittest.TestCase):
         self.assertEqual('bar', cfg['foo'])
         self.assertEqual('report', cfg['_name'])
 
+    def test_load_config_artifact_cache(self):
+        """Ensure load_config() makes the artifact cache paths absolute."""
+        config_file = [
+            '[state]',
+            'cached_tarpkg=cache/ab/linux.tar.gz',
+        ]
+        args = ['--rc', '/tmp/testing.ini', '--state', 'build',
+                '--artifact-cache', '~/cache']
+        cfg = self.load_config_tester(config_file, args)
+        self.assertEqual(os.path.expanduser('~/cache'), cfg['artifact_cache'])
+        self.assertEqual(os.path.abspath('cache/ab/linux.tar.gz'),
+                         cfg['cached_tarpkg'])
+
     def test_load_config_reporter_args(self):
         """Test load_config() with reporter arguments."""
         config_file = []
@@ -275,20 +321,134 @@ class TestExecutable(unittest.TestCase):
 
         self.assertEqual(cfg, result)
 
-    @mock.patch('skt.publisher.ScpPublisher.publish')
-    def test_cmd_publish(self, mock_publish):
-        """Ensure cmd_publish() works and publisher object method."""
-        # pylint: disable=no-self-use
+    @mock.patch('skt.reporter.MailReporter.report_many')
+    def test_cmd_report_split_results(self, mock_report_many):
+        """Ensure cmd_report() reports each state file separately."""
+        cfg = {'reporter': {'type': 'mail'}, 'result': ['state1', 'state2']}
+
+        executable.cmd_report(cfg)
+        mock_report_many.assert_called_with([cfg])
+
+        cfg['split_results'] = True
+        executable.cmd_report(cfg)
+        mock_report_many.assert_called_with([
+            dict(cfg, result=['state1']),
+            dict(cfg, result=['state2']),
+        ])
+
+    @mock.patch('skt.reporter.JsonlReporter.report_many')
+    def test_cmd_report_format(self, mock_report_many):
+        """Ensure cmd_report() exports records in the requested format."""
+        cfg = {'format': 'jsonl', 'result': ['state1']}
+
+        executable.cmd_report(cfg)
+        mock_report_many.assert_called_with([cfg])
+
+    @mock.patch('skt.executable.get_state', return_value=None)
+    @mock.patch('skt.executable.update_state')
+    @mock.patch('skt.executable.KernelBuilder')
+    def test_cmd_build_failure_metrics(self, mock_builder, mock_update,
+                                       mock_get_state):
+        """Ensure cmd_build() saves the metrics of a failed build."""
+        # pylint: disable=unused-argument
+        builder = mock_builder.return_value
+        builder.metrics = {'build': {'wall': 1.5}}
+        builder.mktgz.side_effect = subprocess.CalledProcessError(2, 'make')
+        # Nothing after the failed build works either.
+        builder.get_cfgpath.side_effect = RuntimeError
+
+        try:
+            with self.assertRaises(RuntimeError):
+                executable.cmd_build({'rc': 'rc'})
+            self.assertEqual(executable.SKT_FAIL, executable.retcode)
+        finally:
+            executable.retcode = executable.SKT_SUCCESS
+
+        states = [call[0][1] for call in mock_update.call_args_list]
+        self.assertIn({'buildlog': builder.buildlog,
+                       'buildlogindex': builder.buildlogindex,
+                       'build_metrics': builder.metrics}, states)
+
+    @mock.patch('skt.executable.save_state')
+    @mock.patch('skt.publisher.ScpPublisher.publish_many')
+    def test_cmd_publish(self, mock_publish, mock_save_state):
+        """Ensure cmd_publish() publishes all artifacts together."""
         cfg = {'publisher': ['scp', 'a', 'b'], 'buildconf': 'a'}
 
-        mock_publish.return_value = "stdout"
+        mock_publish.return_value = ['b/a']
 
         executable.cmd_publish(cfg)
-        mock_publish.assert_called()
+        mock_publish.assert_called_with(['a'], executable.PUBLISH_JOBS)
+        mock_save_state.assert_called_with(cfg, {'cfgurl': 'b/a'})
 
-        cfg['tarpkg'] = 'b'
+        cfg['tarpkg'] = 'c'
+        mock_publish.return_value = ['b/a', 'b/c']
         executable.cmd_publish(cfg)
-        mock_publish.assert_called()
+        mock_publish.assert_called_with(['a', 'c'], executable.PUBLISH_JOBS)
+        mock_save_state.assert_called_with(cfg, {'cfgurl': 'b/a',
+                                                 'buildurl': 'b/c'})
+
+    @mock.patch('skt.executable.save_state')
+    @mock.patch('skt.publisher.getpublisher')
+    def test_cmd_publish_options(self, mock_getpublisher, mock_save_state):
+        """Ensure cmd_publish() passes only the options asked for."""
+        # pylint: disable=unused-argument
+        cfg = {'publisher': ['http', 'http://a', 'http://b'],
+               'buildconf': 'a'}
+        mock_getpublisher.return_value.baseurl = 'http://b'
+        mock_getpublisher.return_value.publish_many.return_value = [
+            'http://b/a'
+        ]
+
+        executable.cmd_publish(cfg)
+        mock_getpublisher.assert_called_with('http', 'http://a', 'http://b',
+                                             content_addressed=None)
+
+        cfg['multipart_upload'] = True
+        executable.cmd_publish(cfg)
+        mock_getpublisher.assert_called_with('http', 'http://a', 'http://b',
+                                             content_addressed=None,
+                                             multipart=True)
+
+        cfg['publisher'] = ['scp', 'a', 'http://b']
+        cfg['multipart_upload'] = False
+        cfg['no_verify_upload'] = True
+        executable.cmd_publish(cfg)
+        mock_getpublisher.assert_called_with('scp', 'a', 'http://b',
+                                             content_addressed=None,
+                                             verify=False)
+
+    @mock.patch('skt.executable.save_state')
+    @mock.patch('skt.publisher.ScpPublisher.publish_many')
+    def test_cmd_publish_cached(self, mock_publish, mock_save_state):
+        """Ensure cmd_publish() reuses the URL of a cached tarball."""
+        cfg = {'publisher': ['scp', 'a', 'http://b'], 'tarpkg': 'c',
+               'cached_tarpkg': 'c', 'cached_buildurl': 'http://b/c.tar.gz'}
+
+        executable.cmd_publish(cfg)
+
+        mock_publish.assert_not_called()
+        mock_save_state.assert_called_with(
+            cfg, {'buildurl': 'http://b/c.tar.gz'}
+        )
+
+        # The URL is not reused for a tarball built since.
+        mock_publish.return_value = ['http://b/e.tar.gz']
+        executable.cmd_publish(dict(cfg, tarpkg='e'))
+        mock_publish.assert_called_with(['e'], executable.PUBLISH_JOBS)
+
+        # The URL is not reused if it's not under the publisher's base URL.
+        mock_publish.return_value = ['http://d/c.tar.gz']
+        cfg['publisher'] = ['scp', 'a', 'http://d']
+        cfg['publish_jobs'] = 1
+        executable.cmd_publish(cfg)
+
+        mock_publish.assert_called_with(['c'], 1)
+
+        # The base URL has to match a whole path component.
+        cfg['publisher'] = ['scp', 'a', 'http://b/c']
+        executable.cmd_publish(cfg)
+        mock_publish.assert_called_with(['c'], 1)
 
     def test_addtstamp(self):
         """Ensure addtstamp works."""
@@ -328,7 +488,8 @@ class TestExecutable(unittest.TestCase):
             cfg['called'] = True
             return cfg
 
-        cfg = {'junit': 'whatever', '_testcases': ['test_setup_logging']}
+        cfg = {'junit': self.junitdir, '_name': 'test',
+               '_testcases': []}
         func_wrapper = executable.junit(test_func)
         func_wrapper(cfg)
         self.assertTrue(cfg['called'])
@@ -342,7 +503,8 @@ class TestExecutable(unittest.TestCase):
             """ A function to wrap and run."""
             raise RuntimeError('Objectiooooooon!')
 
-        cfg = {'junit': 'whatever', '_testcases': ['test_setup_logging']}
+        cfg = {'junit': self.junitdir, '_name': 'test',
+               '_testcases': []}
 
         func_wrapper = executable.junit(test_func)
 
@@ -358,9 +520,85 @@ class TestExecutable(unittest.TestCase):
             """ A function to wrap and run."""
             executable.retcode = 1
 
-        cfg = {'junit': 'whatever', '_testcases': ['test_setup_logging']}
+        cfg = {'junit': self.junitdir, '_name': 'test',
+               '_testcases': []}
 
         func_wrapper = executable.junit(test_func)
 
         func_wrapper(cfg)
         self.assertEqual(executable.retcode, 1)
+
+    def test_junit_write(self):
+        """Ensure junit writes compact results after each step."""
+        def test_func(cfg):
+            """ A function to wrap and run."""
+            cfg['krelease'] = '4.17.0'
+            cfg['unrelated'] = 'x' * 1024
+
+        cfg = {'junit': self.junitdir, '_name': 'all', '_testcases': []}
+        func_wrapper = executable.junit(test_func)
+
+        func_wrapper(cfg)
+        with open(os.path.join(self.junitdir, 'all.xml')) as fileh:
+            self.assertEqual(1, fileh.read().count('<testcase '))
+        stdout = json.loads(cfg['_testcases'][0].stdout)
+        self.assertEqual({'krelease': '4.17.0'}, stdout['state'])
+        self.assertIn('wall', stdout['metrics'])
+
+        cfg['junit_key'] = ['unrelated']
+        func_wrapper(cfg)
+        with open(os.path.join(self.junitdir, 'all.xml')) as fileh:
+            self.assertEqual(2, fileh.read().count('<testcase '))
+        stdout = json.loads(cfg['_testcases'][1].stdout)
+        self.assertEqual(['unrelated'], stdout['state'].keys())
+        # Only the results file is left behind
+        self.assertEqual(['all.xml'], os.listdir(self.junitdir))
+
+    def test_junit_write_mode(self):
+        """Ensure the junit results are created with the default mode."""
+        cfg = {'junit': self.junitdir, '_name': 'all', '_testcases': []}
+        path = os.path.join(self.junitdir, 'all.xml')
+
+        umask = os.umask(0o022)
+        try:
+            executable.write_junit(cfg)
+        finally:
+            os.umask(umask)
+        self.assertEqual(0o644, stat.S_IMODE(os.stat(path).st_mode))
+
+        # The mode of an existing file is kept
+        os.chmod(path, 0o640)
+        executable.write_junit(cfg)
+        self.assertEqual(0o640, stat.S_IMODE(os.stat(path).st_mode))
+
+    def test_main_junit(self):
+        """Ensure main() writes the JUnit results once per command."""
+        def cmd_report(cfg):
+            """A stand-in JUnit step."""
+            # pylint: disable=unused-argument
+            pass
+
+        argv = ['skt', '--rc', os.path.join(self.junitdir, 'rc'),
+                '--junit', self.junitdir, 'report', '--reporter', 'stdio']
+        for (func, calls) in [(cmd_report, 1),
+                              (executable.junit(cmd_report), 1)]:
+            with mock.patch('sys.argv', argv), \
+                    mock.patch('skt.executable.setup_logging'), \
+                    mock.patch('skt.executable.cmd_report', func), \
+                    mock.patch('skt.executable.write_junit',
+                               wraps=executable.write_junit) as mock_write:
+                with self.assertRaises(SystemExit):
+                    executable.main()
+
+            self.assertEqual(calls, mock_write.call_count)
+            self.assertTrue(os.path.isfile(os.path.join(self.junitdir,
+                                                        'report.xml')))
+
+    def test_get_metrics_properties(self):
+        """Ensure build metrics are flattened into JUnit properties."""
+        metrics = {'build': {'wall': 1.5, 'maxrss': 100}}
+        self.assertDictEqual(
+            {'build.build.wall': '1.5', 'build.build.maxrss': '100'},
+            executable.get_metrics_properties(metrics)
+        )
+        self.assertDictEqual({}, executable.get_metrics_properties(None))
@@ -14,6 +14,9 @@
 """Test cases for KernelBuilder class."""
 
 from __future__ import division
+import errno
+import gzip
+import json
 import unittest
 import tempfile
 import shutil
@@ -40,14 +43,11 @@ class KBuilderTest(unittest.TestCase):
         )
         self.m_popen = Mock()
         self.m_popen.returncode = 0
+        # Lines the fake make process writes to its stdout
+        self.make_output = []
         self.ctx_popen = mock.patch('subprocess.Popen',
-                                    Mock(return_value=self.m_popen))
+                                    Mock(side_effect=self.fake_popen))
         self.ctx_check_call = mock.patch('subprocess.check_call', Mock())
-        self.m_io_open = Mock()
-        self.m_io_open.__enter__ = lambda *args: self.m_io_open
-        self.m_io_open.__exit__ = lambda *args: None
-        self.ctx_io_open = mock.patch('io.open',
-                                      Mock(return_value=self.m_io_open))
         self.kernel_tarball = 'linux-4.16.0.tar.gz'
         self.success_str = 'Tarball successfully created in ./{}\n'
         self.success_str = self.success_str.format(self.kernel_tarball)
@@ -56,6 +56,14 @@ class KBuilderTest(unittest.TestCase):
         """Tear down test fixtures."""
         shutil.rmtree(self.tmpdir)
 
+    def fake_popen(self, *args, **kwargs):
+        """Write self.make_output to stdout of the fake process."""
+        # pylint: disable=unused-argument
+        stdout = kwargs.get('stdout')
+        if isinstance(stdout, int) and stdout >= 0:
+            os.write(stdout, ''.join(self.make_output))
+        return self.m_popen
+
     def test_assemble_make_options(self):
         """Ensure assemble_make_options() provides valid make options."""
         make_opts = self.kbuilder.assemble_make_options()
@@ -120,11 +128,8 @@ class KBuilderTest(unittest.TestCase):
 
     def test_mktgz_parsing_error(self):
         """Check if ParsingError is raised when no kernel found in stdout."""
-        with open(self.kbuilder.buildlog, 'w') as fileh:
-            fileh.write("log1\nlog2\nlog3")
-
-        self.m_io_open.readlines = Mock(return_value=['foo\n', 'bar\n'])
-        with self.ctx_popen, self.ctx_check_call, self.ctx_io_open:
+        self.make_output = ['foo\n', 'bar\n']
+        with self.ctx_popen, self.ctx_check_call:
             self.assertRaises(
                 kernelbuilder.ParsingError,
                 self.kbuilder_mktgz_silent
@@ -132,10 +137,8 @@ class KBuilderTest(unittest.TestCase):
 
     def test_mktgz_ioerror(self):
         """Check if IOError is raised when tarball path does not exist."""
-        self.m_io_open.readlines = Mock(
-            return_value=['foo\n', self.success_str]
-        )
-        with self.ctx_io_open, self.ctx_popen, self.ctx_check_call:
+        self.make_output = ['foo\n', self.success_str]
+        with self.ctx_popen, self.ctx_check_call:
             self.assertRaises(IOError, self.kbuilder_mktgz_silent)
 
     def test_mktgz_make_fail(self):
@@ -147,43 +150,76 @@ class KBuilderTest(unittest.TestCase):
 
     def test_mktgz_success(self):
         """Check if mktgz can finish successfully."""
-        # Write a valid buildlog.
-        with open(self.kbuilder.buildlog, 'w') as fileh:
-            fileh.write(
-                "Tarball successfully created in "
-                "./linux-4.16.0.tar.gz\n"
-            )
-
-        self.m_io_open.readlines = Mock(
-            return_value=['foo\n', self.success_str, 'bar']
-        )
+        self.make_output = ['foo\n', self.success_str, 'bar']
         self.m_popen.returncode = 0
-        with self.ctx_io_open, self.ctx_popen, self.ctx_check_call:
+        with self.ctx_popen, self.ctx_check_call:
             with open(os.path.join(self.tmpdir, self.kernel_tarball), 'w'):
                 pass
             full_path = self.kbuilder_mktgz_silent()
             self.assertEqual(os.path.join(self.tmpdir, self.kernel_tarball),
                              full_path)
 
+        # The build output should be in the build log as well.
+        with open(self.kbuilder.buildlog, 'r') as fileh:
+            self.assertEqual(''.join(self.make_output), fileh.read())
+
+    def test_mktgz_compressed_log(self):
+        """Ensure mktgz can write the build log compressed."""
+        self.kbuilder = kernelbuilder.KernelBuilder(
+            self.tmpdir,
+            self.tmpconfig.name,
+            compress_log=True
+        )
+        self.make_output = ['foo\n', self.success_str, 'bar\n']
+        with self.ctx_popen, self.ctx_check_call:
+            with open(os.path.join(self.tmpdir, self.kernel_tarball), 'w'):
+                pass
+            self.kbuilder_mktgz_silent()
+
+        self.assertTrue(self.kbuilder.buildlog.endswith('/build.log.gz'))
+        with gzip.open(self.kbuilder.buildlog, 'rb') as fileh:
+            self.assertEqual(''.join(self.make_output), fileh.read())
+
+        # The index lists the gzip members of the log.
+        with open(self.kbuilder.buildlogindex, 'r') as fileh:
+            self.assertEqual([[0, 0]], json.load(fileh)['members'])
+
     def test_mktgz_missing_kernel(self):
         """Ensure an IOError appears if the kernel package is missing."""
         # Write a buildlog that refers to a kernel that does not exist.
-        with open(self.kbuilder.buildlog, 'w') as fileh:
-            fileh.write(
-                "Tarball successfully created in "
-                "./linux-4.16.0.tar.gz-missing\n"
-            )
-
-        self.m_io_open.readlines = Mock(
-            return_value=['foo\n', self.success_str, 'bar']
-        )
+        self.make_output = [
+            'foo\n',
+            'Tarball successfully created in ./linux-4.16.0.tar.gz-missing\n',
+            'bar'
+        ]
         self.m_popen.returncode = 0
-        with self.ctx_io_open, self.ctx_popen, self.ctx_check_call:
+        with self.ctx_popen, self.ctx_check_call:
             with open(os.path.join(self.tmpdir, self.kernel_tarball), 'w'):
                 pass
             with self.assertRaises(IOError):
                 self.kbuilder_mktgz_silent()
 
+    def test_mktgz_log_matchers(self):
+        """Ensure mktgz() collects compiler errors and warnings."""
+        self.make_output = [
+            '  CC      fs/foo.o\n',
+            'fs/foo.c:12:3: warning: unused variable \'x\'\n',
+            'fs/foo.c:20:1: error: expected \';\' before \'}\' token\n',
+        ]
+        self.m_popen.returncode = 2
+        with self.ctx_popen, self.ctx_check_call:
+            with self.assertRaises(subprocess.CalledProcessError):
+                self.kbuilder_mktgz_silent()
+
+        matchers = self.kbuilder.log_matchers
+        self.assertEqual(1, len(matchers['warning'].matches))
+        offset, match = matchers['error'].matches[0]
+        self.assertEqual(len(self.make_output[0] + self.make_output[1]),
+                         offset)
+        self.assertEqual(('fs/foo.c', '20'),
+                         (match.group('file'), match.group('line')))
+        self.assertIsNone(self.kbuilder.find_tarball())
+
     def kbuilder_mktgz_silent(self, *args, **kwargs):
         """Run self.kbuilder.mktgz with disabled output."""
         with mock.patch('sys.stdout'):
@@ -294,3 +330,200 @@ class KBuilderTest(unittest.TestCase):
         self.assertEqual(expected_args, check_call_args[0])
 
         mock_adjust_cfg.assert_called()
+
+    def test_make_jobs_explicit(self):
+        """Ensure an explicit number of make jobs is used as is."""
+        kbuilder = kernelbuilder.KernelBuilder(
+            self.tmpdir,
+            self.tmpconfig.name,
+            make_jobs=3
+        )
+        self.assertEqual(kbuilder.make_jobs, 3)
+        self.assertIn('-j3', kbuilder.assemble_make_options())
+
+    @mock.patch('os.getloadavg', Mock(return_value=(2.5, 1.0, 1.0)))
+    @mock.patch('skt.kernelbuilder.get_cgroup_cpu_limit',
+                Mock(return_value=None))
+    @mock.patch('multiprocessing.cpu_count', Mock(return_value=8))
+    def test_get_make_jobs_load(self):
+        """Ensure get_make_jobs() subtracts the current load."""
+        self.assertEqual(kernelbuilder.get_make_jobs(), 6)
+
+    @mock.patch('os.getloadavg', Mock(return_value=(0.0, 0.0, 0.0)))
+    @mock.patch('skt.kernelbuilder.get_cgroup_cpu_limit',
+                Mock(return_value=2))
+    @mock.patch('multiprocessing.cpu_count', Mock(return_value=64))
+    def test_get_make_jobs_cgroup(self):
+        """Ensure get_make_jobs() respects the cgroup CPU quota."""
+        self.assertEqual(kernelbuilder.get_make_jobs(), 2)
+
+    @mock.patch('os.getloadavg', Mock(return_value=(100.0, 0.0, 0.0)))
+    @mock.patch('skt.kernelbuilder.get_cgroup_cpu_limit',
+                Mock(return_value=None))
+    @mock.patch('multiprocessing.cpu_count', Mock(return_value=4))
+    def test_get_make_jobs_overloaded(self):
+        """Ensure get_make_jobs() always returns at least one job."""
+        self.assertEqual(kernelbuilder.get_make_jobs(), 1)
+
+    def test_get_cgroup_cpu_limit(self):
+        """Ensure get_cgroup_cpu_limit() parses cgroup v2 and v1 quotas."""
+        cpu_max = os.path.join(self.tmpdir, 'cpu.max')
+        with open(cpu_max, 'w') as fileh:
+            fileh.write('250000 100000\n')
+        with mock.patch('skt.kernelbuilder.CGROUP2_CPU_MAX', cpu_max):
+            self.assertEqual(kernelbuilder.get_cgroup_cpu_limit(), 3)
+
+        with open(cpu_max, 'w') as fileh:
+            fileh.write('max 100000\n')
+        with mock.patch('skt.kernelbuilder.CGROUP2_CPU_MAX', cpu_max):
+            self.assertIsNone(kernelbuilder.get_cgroup_cpu_limit())
+
+        with open(os.path.join(self.tmpdir, 'cpu.cfs_quota_us'), 'w') as fh:
+            fh.write('150000\n')
+        with open(os.path.join(self.tmpdir, 'cpu.cfs_period_us'), 'w') as fh:
+            fh.write('100000\n')
+        with mock.patch('skt.kernelbuilder.CGROUP2_CPU_MAX', '/nonexistent'), \
+                mock.patch('skt.kernelbuilder.CGROUP1_CPU_DIRS',
+                           [self.tmpdir]):
+            self.assertEqual(kernelbuilder.get_cgroup_cpu_limit(), 2)
+
+    def test_mktgz_jobserver(self):
+        """Ensure mktgz() creates and passes a jobserver fifo to make."""
+        fifo = os.path.join(self.tmpdir, 'jobserver')
+        kbuilder = kernelbuilder.KernelBuilder(
+            self.tmpdir,
+            self.tmpconfig.name,
+            make_jobs=4,
+            jobserver=fifo
+        )
+        self.assertNotIn('-j4', kbuilder.assemble_make_options())
+
+        self.m_popen.returncode = 1
+        with self.ctx_popen as m_popen, self.ctx_check_call, \
+                mock.patch('sys.stdout'):
+            self.assertRaises(subprocess.CalledProcessError, kbuilder.mktgz)
+            environ = m_popen.call_args[1]['env']
+            self.assertIn('-j4 --jobserver-auth=fifo:{}'.format(fifo),
+                          environ['MAKEFLAGS'])
+
+        self.assertTrue(os.path.exists(fifo))
+        # pylint: disable=protected-access
+        self.assertIsNone(kbuilder._jobserver_fd)
+
+    def test_jobserver_tokens(self):
+        """Ensure every build after the last one left refills the tokens."""
+        # pylint: disable=protected-access
+        fifo = os.path.join(self.tmpdir, 'jobserver')
+
+        def count_tokens(kbuilder):
+            """Take all tokens from the jobserver and put them back."""
+            try:
+                tokens = os.read(kbuilder._jobserver_fd, 1024)
+            except OSError as exc:
+                self.assertEqual(errno.EAGAIN, exc.errno)
+                return 0
+            os.write(kbuilder._jobserver_fd, tokens)
+            return len(tokens)
+
+        for _ in range(2):
+            first = kernelbuilder.KernelBuilder(self.tmpdir,
+                                                self.tmpconfig.name,
+                                                make_jobs=4, jobserver=fifo)
+            first._KernelBuilder__join_jobserver()
+            self.assertEqual(3, count_tokens(first))
+
+            # A concurrent build joins the pool instead of adding to it.
+            second = kernelbuilder.KernelBuilder(self.tmpdir,
+                                                 self.tmpconfig.name,
+                                                 make_jobs=4, jobserver=fifo)
+            second._KernelBuilder__join_jobserver()
+            self.assertEqual(3, count_tokens(second))
+
+            second._KernelBuilder__leave_jobserver()
+            first._KernelBuilder__leave_jobserver()
+
+        with open(fifo + '.members') as fileh:
+            self.assertEqual('', fileh.read())
+
+    def test_jobserver_dead_member(self):
+        """Ensure the tokens are refilled if the last build died."""
+        # pylint: disable=protected-access
+        fifo = os.path.join(self.tmpdir, 'jobserver')
+        os.mkfifo(fifo)
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        with open(fifo + '.members', 'w') as fileh:
+            fileh.write('{}\n'.format(dead.pid))
+
+        kbuilder = kernelbuilder.KernelBuilder(self.tmpdir,
+                                               self.tmpconfig.name,
+                                               make_jobs=2, jobserver=fifo)
+        kbuilder._KernelBuilder__join_jobserver()
+        try:
+            self.assertEqual(b'+', os.read(kbuilder._jobserver_fd, 1024))
+        finally:
+            kbuilder._KernelBuilder__leave_jobserver()
+
+    @mock.patch('skt.kernelbuilder.find_executable')
+    def test_package_format(self, mock_find):
+        """Ensure the package format selects the make target and compressor."""
+        mock_find.return_value = '/usr/bin/zstd'
+        kbuilder = kernelbuilder.KernelBuilder(
+            self.tmpdir,
+            self.tmpconfig.name,
+            package_format='tarzst',
+            compress_level=3
+        )
+        make_opts = kbuilder.assemble_make_options()
+
+        self.assertEqual('.tar.zst', kbuilder.package_extension)
+        self.assertIn('tarzst-pkg', make_opts)
+        self.assertIn('ZSTD=zstd -T0 -3', make_opts)
+
+    @mock.patch('skt.kernelbuilder.find_executable')
+    def test_package_compressor_fallback(self, mock_find):
+        """Ensure gzip is used for the default format if pigz is missing."""
+        mock_find.side_effect = lambda cmd: None if cmd == 'pigz' else cmd
+        make_opts = kernelbuilder.KernelBuilder(
+            self.tmpdir,
+            self.tmpconfig.name
+        ).assemble_make_options()
+
+        self.assertIn('targz-pkg', make_opts)
+        self.assertIn('KGZIP=gzip', make_opts)
+
+        mock_find.side_effect = None
+        mock_find.return_value = '/usr/bin/pigz'
+        make_opts = kernelbuilder.KernelBuilder(
+            self.tmpdir,
+            self.tmpconfig.name
+        ).assemble_make_options()
+        self.assertIn('KGZIP=pigz', make_opts)
+
+    def test_getrelease_after_build(self):
+        """Ensure getrelease() uses the release file left by the build."""
+        os.makedirs(os.path.join(self.tmpdir, 'include', 'config'))
+        with open(os.path.join(self.tmpdir, 'include', 'config',
+                               'kernel.release'), 'w') as fileh:
+            fileh.write('4.17.0-rc6.skt+\n')
+
+        self.make_output = [self.success_str]
+        with self.ctx_popen as m_popen, self.ctx_check_call:
+            with open(os.path.join(self.tmpdir, self.kernel_tarball), 'w'):
+                pass
+            self.kbuilder_mktgz_silent()
+            m_popen.reset_mock()
+
+            self.assertEqual('4.17.0-rc6.skt+', self.kbuilder.getrelease())
+            m_popen.assert_not_called()
+
+    @mock.patch("skt.kernelbuilder.KernelBuilder."
+                "_KernelBuilder__prepare_kernel_config")
+    def test_getrelease_cached(self, mock_prepare):
+        """Ensure getrelease() runs make only once."""
+        self.m_popen.communicate = Mock(return_value=('4.17.0\n', None))
+
+        with self.ctx_popen as m_popen, mock_prepare:
+            self.assertEqual('4.17.0', self.kbuilder.getrelease())
+            self.assertEqual('4.17.0', self.kbuilder.getrelease())
+            m_popen.assert_called_once()
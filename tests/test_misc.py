@@ -13,6 +13,7 @@
 # Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """Test cases for misc.py."""
 from email.errors import HeaderParseError
+import subprocess
 import unittest
 
 import mock
@@ -130,3 +131,17 @@ class TestIndependent(unittest.TestCase):
 
         with self.assertRaises(Exception):
             skt.misc.get_patch_mbox('http://patchwork.example.com/patch/1')
+
+    def test_measure(self):
+        """Ensure measure() accumulates the metrics of a phase."""
+        metrics = {}
+        for _ in range(2):
+            with skt.misc.measure(metrics, 'phase'):
+                subprocess.check_call(['true'])
+
+        self.assertItemsEqual(
+            ['wall', 'cpu_user', 'cpu_sys', 'maxrss', 'inblock', 'oublock'],
+            metrics['phase'].keys()
+        )
+        self.assertGreater(metrics['phase']['wall'], 0)
+        self.assertGreater(metrics['phase']['maxrss'], 0)
@@ -12,8 +12,21 @@
 # this program; if not, write to the Free Software Foundation, Inc., 51
 # Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """Test cases for publisher module."""
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
 import unittest
 
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import mock
+import requests
+
 from skt import publisher
 
 
@@ -24,3 +37,482 @@ class TestPublisher(unittest.TestCase):
         for cls in publisher.Publisher.__subclasses__():
             pub = cls('dest', 'file:///tmp/test')
             self.assertEqual(pub.geturl('source'), 'file:///tmp/test/source')
+
+
+class TestCpPublisher(unittest.TestCase):
+    """Test cases for publisher.CpPublisher class."""
+
+    def setUp(self):
+        """Test fixtures."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, 'source.tar.gz')
+        with open(self.source, 'wb') as fileh:
+            fileh.write(b'kernel' * 1000)
+        self.destination = os.path.join(self.tmpdir, 'dest')
+        os.mkdir(self.destination)
+
+    def tearDown(self):
+        """Tear down test fixtures."""
+        shutil.rmtree(self.tmpdir)
+
+    def test_publish_many(self):
+        """Ensure files are copied and their checksums recorded."""
+        pub = publisher.CpPublisher(self.destination, 'http://a')
+        pub.immutable.add(self.source)
+
+        urls = pub.publish_many([self.source])
+
+        self.assertEqual(['http://a/source.tar.gz'], urls)
+        with open(os.path.join(self.destination, 'source.tar.gz')) as fileh:
+            self.assertEqual('kernel' * 1000, fileh.read())
+        self.assertEqual(hashlib.sha256('kernel' * 1000).hexdigest(),
+                         pub.checksums[self.source])
+        self.assertEqual(pub.checksums[self.source],
+                         publisher.hash_file(self.source))
+
+        # The destination is on the same filesystem, so it's a hard link.
+        self.assertEqual('link', pub.methods[self.source])
+        self.assertTrue(os.path.samefile(
+            self.source, os.path.join(self.destination, 'source.tar.gz')
+        ))
+
+    @mock.patch('os.link')
+    def test_publish_mutable(self, mock_link):
+        """Ensure files which may be modified aren't hard-linked."""
+        pub = publisher.CpPublisher(self.destination, 'http://a')
+        destination = os.path.join(self.destination, 'source.tar.gz')
+
+        pub.publish(self.source)
+
+        mock_link.assert_not_called()
+        self.assertIn(pub.methods[self.source], ['reflink', 'copy'])
+        self.assertFalse(os.path.samefile(self.source, destination))
+        with open(self.source, 'w') as fileh:
+            fileh.write('modified')
+        with open(destination) as fileh:
+            self.assertEqual('kernel' * 1000, fileh.read())
+        self.assertEqual(hashlib.sha256('kernel' * 1000).hexdigest(),
+                         pub.checksums[self.source])
+
+    @mock.patch('fcntl.ioctl', side_effect=IOError)
+    @mock.patch('os.link', side_effect=OSError)
+    def test_publish_copy(self, mock_link, mock_ioctl):
+        """Ensure files are copied if they can't be linked or reflinked."""
+        pub = publisher.CpPublisher(self.destination, 'http://a')
+        pub.immutable.add(self.source)
+        destination = os.path.join(self.destination, 'source.tar.gz')
+        with open(destination, 'w') as fileh:
+            fileh.write('old')
+
+        pub.publish(self.source)
+
+        mock_link.assert_called_once_with(
+            self.source, '{}.{}.tmp'.format(destination, os.getpid())
+        )
+        mock_ioctl.assert_called_once()
+        self.assertEqual('copy', pub.methods[self.source])
+        self.assertFalse(os.path.samefile(self.source, destination))
+        with open(destination) as fileh:
+            self.assertEqual('kernel' * 1000, fileh.read())
+        self.assertEqual(['source.tar.gz'], os.listdir(self.destination))
+
+    def test_publish_in_place(self):
+        """Ensure a file already in the destination is left alone."""
+        pub = publisher.CpPublisher(self.tmpdir, 'http://a')
+
+        self.assertEqual('http://a/source.tar.gz', pub.publish(self.source))
+
+        self.assertEqual('link', pub.methods[self.source])
+        with open(self.source) as fileh:
+            self.assertEqual('kernel' * 1000, fileh.read())
+        self.assertEqual(hashlib.sha256('kernel' * 1000).hexdigest(),
+                         pub.checksums[self.source])
+
+    @mock.patch('skt.publisher.copy_file', side_effect=IOError)
+    @mock.patch('fcntl.ioctl', side_effect=IOError)
+    @mock.patch('os.link', side_effect=OSError)
+    def test_publish_copy_failure(self, mock_link, mock_ioctl, mock_copy):
+        """Ensure a failed publish doesn't remove the published file."""
+        # pylint: disable=unused-argument
+        pub = publisher.CpPublisher(self.destination, 'http://a')
+        destination = os.path.join(self.destination, 'source.tar.gz')
+        with open(destination, 'w') as fileh:
+            fileh.write('old')
+
+        with self.assertRaises(IOError):
+            pub.publish(self.source)
+
+        self.assertEqual(['source.tar.gz'], os.listdir(self.destination))
+        with open(destination) as fileh:
+            self.assertEqual('old', fileh.read())
+
+
+class TestRemotePublishers(unittest.TestCase):
+    """Test cases for publishers copying files to remote hosts."""
+
+    @mock.patch('skt.publisher.hash_file', return_value='sum')
+    @mock.patch('subprocess.check_output')
+    @mock.patch('subprocess.check_call')
+    def test_scp_publish_many(self, mock_check_call, mock_check_output,
+                              mock_hash_file):
+        """Ensure scp copies all files at once and verifies them."""
+        mock_check_output.return_value = 'sum  /srv/a\nsum  /srv/b\n'
+        pub = publisher.ScpPublisher('host:/srv', 'http://a')
+
+        urls = pub.publish_many(['x/a', 'y/b'])
+
+        self.assertEqual(['http://a/a', 'http://a/b'], urls)
+        mock_check_call.assert_called_once_with(
+            ['scp', 'x/a', 'y/b', 'host:/srv/']
+        )
+        self.assertEqual(['ssh', 'host'],
+                         mock_check_output.call_args[0][0][:2])
+        self.assertEqual({'x/a': 'sum', 'y/b': 'sum'}, pub.checksums)
+        self.assertEqual(2, mock_hash_file.call_count)
+
+    @mock.patch('skt.publisher.hash_file', return_value='sum')
+    @mock.patch('subprocess.check_output')
+    @mock.patch('subprocess.check_call')
+    def test_scp_mismatch(self, mock_check_call, mock_check_output,
+                          mock_hash_file):
+        """Ensure scp fails if an uploaded file doesn't match."""
+        # pylint: disable=unused-argument
+        mock_check_output.return_value = 'sum  /srv/a\nbad  /srv/b\n'
+        pub = publisher.ScpPublisher('host:/srv', 'http://a')
+
+        with self.assertRaises(IOError):
+            pub.publish_many(['x/a', 'y/b'])
+
+    @mock.patch('skt.publisher.hash_file', return_value='sum')
+    @mock.patch('subprocess.check_output')
+    @mock.patch('subprocess.check_call')
+    def test_scp_no_verify(self, mock_check_call, mock_check_output,
+                           mock_hash_file):
+        """Ensure scp doesn't connect again if verification is off."""
+        # pylint: disable=unused-argument
+        pub = publisher.getpublisher('scp', 'host:/srv', 'http://a',
+                                     verify=False)
+
+        self.assertEqual(['http://a/a'], pub.publish_many(['x/a']))
+        mock_check_call.assert_called_once_with(['scp', 'x/a', 'host:/srv/'])
+        mock_check_output.assert_not_called()
+        self.assertEqual({'x/a': 'sum'}, pub.checksums)
+
+    def test_unsupported_option(self):
+        """Ensure options the publisher doesn't support are rejected."""
+        with self.assertRaises(ValueError):
+            publisher.getpublisher('cp', '/srv', 'http://a', verify=False)
+
+    @mock.patch('skt.publisher.hash_file', return_value='sum')
+    @mock.patch('subprocess.check_output')
+    @mock.patch('subprocess.check_call')
+    def test_publish_many_parallel(self, mock_check_call, mock_check_output,
+                                   mock_hash_file):
+        """Ensure files are published in parallel batches, keeping order."""
+        # pylint: disable=unused-argument
+        mock_check_output.return_value = \
+            'sum  /srv/a\nsum  /srv/b\nsum  /srv/c\n'
+        pub = publisher.ScpPublisher('host:/srv', 'http://a')
+
+        urls = pub.publish_many(['a', 'b', 'c'], jobs=2)
+
+        self.assertEqual(['http://a/a', 'http://a/b', 'http://a/c'], urls)
+        self.assertEqual(2, mock_check_call.call_count)
+        mock_check_call.assert_any_call(['scp', 'a', 'c', 'host:/srv/'])
+        mock_check_call.assert_any_call(['scp', 'b', 'host:/srv/'])
+
+    @mock.patch('os.path.getsize', return_value=12)
+    @mock.patch('skt.publisher.hash_file', return_value='sum')
+    @mock.patch('subprocess.Popen')
+    def test_sftp_publish_many(self, mock_popen, mock_hash_file,
+                               mock_getsize):
+        """Ensure sftp copies all files in one batch and checks the result."""
+        # pylint: disable=unused-argument
+        mock_popen.return_value.returncode = 0
+        mock_popen.return_value.communicate.side_effect = [
+            ('', None),
+            ('sftp> -ls -l "a"\n'
+             '-rw-r--r--    1 u g   12 Jan  1 00:00 a\n'
+             '-rw-r--r--    1 u g   12 Jan  1 00:00 b\n', None),
+        ]
+        pub = publisher.SftpPublisher('host:/srv', 'http://a')
+
+        self.assertEqual(['http://a/a', 'http://a/b'],
+                         pub.publish_many(['x/a', 'y/b']))
+        mock_popen.assert_called_with(
+            ['sftp', '-b', '-', 'host:/srv'], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+        mock_popen.return_value.communicate.assert_has_calls([
+            mock.call('put -r "x/a"\nput -r "y/b"\n'),
+            mock.call('-ls -l "a"\n-ls -l "b"\n'),
+        ])
+
+        # A truncated upload is detected
+        mock_popen.return_value.communicate.side_effect = [
+            ('', None),
+            ('-rw-r--r--    1 u g   11 Jan  1 00:00 a\n', None),
+        ]
+        with self.assertRaises(IOError):
+            pub.publish('x/a')
+
+        mock_popen.return_value.communicate.side_effect = None
+        mock_popen.return_value.communicate.return_value = ('', None)
+        mock_popen.return_value.returncode = 1
+        with self.assertRaises(subprocess.CalledProcessError):
+            pub.publish('x/a')
+
+
+class TestContentAddressed(unittest.TestCase):
+    """Test cases for the content-addressed publishing mode."""
+
+    def setUp(self):
+        """Test fixtures."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, 'source.config')
+        with open(self.source, 'w') as fileh:
+            fileh.write('CONFIG_FOO=y\n')
+        self.checksum = hashlib.sha256('CONFIG_FOO=y\n').hexdigest()
+
+    def tearDown(self):
+        """Tear down test fixtures."""
+        shutil.rmtree(self.tmpdir)
+
+    def test_cp(self):
+        """Ensure cp publishes under the checksum and skips present files."""
+        destination = os.path.join(self.tmpdir, 'dest')
+        pub = publisher.getpublisher('cp', destination, 'http://a',
+                                     content_addressed=True)
+        pub.immutable.add(self.source)
+
+        url = pub.publish(self.source)
+
+        self.assertEqual('http://a/{}/source.config'.format(self.checksum),
+                         url)
+        self.assertTrue(os.path.isfile(os.path.join(
+            destination, self.checksum, 'source.config'
+        )))
+        self.assertEqual('link', pub.methods[self.source])
+
+        self.assertEqual(url, pub.publish(self.source))
+        self.assertEqual('present', pub.methods[self.source])
+
+    @mock.patch('subprocess.check_call')
+    @mock.patch('subprocess.check_output')
+    def test_scp(self, mock_check_output, mock_check_call):
+        """Ensure scp uploads only files missing on the host."""
+        missing = os.path.join(self.tmpdir, 'missing.tar.gz')
+        with open(missing, 'w') as fileh:
+            fileh.write('kernel')
+        missing_path = '/srv/{}/missing.tar.gz'.format(
+            hashlib.sha256('kernel').hexdigest()
+        )
+        mock_check_output.side_effect = [
+            '/srv/{}/source.config\n'.format(self.checksum),
+            '{}  {}\n'.format(hashlib.sha256('kernel').hexdigest(),
+                              missing_path),
+        ]
+        pub = publisher.ScpPublisher('host:/srv', 'http://a',
+                                     content_addressed=True)
+
+        urls = pub.publish_many([self.source, missing])
+
+        self.assertEqual('http://a' + missing_path[4:], urls[1])
+        self.assertEqual('ssh', mock_check_output.call_args[0][0][0])
+        # Only the uploaded file is verified
+        self.assertIn(missing_path, mock_check_output.call_args[0][0][2])
+        self.assertNotIn('source.config',
+                         mock_check_output.call_args[0][0][2])
+        mock_check_call.assert_called_once_with(
+            ['scp', missing, 'host:' + missing_path]
+        )
+
+    @mock.patch('subprocess.Popen')
+    def test_sftp(self, mock_popen):
+        """Ensure sftp skips the upload if the file is present."""
+        mock_popen.return_value.returncode = 0
+        mock_popen.return_value.communicate.return_value = (
+            '{}/source.config\n'.format(self.checksum), None
+        )
+        pub = publisher.SftpPublisher('host:/srv', 'http://a',
+                                      content_addressed=True)
+
+        pub.publish(self.source)
+
+        mock_popen.return_value.communicate.assert_called_once_with(
+            '-ls "{}/source.config"\n'.format(self.checksum)
+        )
+
+
+class ObjectStoreHandler(BaseHTTPRequestHandler):
+    """A stand-in object store, accepting whole and ranged PUT requests."""
+
+    def log_message(self, *args):
+        """Keep the test output clean."""
+        pass
+
+    def do_HEAD(self):
+        """Return the size of a stored object."""
+        # pylint: disable=invalid-name
+        data = self.server.objects.get(self.path)
+        self.send_response(404 if data is None else 200)
+        if data is not None:
+            self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+
+    def do_PUT(self):
+        """Store an object or a part of it."""
+        # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        content_range = self.headers.get('Content-Range')
+        with self.server.lock:
+            self.server.puts.append((self.path, content_range))
+            if content_range in self.server.fail_ranges:
+                self.server.fail_ranges.remove(content_range)
+                self.send_response(500)
+                self.end_headers()
+                return
+
+            if content_range:
+                match = re.match(r'bytes (\d+)-(\d+)/(\d+)', content_range)
+                (start, _, total) = [int(group) for group in match.groups()]
+                data = self.server.objects.setdefault(self.path,
+                                                      bytearray(total))
+                data[start:start + len(body)] = body
+            else:
+                self.server.objects[self.path] = bytearray(body)
+
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class ObjectStoreServer(ThreadingMixIn, HTTPServer):
+    """A threaded stand-in object store server."""
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), ObjectStoreHandler)
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.puts = []
+        self.fail_ranges = []
+
+
+class TestHttpPublisher(unittest.TestCase):
+    """Test cases for publisher.HttpPublisher class."""
+
+    def setUp(self):
+        """Test fixtures."""
+        self.server = ObjectStoreServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.baseurl = 'http://127.0.0.1:{}/builds'.format(
+            self.server.server_address[1]
+        )
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, 'kernel.tar.gz')
+        self.data = ''.join(chr(index % 251) for index in range(1000))
+        with open(self.source, 'wb') as fileh:
+            fileh.write(self.data)
+
+    def tearDown(self):
+        """Tear down test fixtures."""
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def get_publisher(self, **kwargs):
+        """Create a publisher uploading in small parts."""
+        pub = publisher.getpublisher('http', self.baseurl, 'http://pub',
+                                     multipart=True, **kwargs)
+        pub.PART_SIZE = 100
+        return pub
+
+    def test_publish_small(self):
+        """Ensure small files are uploaded with a single request."""
+        pub = publisher.getpublisher('http', self.baseurl, 'http://pub')
+
+        self.assertEqual('http://pub/kernel.tar.gz', pub.publish(self.source))
+        self.assertEqual([('/builds/kernel.tar.gz', None)], self.server.puts)
+        self.assertEqual(self.data,
+                         self.server.objects['/builds/kernel.tar.gz'])
+
+    def test_publish_single(self):
+        """Ensure large files are uploaded whole unless multipart is on."""
+        pub = publisher.getpublisher('http', self.baseurl, 'http://pub')
+        pub.PART_SIZE = 100
+
+        pub.publish(self.source)
+
+        self.assertEqual([('/builds/kernel.tar.gz', None)], self.server.puts)
+        self.assertEqual(self.data,
+                         self.server.objects['/builds/kernel.tar.gz'])
+
+    def test_publish_many_pool(self):
+        """Ensure there are connections for all files and parts at once."""
+        pub = self.get_publisher()
+        sources = [self.source]
+        for index in range(2):
+            sources.append(os.path.join(self.tmpdir, str(index)))
+            shutil.copyfile(self.source, sources[-1])
+
+        pub.publish_many(sources, 4)
+
+        adapter = pub.session.get_adapter(self.baseurl)
+        # pylint: disable=protected-access
+        self.assertEqual(3 * pub.PART_JOBS, adapter._pool_maxsize)
+        for source in sources:
+            self.assertEqual(
+                self.data,
+                self.server.objects['/builds/' + os.path.basename(source)]
+            )
+
+    def test_publish_parts(self):
+        """Ensure large files are uploaded in parts."""
+        pub = self.get_publisher()
+
+        pub.publish(self.source)
+
+        self.assertEqual(10, len(self.server.puts))
+        self.assertIn(('/builds/kernel.tar.gz', 'bytes 900-999/1000'),
+                      self.server.puts)
+        self.assertEqual(self.data,
+                         self.server.objects['/builds/kernel.tar.gz'])
+        self.assertFalse(os.path.exists(
+            publisher.HttpPublisher.get_journal_path(self.source)
+        ))
+
+    def test_publish_resume(self):
+        """Ensure an interrupted upload resumes with the missing parts."""
+        pub = self.get_publisher()
+        self.server.fail_ranges.append('bytes 500-599/1000')
+
+        with self.assertRaises(requests.HTTPError):
+            pub.publish(self.source)
+        self.assertTrue(os.path.exists(
+            publisher.HttpPublisher.get_journal_path(self.source)
+        ))
+
+        del self.server.puts[:]
+        pub.publish(self.source)
+
+        # Only the failed part is uploaded again.
+        self.assertEqual([('/builds/kernel.tar.gz', 'bytes 500-599/1000')],
+                         self.server.puts)
+        self.assertEqual(self.data,
+                         self.server.objects['/builds/kernel.tar.gz'])
+
+    def test_publish_content_addressed(self):
+        """Ensure objects present in the store are not uploaded again."""
+        pub = self.get_publisher(content_addressed=True)
+        checksum = hashlib.sha256(self.data).hexdigest()
+
+        url = pub.publish(self.source)
+        self.assertEqual('http://pub/{}/kernel.tar.gz'.format(checksum), url)
+
+        del self.server.puts[:]
+        self.assertEqual(url, pub.publish(self.source))
+        self.assertEqual([], self.server.puts)
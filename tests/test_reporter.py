@@ -13,9 +13,18 @@
 # Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """Test cases for reporter module."""
 import StringIO
+import asyncore
+import email
+import gzip
+import json
 import os
+import re
+import smtpd
+import smtplib
 import shutil
+import sqlite3
 import tempfile
+import threading
 import unittest
 
 from defusedxml.ElementTree import fromstring
@@ -29,6 +38,29 @@ from skt import reporter
 SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
 
 
+class SmtpServer(smtpd.SMTPServer):
+    """A local SMTP server keeping the messages it receives."""
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.url = '127.0.0.1:{}'.format(self.socket.getsockname()[1])
+        # The messages received, as (sender, recipients, data) tuples
+        self.messages = []
+        # The replies to the next messages instead of accepting them
+        self.replies = []
+        self.connections = 0
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.replies:
+            return self.replies.pop(0)
+        self.messages.append((mailfrom, rcpttos, data))
+        return None
+
+
 def read_asset(filename):
     """Read a test asset."""
     filename = "{}/assets/{}".format(SCRIPT_PATH, filename)
@@ -51,15 +83,10 @@ class TestReporterFunctions(unittest.TestCase):
         cfg = reporter.load_state_cfg(self.statefile)
 
         expected_cfg = {
-            'jobid_01': 'J:123456',
             'jobs': set(['J:123456']),
-            'localpatch_01': '/tmp/patch.txt',
             'localpatches': ['/tmp/patch.txt'],
-            'mergehead_01': 'master',
             'mergeheads': ['master'],
-            'mergerepo_01': 'git://git.kernel.org/pub/scm/linux/kernel/git/',
             'mergerepos': ['git://git.kernel.org/pub/scm/linux/kernel/git/'],
-            'patchwork_01': 'http://example.com/patch/1',
             'patchworks': ['http://example.com/patch/1'],
             'runner': ['beaker', {'jobtemplate': 'test_template.xml'}]
         }
@@ -72,23 +99,13 @@ class TestReporterFunctions(unittest.TestCase):
 
         expected_cfg = {
             'foo': 'bar',
-            'jobid_01': 'J:123456',
-            'jobid_02': 'J:123456',
             'jobs': set(['J:123456']),
-            'localpatch_01': '/tmp/patch.txt',
-            'localpatch_02': '/tmp/patch.txt',
             'localpatches': ['/tmp/patch.txt', '/tmp/patch.txt'],
-            'mergehead_01': 'master',
-            'mergehead_02': 'master',
             'mergeheads': ['master', 'master'],
-            'mergerepo_01': 'git://git.kernel.org/pub/scm/linux/kernel/git/',
-            'mergerepo_02': 'git://git.kernel.org/pub/scm/linux/kernel/git/',
             'mergerepos': [
                 'git://git.kernel.org/pub/scm/linux/kernel/git/',
                 'git://git.kernel.org/pub/scm/linux/kernel/git/'
             ],
-            'patchwork_01': 'http://example.com/patch/1',
-            'patchwork_02': 'http://example.com/patch/1',
             'patchworks': [
                 'http://example.com/patch/1',
                 'http://example.com/patch/1'
@@ -97,6 +114,105 @@ class TestReporterFunctions(unittest.TestCase):
         self.assertDictEqual(expected_cfg, cfg)
         mock_log.assert_called_once()
 
+    def test_get_jinja_env(self):
+        """Ensure the jinja2 environment is created once and cached."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        with mock.patch.dict('os.environ', {'XDG_CACHE_HOME': tmpdir}), \
+                mock.patch('skt.reporter._JINJA_ENV', None):
+            jinja_env = reporter.get_jinja_env()
+            jinja_env.get_template('report_full.j2')
+
+            self.assertIs(jinja_env, reporter.get_jinja_env())
+
+        cache_dir = os.path.join(tmpdir, 'skt', 'templates')
+        self.assertEqual(cache_dir, jinja_env.bytecode_cache.directory)
+        self.assertTrue(os.listdir(cache_dir))
+
+    @mock.patch('logging.warning')
+    def test_get_jinja_env_no_cache(self, mock_log):
+        """Ensure templates work without a writable cache directory."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        # A file where the cache directory should be created
+        cache_home = os.path.join(tmpdir, 'cache')
+        open(cache_home, 'w').close()
+
+        with mock.patch.dict('os.environ', {'XDG_CACHE_HOME': cache_home}), \
+                mock.patch('skt.reporter._JINJA_ENV', None):
+            jinja_env = reporter.get_jinja_env()
+            jinja_env.get_template('report_full.j2')
+
+        self.assertIsNone(jinja_env.bytecode_cache)
+        mock_log.assert_called_once()
+
+    def test_get_duration_seconds(self):
+        """Ensure get_duration_seconds() parses Beaker task durations."""
+        self.assertEqual(3723, reporter.get_duration_seconds('1:02:03'))
+        self.assertEqual(2 * 86400 + 3723,
+                         reporter.get_duration_seconds('2 days, 1:02:03'))
+        self.assertIsNone(reporter.get_duration_seconds(None))
+        self.assertIsNone(reporter.get_duration_seconds('soon'))
+
+    def test_write_message(self):
+        """Ensure attachments are streamed into a valid MIME message."""
+        msg = reporter.MIMEMultipart()
+        msg['Subject'] = 'Test report'
+        msg.attach(reporter.MIMEText('Report text'))
+        data = os.urandom(reporter.ATTACHMENT_CHUNK_SIZE * 2 + 1)
+        attachments = [('build.log.gz', data),
+                       ('console.log', StringIO.StringIO('Console log\n'))]
+
+        fileh = StringIO.StringIO()
+        reporter.write_message(fileh, msg, attachments)
+
+        parsed = email.message_from_string(fileh.getvalue())
+        self.assertEqual('Test report', parsed['Subject'])
+        parts = parsed.get_payload()
+        self.assertEqual(3, len(parts))
+        self.assertEqual('Report text', parts[0].get_payload())
+        self.assertEqual('build.log.gz', parts[1].get_filename())
+        self.assertEqual('application/octet-stream',
+                         parts[1].get_content_type())
+        self.assertEqual(data, parts[1].get_payload(decode=True))
+        self.assertEqual('console.log', parts[2].get_filename())
+        self.assertEqual('utf-8', parts[2].get_content_charset())
+        self.assertEqual('Console log\n', parts[2].get_payload(decode=True))
+
+    def test_send_message(self):
+        """Ensure messages are sent from a file with dots escaped."""
+        mailserver = mock.Mock()
+        mailserver.mail.return_value = (250, 'OK')
+        mailserver.rcpt.side_effect = [(250, 'OK'), (550, 'No such user')]
+        mailserver.getreply.side_effect = [(354, 'Go ahead'), (250, 'OK')]
+        fileh = StringIO.StringIO('Subject: Test\n\n.hidden\nlast')
+
+        refused = reporter.send_message(mailserver, 'skt@example.com',
+                                        ['a@example.com', 'b@example.com'],
+                                        fileh)
+
+        self.assertEqual({'b@example.com': (550, 'No such user')}, refused)
+        mailserver.mail.assert_called_once_with('skt@example.com')
+        mailserver.putcmd.assert_called_once_with('data')
+        sent = ''.join(call[0][0] for call in mailserver.send.call_args_list)
+        self.assertEqual('Subject: Test\r\n\r\n..hidden\r\nlast\r\n.\r\n',
+                         sent)
+
+    def test_send_message_refused(self):
+        """Ensure a message refused by the server raises an error."""
+        mailserver = mock.Mock()
+        mailserver.mail.return_value = (250, 'OK')
+        mailserver.rcpt.return_value = (250, 'OK')
+        mailserver.getreply.side_effect = [(354, 'Go ahead'),
+                                           (552, 'Too large')]
+
+        with self.assertRaises(smtplib.SMTPDataError):
+            reporter.send_message(mailserver, 'skt@example.com',
+                                  ['a@example.com'],
+                                  StringIO.StringIO('Subject: Test\n'))
+        mailserver.rset.assert_called_once()
+
 
 class TestStdioReporter(unittest.TestCase):
     """Test cases for StdioReporter class."""
@@ -278,6 +394,70 @@ class TestStdioReporter(unittest.TestCase):
         for required_string in required_strings:
             self.assertIn(required_string, report)
 
+    @responses.activate
+    def test_build_failure_excerpt(self):
+        """Verify the build failure report has the excerpt from the index."""
+        responses.add(
+            responses.GET,
+            "http://patchwork.example.com/patch/1/mbox",
+            body="Subject: Patch #1"
+        )
+        responses.add(
+            responses.GET,
+            "http://patchwork.example.com/patch/2/mbox",
+            body="Subject: Patch #2"
+        )
+
+        log = 'build started\nfs/foo.c:1:1: error: oops\nbuild ended\n'
+        self.basecfg['buildlog'] = self.make_file('build.log', log)
+        self.make_file(
+            'build.log.index',
+            '{"version": 1, "failed_target": null, "errors": '
+            '[{"offset": 14, "file": "fs/foo.c", "line": 1}]}'
+        )
+
+        testprint = StringIO.StringIO()
+        rptclass = reporter.StdioReporter(self.basecfg)
+        rptclass.report(printer=testprint)
+        report = testprint.getvalue()
+
+        self.assertIn('The first error in the build log:', report)
+        self.assertIn('      build started\n'
+                      '      fs/foo.c:1:1: error: oops\n'
+                      '      build ended\n', report)
+
+    @responses.activate
+    def test_build_failure_excerpt_unicode(self):
+        """Verify non-ASCII compiler output in the excerpt is reported."""
+        responses.add(
+            responses.GET,
+            "http://patchwork.example.com/patch/1/mbox",
+            body="Subject: Patch #1"
+        )
+        responses.add(
+            responses.GET,
+            "http://patchwork.example.com/patch/2/mbox",
+            body="Subject: Patch #2"
+        )
+
+        log = ('build started\n'
+               'fs/foo.c:1:1: error: \xe2\x80\x98foo\xe2\x80\x99 undeclared\n'
+               'build ended\n')
+        self.basecfg['buildlog'] = self.make_file('build.log', log)
+        self.make_file(
+            'build.log.index',
+            '{"version": 1, "failed_target": null, "errors": '
+            '[{"offset": 14, "file": "fs/foo.c", "line": 1}]}'
+        )
+
+        testprint = StringIO.StringIO()
+        rptclass = reporter.StdioReporter(self.basecfg)
+        rptclass.report(printer=testprint)
+        report = testprint.getvalue()
+
+        self.assertIn('      fs/foo.c:1:1: error: \xe2\x80\x98foo\xe2\x80\x99 '
+                      'undeclared\n', report)
+
     @mock.patch('skt.runner.BeakerRunner.getresultstree')
     @responses.activate
     def test_run_failure(self, mock_grt):
@@ -301,7 +481,7 @@ class TestStdioReporter(unittest.TestCase):
             body="Machine information from beaker goes here"
         )
         mock_grt.return_value = self.beaker_fail_results
-        self.basecfg['retcode'] = '1'
+        self.basecfg['retcode'] = 1
 
         testprint = StringIO.StringIO()
         rptclass = reporter.StdioReporter(self.basecfg)
@@ -354,7 +534,7 @@ class TestStdioReporter(unittest.TestCase):
         )
 
         mock_grt.return_value = self.beaker_pass_results
-        self.basecfg['retcode'] = '0'
+        self.basecfg['retcode'] = 0
 
         testprint = StringIO.StringIO()
         rptclass = reporter.StdioReporter(self.basecfg)
@@ -398,7 +578,7 @@ class TestStdioReporter(unittest.TestCase):
             body="Machine information from beaker goes here"
         )
         mock_grt.return_value = self.beaker_pass_results
-        self.basecfg['retcode'] = '0'
+        self.basecfg['retcode'] = 0
         self.basecfg['localpatches'] = []
         self.basecfg['patchworks'] = ["http://patchwork.example.com/patch/1"]
 
@@ -485,7 +665,7 @@ class TestStdioReporter(unittest.TestCase):
             body="Machine information from beaker goes here"
         )
         mock_grt.return_value = self.beaker_pass_results
-        self.basecfg['retcode'] = '0'
+        self.basecfg['retcode'] = 0
         self.basecfg['localpatches'] = []
         self.basecfg['patchworks'] = []
 
@@ -536,7 +716,7 @@ class TestStdioReporter(unittest.TestCase):
         )
         mock_grt.return_value = self.beaker_pass_results
 
-        self.basecfg['retcode'] = '0'
+        self.basecfg['retcode'] = 0
         self.basecfg['result'] = ['state1', 'state2']
 
         # Create our two mocked state files for two different arches
@@ -546,7 +726,7 @@ class TestStdioReporter(unittest.TestCase):
         state2['kernel_arch'] = 'x86_64'
 
         # Mock the loading of these state files
-        mock_load.side_effect = [state1, state2]
+        mock_load.side_effect = {'state1': state1, 'state2': state2}.get
 
         testprint = StringIO.StringIO()
         rptclass = reporter.StdioReporter(self.basecfg)
@@ -597,7 +777,7 @@ class TestStdioReporter(unittest.TestCase):
         )
         mock_grt.return_value = self.beaker_fail_results
 
-        self.basecfg['retcode'] = '1'
+        self.basecfg['retcode'] = 1
         self.basecfg['result'] = ['state1', 'state2']
 
         # Create our two mocked state files for two different arches
@@ -607,7 +787,7 @@ class TestStdioReporter(unittest.TestCase):
         state2['kernel_arch'] = 'x86_64'
 
         # Mock the loading of these state files
-        mock_load.side_effect = [state1, state2]
+        mock_load.side_effect = {'state1': state1, 'state2': state2}.get
 
         testprint = StringIO.StringIO()
         rptclass = reporter.StdioReporter(self.basecfg)
@@ -632,6 +812,53 @@ class TestStdioReporter(unittest.TestCase):
         for required_string in required_strings:
             self.assertIn(required_string, report)
 
+    @mock.patch('skt.reporter.load_state_cfg')
+    @mock.patch('skt.runner.BeakerRunner.getresultstree')
+    @responses.activate
+    def test_multireport_order(self, mock_grt, mock_load):
+        """Verify state files gathered in parallel keep their order."""
+        responses.add(
+            responses.GET,
+            "http://patchwork.example.com/patch/1/mbox",
+            body="Subject: Patch #1"
+        )
+        responses.add(
+            responses.GET,
+            "http://patchwork.example.com/patch/2/mbox",
+            body="Subject: Patch #2"
+        )
+        mock_grt.return_value = self.beaker_pass_results
+
+        self.basecfg['retcode'] = 0
+        self.basecfg['result'] = ['state1', 'state2', 'state3']
+
+        states = {}
+        for (idx, arch) in enumerate(['aarch64', 's390x', 'x86_64']):
+            state = self.basecfg.copy()
+            state['kernel_arch'] = arch
+            state['jobs'] = ['J:{}'.format(idx + 1)]
+            states['state{}'.format(idx + 1)] = state
+
+        # Make the first state file the last one to finish loading.
+        loaded = threading.Event()
+
+        def load_state(statefile):
+            """Load a mocked state file, the first one after the others."""
+            if statefile == 'state1':
+                loaded.wait(5)
+            elif statefile == 'state3':
+                loaded.set()
+            return states[statefile]
+
+        mock_load.side_effect = load_state
+
+        rptclass = reporter.StdioReporter(self.basecfg)
+        report = rptclass._get_multireport()
+
+        self.assertEqual(['J:1', 'J:2', 'J:3'], rptclass.multi_job_ids)
+        self.assertLess(report.index('aarch64:'), report.index('s390x:'))
+        self.assertLess(report.index('s390x:'), report.index('x86_64:'))
+
     @mock.patch('skt.reporter.load_state_cfg')
     @mock.patch('skt.runner.BeakerRunner.getresultstree')
     @responses.activate
@@ -657,7 +884,7 @@ class TestStdioReporter(unittest.TestCase):
         )
         mock_grt.return_value = self.beaker_panic_results
 
-        self.basecfg['retcode'] = '1'
+        self.basecfg['retcode'] = 1
         self.basecfg['result'] = ['state']
 
         state = self.basecfg.copy()
@@ -710,22 +937,24 @@ class TestStdioReporter(unittest.TestCase):
             "http://example.com/machinedesc.log",
             body="Machine information from beaker goes here"
         )
-        mock_grt.side_effect = [
-            self.beaker_fail_results,
-            self.beaker_pass_results,
-        ]
+        mock_grt.side_effect = {
+            'RS:1': self.beaker_fail_results,
+            'RS:2': self.beaker_pass_results,
+        }.get
 
-        self.basecfg['retcode'] = '1'
+        self.basecfg['retcode'] = 1
         self.basecfg['result'] = ['state1', 'state2']
 
         # Create our two mocked state files for two different arches
         state1 = self.basecfg.copy()
         state1['kernel_arch'] = 's390x'
+        state1['recipe_sets'] = ['RS:1']
         state2 = self.basecfg.copy()
         state2['kernel_arch'] = 'x86_64'
+        state2['recipe_sets'] = ['RS:2']
 
         # Mock the loading of these state files
-        mock_load.side_effect = [state1, state2]
+        mock_load.side_effect = {'state1': state1, 'state2': state2}.get
 
         testprint = StringIO.StringIO()
         rptclass = reporter.StdioReporter(self.basecfg)
@@ -751,3 +980,334 @@ class TestStdioReporter(unittest.TestCase):
         ]
         for required_string in required_strings:
             self.assertIn(required_string, report)
+
+
+class TestMailReporter(unittest.TestCase):
+    """Test cases for MailReporter class."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.buildlog = os.path.join(self.tmpdir, 'build.log')
+        with open(self.buildlog, 'w') as fileh:
+            fileh.write('build failed\n' * 100)
+
+        self.basecfg = {
+            'workdir': self.tmpdir,
+            'template': 'full',
+            'krelease': '3.10.0',
+            'baserepo': 'git://git.example.com/kernel.git',
+            'basehead': '1234abcdef',
+            'kernel_arch': 'x86_64',
+            'buildlog': self.buildlog,
+            'reporter': {
+                'type': 'mail',
+                'mail_to': ['dev@example.com'],
+                'mail_cc': None,
+                'mail_bcc': None,
+                'mail_from': 'skt@example.com',
+                'mail_subject_pfx': None,
+                'mail_subject': None,
+                'mail_header': [],
+            },
+        }
+
+        # A mocked SMTP connection accepting everything, which keeps the
+        # message sent.
+        self.mailserver = mock.Mock()
+        self.mailserver.mail.return_value = (250, 'OK')
+        self.mailserver.rcpt.return_value = (250, 'OK')
+        self.mailserver.getreply.side_effect = [(354, 'Go ahead'),
+                                                (250, 'OK')]
+        patcher = mock.patch('smtplib.SMTP', return_value=self.mailserver)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """Tear down text fixtures."""
+        shutil.rmtree(self.tmpdir)
+
+    def get_sent_message(self):
+        """Get the message sent over the mocked SMTP connection."""
+        sent = ''.join(call[0][0]
+                       for call in self.mailserver.send.call_args_list)
+        self.assertTrue(sent.endswith('\r\n.\r\n'))
+        return email.message_from_string(sent[:-len('.\r\n')])
+
+    def test_report(self):
+        """Verify the build log is attached to the report email."""
+        rptclass = reporter.MailReporter(self.basecfg)
+        rptclass.report()
+
+        msg = self.get_sent_message()
+        self.assertIn('FAIL: Build failed', msg['Subject'])
+        parts = msg.get_payload()
+        self.assertIn('build log attached: build_x86_64.log.gz',
+                      parts[0].get_payload())
+        self.assertEqual('build_x86_64.log.gz', parts[1].get_filename())
+        self.mailserver.rcpt.assert_called_once_with('dev@example.com')
+        self.mailserver.quit.assert_called_once()
+
+    def test_report_unicode_excerpt(self):
+        """Verify a report with non-ASCII compiler output is sent."""
+        with open(self.buildlog, 'w') as fileh:
+            fileh.write('error: \xe2\x80\x98foo\xe2\x80\x99 undeclared\n')
+        with open(self.buildlog + '.index', 'w') as fileh:
+            fileh.write('{"version": 1, "failed_target": null, "errors": '
+                        '[{"offset": 0, "file": "fs/foo.c", "line": 1}]}')
+
+        rptclass = reporter.MailReporter(dict(self.basecfg))
+        rptclass.report()
+
+        text = self.get_sent_message().get_payload()[0]
+        self.assertIn(u'error: \u2018foo\u2019 undeclared',
+                      text.get_payload(decode=True).decode('utf-8'))
+
+    def test_report_compressed_log(self):
+        """Verify an up-to-date compressed build log is attached as is."""
+        with open(self.buildlog + '.gz', 'wb') as fileh:
+            fileh.write('compressed build log')
+
+        rptclass = reporter.MailReporter(dict(self.basecfg))
+        rptclass.report()
+
+        parts = self.get_sent_message().get_payload()
+        self.assertEqual('compressed build log',
+                         parts[1].get_payload(decode=True))
+
+        # Compress the log again if it's newer than the compressed copy.
+        os.utime(self.buildlog + '.gz', (0, 0))
+        self.mailserver.getreply.side_effect = [(354, 'Go ahead'),
+                                                (250, 'OK')]
+        self.mailserver.send.reset_mock()
+        rptclass = reporter.MailReporter(dict(self.basecfg))
+        rptclass.report()
+
+        parts = self.get_sent_message().get_payload()
+        compressed = StringIO.StringIO(parts[1].get_payload(decode=True))
+        with gzip.GzipFile(fileobj=compressed, mode='r') as fileh:
+            self.assertEqual('build failed\n' * 100, fileh.read())
+
+    def test_report_large_attachment(self):
+        """Verify attachments over the limit are published and linked."""
+        publish_dir = os.path.join(self.tmpdir, 'published')
+        self.basecfg['publisher'] = ['cp', publish_dir,
+                                     'http://example.com/logs']
+        self.basecfg['mail_attach_max'] = 0
+
+        rptclass = reporter.MailReporter(self.basecfg)
+        rptclass.report()
+
+        msg = self.get_sent_message()
+        parts = msg.get_payload()
+        self.assertEqual(1, len(parts))
+        match = re.search(r'build log: (http://example.com/logs/[^\s)]+)',
+                          parts[0].get_payload())
+        self.assertIsNotNone(match)
+        path = match.group(1).replace('http://example.com/logs',
+                                      publish_dir)
+        self.assertTrue(path.endswith('/build_x86_64.log.gz'))
+        self.assertTrue(os.path.isfile(path))
+
+
+class TestMailSession(unittest.TestCase):
+    """Test cases for MailSession class, using a local SMTP server."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.server = SmtpServer()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.basecfg = {
+            'workdir': self.tmpdir,
+            'template': 'full',
+            'krelease': '3.10.0',
+            'baserepo': 'git://git.example.com/kernel.git',
+            'basehead': '1234abcdef',
+            'smtp_url': self.server.url,
+            'reporter': {
+                'type': 'mail',
+                'mail_to': ['dev@example.com'],
+                'mail_cc': None,
+                'mail_bcc': None,
+                'mail_from': 'skt@example.com',
+                'mail_subject_pfx': None,
+                'mail_subject': None,
+                'mail_header': [],
+            },
+        }
+
+    def tearDown(self):
+        """Tear down text fixtures."""
+        self.stopped.set()
+        self.thread.join()
+        asyncore.close_all()
+        shutil.rmtree(self.tmpdir)
+
+    def serve(self):
+        """Run the SMTP server until the test is done."""
+        while not self.stopped.is_set():
+            asyncore.loop(timeout=0.05, count=1)
+
+    def make_cfg(self, kernel_arch):
+        """Create a configuration for a failed build report."""
+        buildlog = os.path.join(self.tmpdir, 'build_{}.log'.format(
+            kernel_arch))
+        with open(buildlog, 'w') as fileh:
+            fileh.write('build failed on {}\n'.format(kernel_arch))
+        return dict(self.basecfg, kernel_arch=kernel_arch, buildlog=buildlog)
+
+    def test_report_many(self):
+        """Verify several reports are sent over a single connection."""
+        reporter.MailReporter.report_many([self.make_cfg('x86_64'),
+                                           self.make_cfg('s390x')])
+
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual(2, len(self.server.messages))
+        for ((mailfrom, rcpttos, data), kernel_arch) in zip(
+                self.server.messages, ['x86_64', 's390x']):
+            self.assertEqual('skt@example.com', mailfrom)
+            self.assertEqual(['dev@example.com'], rcpttos)
+            msg = email.message_from_string(data)
+            self.assertEqual('build_{}.log.gz'.format(kernel_arch),
+                             msg.get_payload()[1].get_filename())
+
+    @mock.patch('time.sleep')
+    def test_send_temporary_failure(self, mock_sleep):
+        """Verify sending is retried after a temporary failure."""
+        self.server.replies = ['451 Try again later', '452 Out of space']
+
+        with reporter.MailSession(self.server.url) as session:
+            session.send('skt@example.com', ['dev@example.com'],
+                         StringIO.StringIO('Subject: Test\n\nTest\n'))
+
+        self.assertEqual(1, len(self.server.messages))
+        self.assertEqual('Subject: Test\n\nTest',
+                         self.server.messages[0][2])
+        self.assertEqual([mock.call(reporter.SMTP_RETRY_DELAY),
+                          mock.call(reporter.SMTP_RETRY_DELAY * 2)],
+                         mock_sleep.call_args_list)
+
+    @mock.patch('time.sleep')
+    def test_send_permanent_failure(self, mock_sleep):
+        """Verify sending is not retried after a permanent failure."""
+        self.server.replies = ['554 Rejected']
+
+        with reporter.MailSession(self.server.url) as session:
+            with self.assertRaises(smtplib.SMTPDataError):
+                session.send('skt@example.com', ['dev@example.com'],
+                             StringIO.StringIO('Subject: Test\n'))
+
+        self.assertEqual([], self.server.messages)
+        mock_sleep.assert_not_called()
+
+    @mock.patch('time.sleep')
+    def test_send_reconnect(self, mock_sleep):
+        """Verify the session reconnects after losing the connection."""
+        with reporter.MailSession(self.server.url) as session:
+            session.send('skt@example.com', ['dev@example.com'],
+                         StringIO.StringIO('Subject: First\n'))
+            session.mailserver.sock.close()
+            session.send('skt@example.com', ['dev@example.com'],
+                         StringIO.StringIO('Subject: Second\n'))
+
+        self.assertEqual(2, len(self.server.messages))
+        self.assertEqual(2, self.server.connections)
+        mock_sleep.assert_called_once()
+
+
+class TestExportReporter(unittest.TestCase):
+    """Test cases for the exporting reporter classes."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.cfg = {
+            'krelease': '3.10.0',
+            'recipe_sets': ['RS:1'],
+            'runner': ('beaker', {'jobtemplate': 'foo'}),
+        }
+        self.fail_results = fromstring(
+            read_asset("beaker_recipe_set_fail_results.xml")
+        )
+        self.fail_results.find('recipe').attrib['id'] = '12'
+        self.fail_results.find('recipe/task[2]').attrib['duration'] = \
+            '0:00:42'
+        self.expected = [
+            {'krelease': '3.10.0', 'recipe_set': 'RS:1', 'recipe': '12',
+             'arch': 'x86_64', 'task': '/distribution/kpkginstall',
+             'result': 'Pass', 'status': 'Completed', 'duration': 42,
+             'url': 'https://github.com/CKI-project/tests-beaker/archive/'
+                    'master.zip#distribution/kpkginstall',
+             'logs': []},
+            {'krelease': '3.10.0', 'recipe_set': 'RS:1', 'recipe': '12',
+             'arch': 'x86_64', 'task': '/test/we/ran', 'result': 'Fail',
+             'status': 'Completed', 'duration': None, 'url': '',
+             'logs': []},
+        ]
+
+    def tearDown(self):
+        """Tear down text fixtures."""
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('skt.reporter.load_state_cfg')
+    @mock.patch('skt.runner.BeakerRunner.getresultstree')
+    def test_jsonl(self, mock_grt, mock_load):
+        """Verify a JSON record is printed for each test task."""
+        mock_grt.return_value = self.fail_results
+        mock_load.side_effect = {
+            'state1': self.cfg,
+            'state2': dict(self.cfg, runner=None),
+        }.get
+
+        testprint = StringIO.StringIO()
+        reporter.JsonlReporter(
+            {'result': ['state1', 'state2']}
+        ).report(printer=testprint)
+
+        self.assertEqual(
+            self.expected,
+            [json.loads(line) for line in testprint.getvalue().splitlines()]
+        )
+
+    @mock.patch('skt.runner.BeakerRunner.getresultstree')
+    def test_jsonl_output(self, mock_grt):
+        """Verify the JSON records are appended to the output file."""
+        mock_grt.return_value = self.fail_results
+        output = os.path.join(self.tmpdir, 'results.jsonl')
+
+        for _ in range(2):
+            reporter.JsonlReporter(
+                dict(self.cfg, report_output=output)
+            ).report()
+
+        with open(output) as fileh:
+            self.assertEqual(self.expected * 2,
+                             [json.loads(line) for line in fileh])
+
+    @mock.patch('skt.runner.BeakerRunner.getresultstree')
+    def test_sqlite(self, mock_grt):
+        """Verify a database row is inserted for each test task."""
+        self.fail_results.find('recipe/task[3]').attrib['result'] = 'Panic'
+        mock_grt.return_value = self.fail_results
+        output = os.path.join(self.tmpdir, 'results.sqlite')
+
+        reporter.SqliteReporter(dict(self.cfg, report_output=output)).report()
+
+        connection = sqlite3.connect(output)
+        try:
+            rows = connection.execute(
+                'SELECT task, result, arch, logs FROM results'
+            ).fetchall()
+        finally:
+            connection.close()
+
+        self.assertEqual(
+            [('/distribution/kpkginstall', 'Pass', 'x86_64', '[]'),
+             ('/test/we/ran', 'Panic', 'x86_64',
+              '["http://example.com/"]')],
+            rows
+        )
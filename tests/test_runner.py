@@ -89,6 +89,80 @@ class TestRunner(unittest.TestCase):
         ret_list = self.myrunner.get_recipe_test_list(recipe_node)
         self.assertEqual(ret_list, ['good1', 'good2'])
 
+    def test_summarize_recipe(self):
+        """Ensure summarize_recipe sorts the tasks after kpkginstall."""
+        recipe_xml = """<recipe id="1" result="Panic" status="Aborted">
+        <hostRequires><and><arch op="=" value="s390x"/></and></hostRequires>
+        <logs><log name="console.log" href="http://console"/></logs>
+        <task name="setup" result="Pass"><fetch url="setup"/></task>
+        <task name="Boot test" result="Pass" duration="0:01:00">
+          <fetch url="kpkginstall"/></task>
+        <task name="skipped" result="Skip"/>
+        <task name="aborted" result="Warn" status="Aborted"/>
+        <task name="failed" result="Fail"><fetch url="failed"/>
+          <logs><log name="harness.log" href="http://harness"/>
+          <log name="taskout.log" href="http://taskout"/></logs>
+          <results><result result="Pass"><logs>
+            <log name="pass.log" href="http://pass"/></logs></result>
+          <result result="Fail"><logs>
+            <log name="fail.log" href="http://fail"/></logs></result>
+          </results></task>
+        <task name="panicked" result="Panic"/></recipe>"""
+
+        summary = self.myrunner.summarize_recipe(fromstring(recipe_xml))
+
+        self.assertEqual('1', summary['id'])
+        self.assertEqual('s390x', summary['arch'])
+        self.assertEqual('Panic', summary['result'])
+        self.assertEqual('Boot test', summary['kpkginstall'].attrib['name'])
+        self.assertEqual(['Boot test', 'aborted', 'failed', 'panicked'],
+                         summary['tests'])
+        self.assertEqual(['Boot test', 'aborted', 'failed', 'panicked'],
+                         [task['name'] for task in summary['tasks']])
+        self.assertEqual(
+            [{'name': 'Boot test', 'url': 'kpkginstall', 'result': 'Pass',
+              'status': None, 'duration': '0:01:00'}],
+            summary['passed_tasks']
+        )
+        self.assertEqual(['aborted'],
+                         [task['name'] for task in summary['aborted_tasks']])
+        self.assertEqual(
+            [('failed', 'failed', ['http://taskout', 'http://fail']),
+             ('panicked', '', ['http://console'])],
+            [(task['name'], task['url'], task['logs'])
+             for task in summary['failed_tasks']]
+        )
+        # The first task which didn't pass is a skipped one
+        self.assertFalse(summary['test_failure'])
+
+    def test_summarize_recipe_failures(self):
+        """Ensure summarize_recipe detects test failures."""
+        # Failure before the kernel was installed
+        recipe_node = fromstring("""<recipe>
+        <task name="setup" result="Fail"/>
+        <task name="Boot test" result="Pass"><fetch url="kpkginstall"/></task>
+        </recipe>""")
+        summary = self.myrunner.summarize_recipe(recipe_node)
+        self.assertFalse(summary['test_failure'])
+        self.assertEqual(['Boot test'], summary['tests'])
+
+        # Failure in a test
+        recipe_node = fromstring("""<recipe>
+        <task name="Boot test" result="Pass"><fetch url="kpkginstall"/></task>
+        <task name="test" result="Fail"/></recipe>""")
+        self.assertTrue(
+            self.myrunner.summarize_recipe(recipe_node)['test_failure']
+        )
+
+        # Without kpkginstall every task is a test
+        recipe_node = fromstring("""<recipe>
+        <task name="test" result="Pass"/></recipe>""")
+        summary = self.myrunner.summarize_recipe(recipe_node)
+        self.assertIsNone(summary['kpkginstall'])
+        self.assertIsNone(summary['arch'])
+        self.assertTrue(summary['test_failure'])
+        self.assertEqual(['test'], summary['tests'])
+
     @mock.patch('subprocess.Popen')
     def test_jobsubmit(self, mock_popen):
         """ Ensure __jobsubmit works."""
@@ -445,6 +519,22 @@ class TestRunner(unittest.TestCase):
         result = self.myrunner.run(url, self.max_aborted, release, wait)
         self.assertEqual(result, 0)
 
+    @mock.patch('skt.runner.BeakerRunner._BeakerRunner__jobsubmit')
+    @mock.patch('skt.runner.BeakerRunner._BeakerRunner__getxml')
+    def test_run_kpkg_format(self, mock_getxml, mock_jobsubmit):
+        """Ensure BeakerRunner.run passes the tarball format to the job."""
+        url = "http://machine1.example.com/builds/1234567890.tar.xz"
+        mock_getxml.return_value = misc.get_asset_content('test.xml')
+        mock_jobsubmit.return_value = "J:0001"
+
+        result = self.myrunner.run(url, self.max_aborted, "4.17.0-rc1",
+                                   kpkg_format='tarxz')
+
+        self.assertEqual(result, 0)
+        replacements = mock_getxml.call_args[0][0]
+        self.assertEqual('tarxz', replacements['KPKG_FORMAT'])
+        self.assertEqual(url, replacements['KPKG_URL'])
+
     @mock.patch('logging.error')
     @mock.patch('skt.runner.BeakerRunner._BeakerRunner__getxml')
     def test_run_fail(self, mock_logging_err, mock_getxml):
@@ -15,9 +15,12 @@
 import ConfigParser
 import os
 import shutil
+import stat
 import tempfile
 import unittest
 
+import mock
+
 from skt import state_file
 
 
@@ -79,13 +82,168 @@ class TestStateFile(unittest.TestCase):
 
         config = ConfigParser.RawConfigParser()
         config.read(temp_state)
-        self.assertEqual(config.get('state', 'foo'), 'bar')
-        self.assertEqual(config.get('state', 'foo2'), 'bar2')
+        self.assertEqual(config.get('state', 'state_version'), '2')
+        self.assertEqual(config.get('state', 'foo'), '"bar"')
+        self.assertEqual(config.get('state', 'foo2'), '"bar2"')
 
         # Test a write with an existing state file.
         state_file.update_state(temp_state, new_state)
 
         config = ConfigParser.RawConfigParser()
         config.read(temp_state)
-        self.assertEqual(config.get('state', 'foo'), 'bar')
-        self.assertEqual(config.get('state', 'foo2'), 'bar2')
+        self.assertEqual(config.get('state', 'foo'), '"bar"')
+        self.assertEqual(config.get('state', 'foo2'), '"bar2"')
+
+    def test_typed_values(self):
+        """Ensure state values keep their types."""
+        temp_state = "{}/temp_sktrc".format(self.tmpdir)
+        with open(temp_state, 'w') as fileh:
+            fileh.write('[config]\nworkdir = /tmp\n')
+
+        new_state = {
+            'retcode': 0,
+            'jobs': ['J:1', 'J:2'],
+            'build_metrics': {'build': {'wall': 1.5}},
+            'cross_compiler_prefix': None,
+            'krelease': '4.17.0%skt',
+        }
+        state_file.update_state(temp_state, new_state)
+
+        self.assertEqual(new_state, state_file.load_state(temp_state))
+        self.assertIsInstance(state_file.get_state(temp_state, 'krelease'),
+                              str)
+
+        # Other sections are kept.
+        config = ConfigParser.RawConfigParser()
+        config.read(temp_state)
+        self.assertEqual(config.get('config', 'workdir'), '/tmp')
+
+    def test_legacy_state(self):
+        """Ensure old state files are read and converted."""
+        temp_state = "{}/temp_sktrc".format(self.tmpdir)
+        with open(temp_state, 'w') as fileh:
+            fileh.write('[state]\n'
+                        'retcode = 1\n'
+                        'jobid_0 = J:1\n'
+                        'jobid_1 = J:2\n'
+                        'mergerepo_00 = git://a\n'
+                        'tarpkg = a.tar.gz\n')
+
+        state = state_file.load_state(temp_state)
+        self.assertEqual(1, state['retcode'])
+        self.assertEqual(set(['J:1', 'J:2']), state['jobs'])
+        self.assertEqual(['git://a'], state['mergerepos'])
+        self.assertEqual('a.tar.gz', state['tarpkg'])
+        # The numbered keys are replaced by the lists.
+        self.assertNotIn('jobid_0', state)
+        self.assertNotIn('mergerepo_00', state)
+
+        # The file is converted to the current format on update.
+        state_file.update_state(temp_state, {'buildurl': 'http://a'})
+        state = state_file.load_state(temp_state)
+        self.assertEqual(['J:1', 'J:2'], state['jobs'])
+        self.assertEqual(1, state['retcode'])
+        self.assertEqual('http://a', state['buildurl'])
+        self.assertEqual(['buildurl', 'jobs', 'mergerepos', 'retcode',
+                          'tarpkg'], sorted(state))
+
+    def test_invalid_json_value(self):
+        """Ensure values which aren't valid JSON are read as strings."""
+        temp_state = "{}/temp_sktrc".format(self.tmpdir)
+        state_file.update_state(temp_state, {'foo': 'bar', 'retcode': 1})
+        with open(temp_state, 'a') as fileh:
+            fileh.write('edited = some value\n')
+
+        self.assertEqual('some value',
+                         state_file.get_state(temp_state, 'edited'))
+        state = state_file.load_state(temp_state)
+        self.assertEqual({'foo': 'bar', 'retcode': 1, 'edited': 'some value'},
+                         state)
+
+    def test_update_state_atomic(self):
+        """Ensure a failed write leaves the state file intact."""
+        temp_state = "{}/temp_sktrc".format(self.tmpdir)
+        state_file.update_state(temp_state, {'foo': 'bar'})
+        os.chmod(temp_state, 0o640)
+
+        with mock.patch('ConfigParser.RawConfigParser.write',
+                        exception_maker):
+            with self.assertRaises(IOError):
+                state_file.update_state(temp_state, {'foo': 'baz'})
+
+        self.assertEqual(state_file.get_state(temp_state, 'foo'), 'bar')
+        self.assertEqual(['temp_sktrc', 'temp_sktrc.lock'],
+                         sorted(os.listdir(self.tmpdir)))
+
+        # The mode of the state file is kept.
+        state_file.update_state(temp_state, {'foo': 'baz'})
+        self.assertEqual(0o640, stat.S_IMODE(os.stat(temp_state).st_mode))
+
+    def test_state_transaction(self):
+        """Ensure updates in a transaction are written at once."""
+        temp_state = "{}/temp_sktrc".format(self.tmpdir)
+
+        with mock.patch('skt.state_file.write_state_file',
+                        wraps=state_file.write_state_file) as mock_write:
+            with state_file.state_transaction(temp_state):
+                for index in range(100):
+                    state_file.update_state(temp_state,
+                                            {'jobid_%s' % index: index})
+                # Nested transactions are part of the outer one.
+                with state_file.state_transaction(temp_state):
+                    state_file.update_state(temp_state, {'foo': 'bar'})
+
+                # Pending values are visible, but not written yet.
+                self.assertEqual(
+                    state_file.get_state(temp_state, 'jobid_99'), 99
+                )
+                self.assertFalse(os.path.exists(temp_state))
+
+            mock_write.assert_called_once()
+
+        self.assertEqual(state_file.get_state(temp_state, 'jobid_99'), 99)
+        self.assertEqual(state_file.get_state(temp_state, 'foo'), 'bar')
+
+    def test_state_transaction_exception(self):
+        """Ensure updates are written if a transaction is interrupted."""
+        temp_state = "{}/temp_sktrc".format(self.tmpdir)
+
+        with self.assertRaises(ValueError):
+            with state_file.state_transaction(temp_state):
+                state_file.update_state(temp_state, {'foo': 'bar'})
+                raise ValueError
+
+        self.assertEqual(state_file.get_state(temp_state, 'foo'), 'bar')
+
+    def test_read_state_file_cache(self):
+        """Ensure state files are parsed once until they change."""
+        temp_state = "{}/temp_sktrc".format(self.tmpdir)
+        state_file.update_state(temp_state, {'jobs': ['J:1']})
+
+        with mock.patch('ConfigParser.ConfigParser.read',
+                        autospec=True,
+                        side_effect=ConfigParser.ConfigParser.read) as read:
+            (_, first) = state_file.read_state_file(temp_state)
+            (_, second) = state_file.read_state_file(temp_state)
+            self.assertIs(first, second)
+            self.assertIs(first.get('jobs'), second.get('jobs'))
+            self.assertEqual(1, read.call_count)
+
+            # Updates replace the file, which invalidates the cached one.
+            state_file.update_state(temp_state, {'jobs': ['J:1', 'J:2']})
+            self.assertEqual(['J:1', 'J:2'],
+                             state_file.get_state(temp_state, 'jobs'))
+            self.assertEqual(2, read.call_count)
+
+    def test_state_values_lazy(self):
+        """Ensure state values are decoded on their first access."""
+        values = state_file.StateValues([('state_version', '2'),
+                                         ('good', '"a"'),
+                                         ('bad', 'not json')])
+
+        self.assertEqual(['good', 'bad'], values.keys())
+        self.assertIn('bad', values)
+        self.assertEqual('a', values.get('good'))
+        self.assertIsNone(values.get('missing'))
+        # Values which aren't valid JSON are taken as strings.
+        self.assertEqual('not json', values.get('bad'))